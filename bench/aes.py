@@ -0,0 +1,77 @@
+#! /usr/bin/python2
+"""
+bench/aes.py
+~~~~~~~~~~~~
+
+Measures the cluster decryption throughput of every available AES backend.
+Each cluster is decrypted separately with its own IV, like in
+wiiod.partition.Partition.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import crypto
+from wiiod.partition import CLUSTER_DATA_SIZE
+
+def bench(backend, clusters, runs):
+    """
+    Returns the best throughput (in MB/s of decrypted data) of a backend
+    over the given list of (iv, data) clusters.
+    """
+    key = os.urandom(16)
+    decrypt = backend.cbc_decrypt
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        for iv, data in clusters:
+            decrypt(key, iv, data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(clusters) * CLUSTER_DATA_SIZE / 1048576.0 / max(best, 1e-9)
+
+def main():
+    parser = argparse.ArgumentParser(description='AES backends benchmark.')
+    parser.add_argument('-n', '--clusters', type=int, default=1024,
+                        help='number of clusters per run '
+                             '(default: %(default)s)')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='number of runs (default: %(default)s)')
+    args = parser.parse_args()
+
+    clusters = [(os.urandom(16), os.urandom(CLUSTER_DATA_SIZE))
+                for i in xrange(args.clusters)]
+
+    available = crypto.available_backends()
+    for name in crypto.BACKENDS:
+        if name not in available:
+            print '%-14s not installed' % name
+            continue
+        speed = bench(crypto.get_backend(name), clusters, args.runs)
+        print '%-14s %8.1f MB/s' % (name, speed)
+
+    if available:
+        print 'default:       %s' % available[0]
+
+if __name__ == '__main__':
+    main()
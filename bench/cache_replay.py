@@ -0,0 +1,117 @@
+#! /usr/bin/python2
+"""
+bench/cache_replay.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Replays cluster access traces against every cache replacement policy and
+reports their hit ratios.
+
+A trace is a text file with one accessed cluster per line, either as a
+cluster index or as "<partition> <cluster index>". Without a trace file, a
+synthetic trace is used: random reads in a small hot set (FST, main.dol,
+small assets) interleaved with a long sequential scan (streamed video).
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache
+from wiiod.partition import CLUSTER_DATA_SIZE
+
+def load_trace(path):
+    """
+    Loads a trace file and returns the list of accessed keys.
+    """
+    trace = []
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) == 1:
+                trace.append((0, int(fields[0])))
+            elif len(fields) == 2:
+                trace.append((fields[0], int(fields[1])))
+    return trace
+
+def synthetic_trace(length, hot_clusters, scan_ratio, seed=0):
+    """
+    Generates a trace of random accesses to hot_clusters clusters, mixed
+    with a sequential scan of new clusters read in 4KB requests (so each
+    scanned cluster is accessed several times in a row). scan_ratio is the
+    share of the requests belonging to the scan.
+    """
+    rnd = random.Random(seed)
+    reads_per_cluster = CLUSTER_DATA_SIZE // 4096 + 1
+    trace = []
+    scan_pos = hot_clusters * reads_per_cluster
+    while len(trace) < length:
+        if rnd.random() < scan_ratio:
+            trace.append((0, scan_pos // reads_per_cluster))
+            scan_pos += 1
+        else:
+            trace.append((0, rnd.randrange(hot_clusters)))
+    return trace
+
+def replay(policy, max_bytes, trace):
+    """
+    Replays the trace on a new cache and returns the cache and the elapsed
+    time.
+    """
+    cluster = '\0' * CLUSTER_DATA_SIZE
+    cache_obj = cache.new_cache(policy, max_bytes)
+
+    start = time.time()
+    for key in trace:
+        if cache_obj.get(key) is None:
+            cache_obj.put(key, cluster)
+    return cache_obj, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache policies replay.')
+    parser.add_argument('traces', nargs='*', help='trace files to replay')
+    parser.add_argument('-c', '--cache-size', type=float, default=4,
+                        metavar='MB', help='cache budget in MB')
+    parser.add_argument('-n', '--length', type=int, default=200000,
+                        help='synthetic trace length')
+    parser.add_argument('--hot', type=int, default=96,
+                        help='synthetic trace hot set size (clusters)')
+    parser.add_argument('--scan', type=float, default=0.5,
+                        help='synthetic trace share of sequential requests')
+    args = parser.parse_args()
+
+    if args.traces:
+        traces = [(path, load_trace(path)) for path in args.traces]
+    else:
+        traces = [('synthetic', synthetic_trace(args.length, args.hot,
+                                                args.scan))]
+
+    max_bytes = int(args.cache_size * 1024 * 1024)
+    for name, trace in traces:
+        print '%s: %d accesses, %.1f MB cache' % (name, len(trace),
+                                                  args.cache_size)
+        for policy in cache.POLICIES:
+            cache_obj, elapsed = replay(policy, max_bytes, trace)
+            ratio = 100.0 * cache_obj.hits / len(trace)
+            print '  %-4s hit ratio %6.2f%%  evictions %8d  %7.1f ms' % (
+                policy, ratio, cache_obj.evictions, elapsed * 1000)
+
+if __name__ == '__main__':
+    main()
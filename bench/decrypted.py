@@ -0,0 +1,95 @@
+#! /usr/bin/python2
+"""
+bench/decrypted.py
+~~~~~~~~~~~~~~~~~~
+
+Compares random read latency on an encrypted image and on its decrypted
+export (see wiiod.export). The clusters cache is disabled so that every read
+goes to the disc image.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, export, partition
+
+def bench(image_path, reads, size, runs):
+    """
+    Returns the best average latency (in seconds) of reads of size bytes at
+    random offsets of the first game partition of the image.
+    """
+    disc_obj = disc.open_disc(image_path)
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(0))
+
+    data_size = part.data_size / partition.CLUSTER_SIZE * \
+        partition.CLUSTER_DATA_SIZE
+    rand = random.Random(42)
+    offsets = [rand.randrange(data_size - size) for i in xrange(reads)]
+
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        for offset in offsets:
+            part.read(offset, size)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    disc_obj.close()
+    return best / reads
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Encrypted vs decrypted image benchmark.')
+    parser.add_argument('image', help='path to an encrypted disc image')
+    parser.add_argument('decrypted', nargs='?',
+                        help='path to its decrypted export (default: '
+                             'exported to a temporary file)')
+    parser.add_argument('-n', '--reads', type=int, default=2000,
+                        help='number of reads per run (default: %(default)s)')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='size of the reads (default: %(default)s)')
+    parser.add_argument('-r', '--runs', type=int, default=3,
+                        help='number of runs (default: %(default)s)')
+    args = parser.parse_args()
+
+    decrypted = args.decrypted
+    if decrypted is None:
+        fd, decrypted = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        export.export(args.image, decrypted)
+
+    try:
+        encrypted_lat = bench(args.image, args.reads, args.size, args.runs)
+        decrypted_lat = bench(decrypted, args.reads, args.size, args.runs)
+    finally:
+        if args.decrypted is None:
+            os.unlink(decrypted)
+
+    print 'encrypted image: %8.1f us/read' % (encrypted_lat * 1e6)
+    print 'decrypted image: %8.1f us/read' % (decrypted_lat * 1e6)
+    print 'speedup:         %8.2fx' % (encrypted_lat / decrypted_lat)
+
+if __name__ == '__main__':
+    main()
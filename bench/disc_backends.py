@@ -0,0 +1,94 @@
+#! /usr/bin/python2
+"""
+bench/disc_backends.py
+~~~~~~~~~~~~~~~~~~~~~~
+
+Compares the raw read throughput of the file and mmap disc backends, for
+sequential and random cluster reads, with a cold and a warm page cache.
+
+Dropping the page cache needs write access to /proc/sys/vm/drop_caches
+(usually root); cold cache measurements are skipped otherwise.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import disc
+from wiiod.partition import CLUSTER_SIZE
+
+def drop_page_cache():
+    """
+    Drops the kernel page cache. Returns False if it is not permitted.
+    """
+    os.system('sync')
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as fp:
+            fp.write('1\n')
+        return True
+    except IOError:
+        return False
+
+def bench(disc_obj, offsets):
+    start = time.time()
+    for offset in offsets:
+        disc_obj.read(offset, CLUSTER_SIZE)
+    return len(offsets) * CLUSTER_SIZE / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Disc backends benchmark.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('-s', '--size', type=int, default=512, metavar='MB',
+                        help='amount of data to read (default: %(default)s)')
+    args = parser.parse_args()
+
+    image_size = os.path.getsize(args.image)
+    count = min(args.size * 1024 * 1024, image_size) / CLUSTER_SIZE
+    sequential = [i * CLUSTER_SIZE for i in xrange(count)]
+    rand = [random.randrange(image_size / CLUSTER_SIZE) * CLUSTER_SIZE
+            for i in xrange(count)]
+
+    can_drop = drop_page_cache()
+    if not can_drop:
+        print 'cannot drop the page cache, skipping cold cache runs'
+
+    for backend in ('file', 'mmap'):
+        for pattern, offsets in (('sequential', sequential), ('random', rand)):
+            for state in ('cold', 'warm'):
+                if state == 'cold':
+                    if not can_drop:
+                        continue
+                    drop_page_cache()
+                else:
+                    # Make sure the data is in the page cache
+                    disc_obj = disc.open_disc(args.image, 'file')
+                    bench(disc_obj, offsets)
+                    disc_obj.close()
+
+                disc_obj = disc.open_disc(args.image, backend, pattern)
+                speed = bench(disc_obj, offsets)
+                disc_obj.close()
+                print '%-4s %-10s %s cache: %8.2f MB/s' % (
+                    backend, pattern, state, speed / 1024 / 1024)
+
+if __name__ == '__main__':
+    main()
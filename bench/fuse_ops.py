@@ -0,0 +1,150 @@
+#! /usr/bin/python2
+"""
+bench/fuse_ops.py
+~~~~~~~~~~~~~~~~~
+
+Compares the cost of the FUSE operations of the PyFS adapter (wiiod.fs
+exposed by fs.expose.fuse) and of the native adapter (wiiod.fuseops). The
+operations are called directly, without mounting anything: this measures
+the time spent in Python for each request, not the kernel caching.
+
+Both adapters need a FUSE library to be importable; adapters which cannot
+be imported are skipped.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import os
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, partition, wiiodfs
+
+class FileInfo(object):
+    """
+    Stand-in for the fuse_file_info structure given to open/read/release.
+    """
+
+    def __init__(self):
+        self.flags = os.O_RDONLY
+        self.fh = None
+        self.keep_cache = 0
+
+def pyfs_adapter(fs_obj):
+    """
+    Returns the PyFS operations of a filesystem and the path type they use.
+    """
+    from fs.expose import fuse
+    from wiiod import fs
+
+    # The caller context is only available inside a mounted filesystem
+    fuse.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+    return fuse.FSOperations(fs.WiiODFS(fs_obj)), str
+
+def native_adapter(fs_obj):
+    """
+    Returns the native operations of a filesystem and the path type they use.
+    """
+    from wiiod import fuseops
+    return fuseops.WiiODOperations(fs_obj), unicode
+
+ADAPTERS = (('pyfs', pyfs_adapter), ('native', native_adapter))
+
+def bench(ops, path_type, dirs, files, reads, size):
+    """
+    Returns the average time (in seconds) of the getattr, readdir and read
+    (including open and release) operations.
+    """
+    dirs = [path_type(path) for path in dirs]
+    files = [(path_type(path), file_size) for path, file_size in files]
+    paths = dirs + [path for path, _ in files]
+
+    start = time.time()
+    for path in paths:
+        ops.getattr(path)
+    getattr_time = (time.time() - start) / len(paths)
+
+    start = time.time()
+    for path in dirs:
+        ops.readdir(path, None)
+    readdir_time = (time.time() - start) / len(dirs)
+
+    rand = random.Random(42)
+    start = time.time()
+    for i in xrange(reads):
+        path, file_size = rand.choice(files)
+        fi = FileInfo()
+        ops.open(path, fi)
+        ops.read(path, size, rand.randrange(max(file_size - size, 1)), fi)
+        ops.release(path, fi)
+    read_time = (time.time() - start) / reads
+
+    return getattr_time, readdir_time, read_time
+
+def main():
+    parser = argparse.ArgumentParser(description='FUSE adapters benchmark.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('-n', '--reads', type=int, default=5000,
+                        help='number of reads (default: %(default)s)')
+    parser.add_argument('-s', '--size', type=int, default=128 * 1024,
+                        help='size of the reads (default: %(default)s)')
+    parser.add_argument('-c', '--cache-size', type=int, default=1024,
+                        help='clusters cache size, in MB, large enough for '
+                             'all the files (default: %(default)s)')
+    args = parser.parse_args()
+
+    disc_obj = disc.open_disc(args.image)
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos,
+                               cache.LRUCache(args.cache_size * 1024 * 1024))
+    fs_obj = wiiodfs.Filesystem(part)
+
+    dirs, files = [], []
+    for ino in xrange(fs_obj.inode_count):
+        path = fs_obj.inode_path(ino)
+        if fs_obj.inode_isdir(ino):
+            dirs.append(path)
+        elif fs_obj.inode_size(ino):
+            files.append((path, fs_obj.inode_size(ino)))
+
+    # Decrypt the clusters beforehand: only the adapters are measured
+    for path, _ in files:
+        fs_obj.open(path).read()
+
+    results = {}
+    for name, adapter in ADAPTERS:
+        try:
+            ops, path_type = adapter(fs_obj)
+        except (ImportError, EnvironmentError) as e:
+            print '%-7s not available: %s' % (name, e)
+            continue
+        results[name] = bench(ops, path_type, dirs, files, args.reads,
+                              args.size)
+        print '%-7s getattr %8.1f us  readdir %8.1f us  read %8.1f us' % (
+            (name,) + tuple(t * 1e6 for t in results[name]))
+
+    if len(results) == 2:
+        print 'speedup getattr %8.2fx  readdir %8.2fx  read %8.2fx' % tuple(
+            old / new for old, new in zip(results['pyfs'], results['native']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#! /usr/bin/python2
+"""
+bench/http_ranges.py
+~~~~~~~~~~~~~~~~~~~~
+
+Measures the throughput of the HTTP server (wiiod.httpd) under parallel range
+requests: for each number of clients, every client thread sends requests for
+random ranges of random files over its own keep-alive connection, and the
+total throughput and the latency percentiles of the requests are reported.
+
+The server runs in its own process, so that the clients do not compete with
+it for the interpreter lock. It uses a synthetic disc image (see
+wiiod.synth), whose responses are checked against the expected content, or a
+given image.
+
+On synthetic images, the answers to empty file, suffix, open-ended, out of
+bounds and multiple range requests are checked first, and the script exits
+with a non-zero status if one of them is wrong.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import httplib
+import multiprocessing
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, httpd, partition, synth, wiiodfs
+
+PERCENTILES = (50, 90, 99)
+
+# Empty file added to the synthetic images
+EMPTY_PATH = '/empty.bin'
+
+class CheckError(Exception):
+    pass
+
+def open_filesystem(image_path, cache_size):
+    """
+    Opens the first game partition of an image and returns its
+    wiiod.wiiodfs.Filesystem.
+    """
+    disc_obj = disc.open_disc(image_path, 'auto', 'random')
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(cache_size))
+    return wiiodfs.Filesystem(part)
+
+def client(port, files, requests, range_size, seed, check, results):
+    """
+    Sends requests for random ranges of the files, a list of (path, size,
+    data offset) tuples, over one connection. Appends the latencies, the
+    number of bytes received and the number of connections opened to
+    results.
+    """
+    rand = random.Random(seed)
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    received = 0
+    connections = 0
+    for i in xrange(requests):
+        path, size, offset = rand.choice(files)
+        first = rand.randrange(max(size - range_size, 0) + 1)
+        last = min(first + range_size, size) - 1
+
+        start = time.time()
+        if conn.sock is None:
+            connections += 1
+        conn.request('GET', urllib.quote(path),
+                     headers={'Range': 'bytes=%d-%d' % (first, last)})
+        resp = conn.getresponse()
+        data = resp.read()
+        latencies.append(time.time() - start)
+
+        if resp.status != 206 or len(data) != last - first + 1:
+            raise ValueError("bad response for %s: %d" % (path, resp.status))
+        if check and data != synth.pattern(offset + first, len(data)):
+            raise ValueError("wrong content in %s at %d" % (path, first))
+        received += len(data)
+    conn.close()
+    results.append((latencies, received, connections))
+
+def get(conn, path, byte_range):
+    """
+    Requests a file with the given Range header (or none if it is None).
+    Returns the status, the Content-Range header and the body.
+    """
+    headers = {}
+    if byte_range is not None:
+        headers['Range'] = byte_range
+    conn.request('GET', urllib.quote(path), headers=headers)
+    resp = conn.getresponse()
+    return resp.status, resp.getheader('Content-Range'), resp.read()
+
+def check_ranges(port, files):
+    """
+    Checks the answers of the server to the edge cases of range requests on
+    a synthetic image, whose files are a list of (path, size, data offset)
+    tuples. Raises CheckError on the first wrong answer. Returns the number
+    of requests checked.
+    """
+    path, size, offset = max(files, key=lambda f: f[1])
+    if size < 16:
+        raise CheckError('no file large enough to check the ranges')
+    content = lambda first, last: synth.pattern(offset + first,
+                                                last - first + 1)
+    whole = (200, None, content(0, size - 1))
+    partial = lambda first, last: (206, 'bytes %d-%d/%d' % (first, last,
+                                                            size),
+                                   content(first, last))
+    unsatisfiable = lambda length: (416, 'bytes */%d' % length, '')
+
+    cases = [
+        # Empty file
+        (EMPTY_PATH, None, (200, None, '')),
+        (EMPTY_PATH, 'bytes=-10', unsatisfiable(0)),
+        (EMPTY_PATH, 'bytes=0-', unsatisfiable(0)),
+        (EMPTY_PATH, 'bytes=0-0', unsatisfiable(0)),
+        # Suffix ranges
+        (path, 'bytes=-10', partial(size - 10, size - 1)),
+        (path, 'bytes=-%d' % (size + 10), partial(0, size - 1)),
+        (path, 'bytes=-0', unsatisfiable(size)),
+        # Open-ended and closed ranges
+        (path, 'bytes=5-', partial(5, size - 1)),
+        (path, 'bytes=%d-' % (size - 1), partial(size - 1, size - 1)),
+        (path, 'bytes=3-9', partial(3, 9)),
+        (path, 'bytes=0-%d' % (size + 100), partial(0, size - 1)),
+        # Out of bounds ranges
+        (path, 'bytes=%d-' % size, unsatisfiable(size)),
+        (path, 'bytes=%d-%d' % (size, size + 10), unsatisfiable(size)),
+        # Forms which are not supported: the whole file is sent
+        (path, 'bytes=0-1,4-5', whole),
+        (path, 'bytes=9-3', whole),
+        (path, 'items=0-1', whole),
+    ]
+
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    try:
+        for case_path, byte_range, expected in cases:
+            answer = get(conn, case_path, byte_range)
+            if answer != expected:
+                raise CheckError('%s with Range %r: got %d %r (%d bytes), '
+                                 'expected %d %r (%d bytes)' % (
+                    case_path, byte_range, answer[0], answer[1],
+                    len(answer[2]), expected[0], expected[1],
+                    len(expected[2])))
+    finally:
+        conn.close()
+    return len(cases)
+
+def run(port, files, clients, requests, range_size, seed, check):
+    """
+    Runs the given number of clients in parallel. Returns the sorted list
+    of the latencies, the number of bytes received, the number of
+    connections opened and the elapsed time.
+    """
+    results = []
+    threads = [threading.Thread(target=client,
+                                args=(port, files, requests, range_size,
+                                      seed + i, check, results))
+               for i in xrange(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if len(results) != clients:
+        raise ValueError("some clients failed")
+
+    latencies = sorted(l for result in results for l in result[0])
+    return (latencies, sum(r[1] for r in results),
+            sum(r[2] for r in results), elapsed)
+
+def percentile(values, pct):
+    """
+    Returns the given percentile of a sorted list of values.
+    """
+    return values[min(len(values) - 1, len(values) * pct / 100)]
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP server range '
+                                                 'requests benchmark.')
+    parser.add_argument('-i', '--image',
+                        help='disc image to use instead of a synthetic one')
+    parser.add_argument('-n', '--files', type=int, default=200,
+                        help='number of files of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024,
+                        metavar='BYTES',
+                        help='maximum file size of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('-c', '--clients', default='1,4,16',
+                        help='comma separated numbers of parallel clients '
+                             '(default: %(default)s)')
+    parser.add_argument('-r', '--requests', type=int, default=200,
+                        help='number of requests per client '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--range-size', type=int, default=64 * 1024,
+                        metavar='BYTES',
+                        help='size of the requested ranges '
+                             '(default: %(default)s)')
+    parser.add_argument('-m', '--cache-size', type=int, metavar='MB',
+                        default=cache.DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='decrypted clusters cache size, in MB '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    server_proc = None
+    try:
+        image_path = args.image
+        if image_path is None:
+            tmp_dir = tempfile.mkdtemp()
+            image_path = os.path.join(tmp_dir, 'synthetic.iso')
+            tree = synth.random_tree(args.files, max_size=args.max_size,
+                                     seed=args.seed)
+            tree = sorted(tree + [(EMPTY_PATH, 0)])
+            synth.build_image(image_path, tree, seed=args.seed)
+
+        fs_obj = open_filesystem(image_path, args.cache_size * 1024 * 1024)
+        files = [(fs_obj.inode_path(ino), fs_obj.inode_size(ino),
+                  fs_obj.inode_offset(ino))
+                 for ino in xrange(fs_obj.inode_count)
+                 if not fs_obj.inode_isdir(ino) and fs_obj.inode_size(ino)]
+
+        # The listening socket is created before the fork: its port is
+        # known and the clients can connect as soon as it exists
+        server = httpd.HTTPServer(fs_obj, ('127.0.0.1', 0))
+        port = server.server_address[1]
+        server_proc = multiprocessing.Process(target=server.serve_forever)
+        server_proc.start()
+        server.socket.close()
+
+        if args.image is None:
+            try:
+                checked = check_ranges(port, files)
+            except CheckError as e:
+                print '%s: FAILED: %s' % (sys.argv[0], e)
+                sys.exit(1)
+            print 'check:   %d range requests OK' % checked
+
+        print 'image:   %d files, %d bytes ranges' % (len(files),
+                                                      args.range_size)
+        for clients in map(int, args.clients.split(',')):
+            latencies, received, connections, elapsed = run(
+                port, files, clients, args.requests, args.range_size,
+                args.seed, args.image is None)
+            print '%3d clients: %8.2f MB/s  %7.0f req/s  %s  %d conn' % (
+                clients, received / 1048576.0 / max(elapsed, 1e-6),
+                len(latencies) / max(elapsed, 1e-6),
+                '  '.join('p%d %6.2f ms' % (pct,
+                                            percentile(latencies, pct) * 1e3)
+                          for pct in PERCENTILES),
+                connections)
+    finally:
+        if server_proc is not None:
+            server_proc.terminate()
+            server_proc.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
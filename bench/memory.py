@@ -0,0 +1,172 @@
+#! /usr/bin/python2
+"""
+bench/memory.py
+~~~~~~~~~~~~~~~
+
+Measures the peak memory used to copy the largest file of a disc image (or
+of a synthetic image holding one large file, see wiiod.synth) with the
+streaming API (_File.copy_to) under every cache policy, then with a single
+read() call. Exits with an error if a streaming copy grows the peak memory
+usage by more than the given limit, or if the clusters cache ever holds more
+than its byte budget.
+
+Each measurement runs in its own process, since the peak resident set size
+of a process can only grow.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, partition, synth, wiiodfs
+
+def largest_file(fs_obj):
+    """
+    Returns the inode of the largest file of a wiiod.wiiodfs.Filesystem.
+    """
+    files = [ino for ino in xrange(fs_obj.inode_count)
+             if not fs_obj.inode_isdir(ino)]
+    return max(files, key=fs_obj.inode_size)
+
+def measure(args):
+    """
+    Copies the largest file of the image to /dev/null with a clusters cache
+    of the given policy and byte budget. Returns the peak memory growth (in
+    kB), the size of the file, the elapsed time and the largest size of
+    the cache during the copy.
+    """
+    image_path, streaming, policy, cache_size = args
+
+    # Pages of a memory-mapped image would be counted in the resident set
+    disc_obj = disc.open_disc(image_path, 'file')
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+
+    # Keep the clusters cache small: only the copy itself is measured. Its
+    # size is checked after every insertion.
+    cluster_cache = cache.new_cache(policy, cache_size)
+    cache_peak = [0]
+    put = cluster_cache.put
+    def checked_put(key, value):
+        put(key, value)
+        cache_peak[0] = max(cache_peak[0], cluster_cache.size)
+    cluster_cache.put = checked_put
+
+    part = partition.Partition(disc_obj, infos, cluster_cache)
+    fs_obj = wiiodfs.Filesystem(part)
+    ino = largest_file(fs_obj)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with open(os.devnull, 'wb') as out:
+        fp = fs_obj.open_inode(ino)
+        if streaming:
+            fp.copy_to(out)
+        else:
+            out.write(fp.read())
+        fp.close()
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    disc_obj.close()
+    return after - before, fs_obj.inode_size(ino), elapsed, cache_peak[0]
+
+def build_image(args):
+    """
+    Builds a synthetic image holding one file of the given size.
+    """
+    image_path, size = args
+    synth.build_image(image_path, [('/large.bin', size)])
+
+def in_process(func, args):
+    """
+    Runs a function in a new process. The peak resident set size of the
+    process is inherited by its children, so the measurements are done in
+    processes forked from a process which did not build the image.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, (args,))
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='File copy memory benchmark.')
+    parser.add_argument('image', nargs='?',
+                        help='path to the disc image (default: a synthetic '
+                             'image with one large file)')
+    parser.add_argument('-s', '--size', type=int, default=64, metavar='MB',
+                        help='size of the file of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('-c', '--cache-size', type=float, default=1,
+                        metavar='MB',
+                        help='byte budget of the clusters cache, in MB '
+                             '(default: %(default)s)')
+    parser.add_argument('-l', '--limit', type=float, default=16,
+                        help='maximum peak memory growth of the streaming '
+                             'copy, in MB (default: %(default)s)')
+    args = parser.parse_args()
+
+    cache_size = int(args.cache_size * 1024 * 1024)
+    tmp_dir = None
+    try:
+        image_path = args.image
+        if image_path is None:
+            tmp_dir = tempfile.mkdtemp()
+            image_path = os.path.join(tmp_dir, 'synthetic.iso')
+            in_process(build_image, (image_path, args.size * 1024 * 1024))
+
+        results = [('copy_to (%s)' % policy,
+                    in_process(measure, (image_path, True, policy,
+                                                cache_size)))
+                   for policy in cache.POLICIES]
+        results.append(('read (lru)',
+                        in_process(measure, (image_path, False, 'lru',
+                                             cache_size))))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    size = results[0][1][1] / 1048576.0
+    print 'largest file: %8.1f MB' % size
+    failed = False
+    for name, (growth, _, elapsed, cache_peak) in results:
+        print '%-16s  %8.1f MB peak growth, %8.2f MB/s, %6.2f MB cache' % (
+            name + ':', growth / 1024.0, size / max(elapsed, 1e-6),
+            cache_peak / 1048576.0)
+
+        if cache_peak > cache_size:
+            print 'FAILED: %s: cache above its %.2f MB budget' % (
+                name, cache_size / 1048576.0)
+            failed = True
+        if name.startswith('copy_to') and growth / 1024.0 > args.limit:
+            print 'FAILED: %s: streaming copy above the %.1f MB limit' % (
+                name, args.limit)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
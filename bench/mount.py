@@ -0,0 +1,123 @@
+#! /usr/bin/python2
+"""
+bench/mount.py
+~~~~~~~~~~~~~~
+
+Measures the time needed to parse the filesystem of a disc image partition,
+comparing the current FST loader with the original recursive parser.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import disc, partition, wiiodfs
+
+class RecursiveFilesystem(wiiodfs.Filesystem):
+    """
+    The original FST parser: one read per descriptor and per filename, one
+    recursion level per directory.
+    """
+
+    def _build_tree(self):
+        fst_offset_string = self.part.read(wiiodfs.FST_OFFSET_POS, 4)
+        self.fst_offset = struct.unpack('>L', fst_offset_string)[0] * 4
+
+        descr_count_string = self.part.read(self.fst_offset, 12)
+        self.str_offset = self.fst_offset
+        self.str_offset += struct.unpack('>8xL', descr_count_string)[0] * 12
+
+        _, _, self.tree = self._parse_descriptor(0)
+
+    def _parse_descriptor(self, idx):
+        descr_string = self.part.read(self.fst_offset + 12 * idx, 12)
+        (name_off, data_off, size) = struct.unpack('>LLL', descr_string)
+
+        data_off *= 4
+
+        is_dir = bool(name_off & 0xFF000000)
+        name = self._read_filename(name_off & ~0xFF000000) if idx else ''
+
+        if is_dir:
+            children = {}
+            idx += 1
+            while idx < size:
+                idx, child_name, child_data = self._parse_descriptor(idx)
+                children[child_name] = child_data
+            return idx, name, children
+        else:
+            return idx + 1, name, (data_off, size)
+
+    def _read_filename(self, offset):
+        string = self.part.read(self.str_offset + offset, 256)
+        return string[:string.index('\0')]
+
+def bench(fs_class, image_path, runs, **kwargs):
+    """
+    Returns the best time (in seconds) needed to build a fs_class object over
+    the first game partition of the image, passing it the keyword arguments.
+    A new Partition is created for every run so that clusters are decrypted
+    again.
+    """
+    best = None
+    for i in xrange(runs):
+        disc_obj = disc.Disc(open(image_path, 'rb'))
+        infos = [p for p in disc_obj.partitions if p.type == 0][0]
+        part = partition.Partition(disc_obj, infos)
+
+        start = time.time()
+        fs_class(part, **kwargs)
+        elapsed = time.time() - start
+
+        disc_obj.fp.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    if len(sys.argv) < 2:
+        print 'usage: %s <image> [runs]' % sys.argv[0]
+        sys.exit(1)
+
+    image_path = sys.argv[1]
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    old = bench(RecursiveFilesystem, image_path, runs)
+    new = bench(wiiodfs.Filesystem, image_path, runs)
+
+    # The first run writes the sidecar index, the following ones load it
+    index_dir = tempfile.mkdtemp()
+    try:
+        bench(wiiodfs.Filesystem, image_path, 1, index_dir=index_dir)
+        index = bench(wiiodfs.Filesystem, image_path, runs,
+                      index_dir=index_dir)
+    finally:
+        shutil.rmtree(index_dir)
+
+    print 'recursive parser: %8.2f ms' % (old * 1000)
+    print 'bulk parser:      %8.2f ms' % (new * 1000)
+    print 'sidecar index:    %8.2f ms' % (index * 1000)
+    print 'speedup:          %8.2fx (bulk), %.2fx (index)' % (old / new,
+                                                           old / index)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#! /usr/bin/python2
+"""
+bench/read_throughput.py
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures the sequential decrypted read throughput of a disc image partition
+using the original string concatenation read path, Partition.read and
+Partition.readinto with a reused buffer. Use --warm to measure the copying
+overhead alone, without any decryption.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, partition
+from wiiod.partition import CLUSTER_SIZE, CLUSTER_DATA_SIZE
+
+class ConcatPartition(partition.Partition):
+    """
+    Partition using the original read implementation, concatenating the
+    cluster slices into a string.
+    """
+
+    def read(self, offset, size):
+        data = ''
+        while size > 0:
+            cluster_data = self.read_cluster(offset / CLUSTER_DATA_SIZE)
+
+            start_off = offset % CLUSTER_DATA_SIZE
+            last_off = min(start_off + size, CLUSTER_DATA_SIZE)
+            read_size = last_off - start_off
+
+            data += cluster_data[start_off:last_off]
+
+            offset += read_size
+            size -= read_size
+        return data
+
+def open_partition(image_path, part_class, cache_size):
+    disc_obj = disc.Disc(open(image_path, 'rb'))
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    return part_class(disc_obj, infos, cache.LRUCache(cache_size))
+
+def bench_read(part, total, chunk):
+    offset = 0
+    while offset < total:
+        part.read(offset, min(chunk, total - offset))
+        offset += chunk
+
+def bench_readinto(part, total, chunk):
+    buf = bytearray(chunk)
+    view = memoryview(buf)
+    offset = 0
+    while offset < total:
+        size = min(chunk, total - offset)
+        part.readinto(offset, view[:size])
+        offset += chunk
+
+MODES = [
+    ('concat read', ConcatPartition, bench_read),
+    ('read', partition.Partition, bench_read),
+    ('readinto', partition.Partition, bench_readinto),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Sequential read benchmark.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('-s', '--size', type=int, default=1024, metavar='MB',
+                        help='amount of data to read (default: %(default)s)')
+    parser.add_argument('-b', '--chunk', type=int, default=1024, metavar='KB',
+                        help='size of each read (default: %(default)s)')
+    parser.add_argument('-w', '--warm', action='store_true',
+                        help='read everything once with a cache large enough '
+                             'to hold it before measuring (no decryption)')
+    args = parser.parse_args()
+
+    chunk = args.chunk * 1024
+    for name, part_class, func in MODES:
+        total = args.size * 1024 * 1024
+        cache_size = 2 * total if args.warm else cache.DEFAULT_CACHE_SIZE
+        part = open_partition(args.image, part_class, cache_size)
+        data_size = part.data_size / CLUSTER_SIZE * CLUSTER_DATA_SIZE
+        total = min(total, data_size)
+
+        if args.warm:
+            func(part, total, chunk)
+
+        start = time.time()
+        func(part, total, chunk)
+        elapsed = time.time() - start
+
+        print '%-12s %8.2f MB/s (%d MB in %.2f s)' % (
+            name, total / elapsed / 1024 / 1024, total / 1024 / 1024,
+            elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#! /usr/bin/python2
+"""
+bench/scrub.py
+~~~~~~~~~~~~~~
+
+Checks the used clusters map and the scrubbed images (see wiiod.scrub) on a
+synthetic disc image: the map must hold exactly the clusters of the
+apploader, the DOL sections, the FST and the files, and the scrubbed copy
+must keep these clusters and zero all the others. The decrypted export
+with scrubbing (see wiiod.export) must hold the used clusters in clear and
+zeros elsewhere. Exits with a non-zero status on the first mismatch.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, export, partition, scrub, synth, wiiodfs
+from wiiod.partition import CLUSTER_DATA_SIZE, CLUSTER_SIZE
+
+class CheckError(Exception):
+    pass
+
+def expected_runs(fs_obj, files):
+    """
+    Returns the (first cluster, number of clusters) runs which should be
+    used in a synthetic image, computed from its layout instead of its
+    system area.
+    """
+    apploader_end = (synth.APPLOADER_OFFSET + synth.APPLOADER_HEADER.size +
+                     synth.APPLOADER_SIZE + synth.APPLOADER_TRAILER_SIZE)
+    areas = [(0, apploader_end), (synth.DOL_OFFSET, synth.dol_size()),
+             (synth.FST_OFFSET, fs_obj.fst_size)]
+    areas.extend((f.offset, f.size) for f in files)
+
+    used = set()
+    for offset, size in areas:
+        if size:
+            used.update(xrange(offset / CLUSTER_DATA_SIZE,
+                               (offset + size - 1) / CLUSTER_DATA_SIZE + 1))
+
+    runs = []
+    for idx in sorted(used):
+        if runs and runs[-1][0] + runs[-1][1] == idx:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((idx, 1))
+    return runs
+
+def check_map(image_path, files):
+    """
+    Checks the used clusters map of the image. Returns the map.
+    """
+    disc_obj = disc.open_disc(image_path)
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(0))
+    fs_obj = wiiodfs.Filesystem(part)
+
+    cluster_map = scrub.ClusterMap.for_filesystem(fs_obj)
+    runs = list(cluster_map.runs())
+    expected = expected_runs(fs_obj, files)
+    disc_obj.close()
+
+    if runs != expected:
+        raise CheckError('used runs %r, expected %r' % (runs, expected))
+    if cluster_map.used_count() == cluster_map.clusters:
+        raise CheckError('no unused cluster in the image')
+    return cluster_map
+
+def check_scrubbed(image_path, scrubbed_path):
+    """
+    Checks that a scrubbed copy keeps the used ranges of the image and only
+    holds zeros elsewhere. Returns the number of bytes zeroed.
+    """
+    with open(image_path, 'rb') as fp:
+        original = fp.read()
+    with open(scrubbed_path, 'rb') as fp:
+        scrubbed = fp.read()
+    if len(scrubbed) != len(original):
+        raise CheckError('scrubbed image is %d bytes, expected %d' % (
+            len(scrubbed), len(original)))
+
+    disc_obj = disc.open_disc(image_path)
+    ranges = list(scrub.used_ranges(disc_obj))
+    disc_obj.close()
+
+    zeroed = 0
+    pos = 0
+    for offset, size in ranges + [(len(original), 0)]:
+        if scrubbed[pos:offset].count('\0') != offset - pos:
+            raise CheckError('unused data kept between %#x and %#x' % (
+                pos, offset))
+        if original[pos:offset].count('\0') != offset - pos:
+            zeroed += offset - pos
+        if scrubbed[offset:offset + size] != original[offset:offset + size]:
+            raise CheckError('used data changed between %#x and %#x' % (
+                offset, offset + size))
+        pos = offset + size
+    if not zeroed:
+        raise CheckError('nothing was scrubbed')
+    return zeroed
+
+def check_export(image_path, exported_path, cluster_map):
+    """
+    Checks that a scrubbed export holds zeros in the unused clusters and
+    the same decrypted data as the image in the used ones. Returns the
+    number of clusters zeroed.
+    """
+    disc_obj = disc.open_disc(image_path)
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(0))
+    exported_disc = disc.open_disc(exported_path)
+    exported = partition.Partition(exported_disc,
+                                   [p for p in exported_disc.partitions
+                                    if p.type == 0][0], cache.LRUCache(0))
+
+    start = infos.offset + part.data_start
+    zeroed = 0
+    try:
+        for idx in xrange(cluster_map.clusters):
+            if idx in cluster_map:
+                offset = idx * CLUSTER_DATA_SIZE
+                if (exported.read(offset, CLUSTER_DATA_SIZE) !=
+                        part.read(offset, CLUSTER_DATA_SIZE)):
+                    raise CheckError('wrong data in exported cluster %d' %
+                                     idx)
+            else:
+                raw = exported_disc.read(start + idx * CLUSTER_SIZE,
+                                         CLUSTER_SIZE)
+                if raw.count('\0') != len(raw):
+                    raise CheckError('unused cluster %d was exported' % idx)
+                zeroed += 1
+    finally:
+        exported_disc.close()
+        disc_obj.close()
+    if not zeroed:
+        raise CheckError('no cluster was scrubbed from the export')
+    return zeroed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Used clusters map and scrubbed images check.')
+    parser.add_argument('-n', '--files', type=int, default=50,
+                        help='number of files of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=64 * 1024,
+                        metavar='BYTES',
+                        help='maximum file size of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_path = os.path.join(tmp_dir, 'synthetic.iso')
+        files = synth.build_image(image_path, synth.random_tree(
+            args.files, max_size=args.max_size, seed=args.seed),
+            seed=args.seed)
+
+        cluster_map = check_map(image_path, files)
+        print 'map:       %d of %d clusters used, runs %r' % (
+            cluster_map.used_count(), cluster_map.clusters,
+            list(cluster_map.runs()))
+
+        scrubbed_path = os.path.join(tmp_dir, 'scrubbed.iso')
+        scrub.write_scrubbed(image_path, scrubbed_path)
+        print 'scrubbed:  %.1f kB zeroed' % (
+            check_scrubbed(image_path, scrubbed_path) / 1024.0)
+
+        exported_path = os.path.join(tmp_dir, 'exported.iso')
+        export.export(image_path, exported_path, scrub_unused=True)
+        print 'exported:  %d clusters zeroed' % check_export(
+            image_path, exported_path, cluster_map)
+    except CheckError as e:
+        print '%s: FAILED: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
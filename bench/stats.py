@@ -0,0 +1,109 @@
+#! /usr/bin/python2
+"""
+bench/stats.py
+~~~~~~~~~~~~~~
+
+Measures the overhead of the runtime statistics (wiiod.stats): cost of a
+call to an empty timed function with the collection enabled and disabled,
+and time of 4 KB reads served from the clusters cache (the cheapest
+instrumented path) in both modes. Both modes are measured alternately
+several times and the best times are kept, to limit the noise.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, partition, stats, wiiodfs
+
+def empty():
+    pass
+
+timed_empty = stats.timed('bench.empty')(empty)
+
+def bench_calls(func, calls):
+    """
+    Returns the average time of a call to func, in seconds.
+    """
+    start = time.time()
+    for i in xrange(calls):
+        func()
+    return (time.time() - start) / calls
+
+def bench_reads(fs_obj, files, reads):
+    """
+    Returns the average time of a 4 KB read at a random offset of a random
+    file, in seconds.
+    """
+    rand = random.Random(42)
+    start = time.time()
+    for i in xrange(reads):
+        ino = rand.choice(files)
+        fp = fs_obj.open_inode(ino)
+        fp.seek(rand.randrange(fs_obj.inode_size(ino)))
+        fp.read(4096)
+    return (time.time() - start) / reads
+
+def main():
+    parser = argparse.ArgumentParser(description='Statistics overhead '
+                                                 'benchmark.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('-n', '--reads', type=int, default=20000,
+                        help='number of reads and calls per round (default: '
+                             '%(default)s)')
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help='number of rounds (default: %(default)s)')
+    args = parser.parse_args()
+
+    disc_obj = disc.open_disc(args.image)
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(1 << 40))
+    fs_obj = wiiodfs.Filesystem(part)
+    files = [ino for ino in xrange(fs_obj.inode_count)
+             if not fs_obj.inode_isdir(ino) and fs_obj.inode_size(ino)]
+
+    # Decrypt everything beforehand: only cache hits are measured
+    for ino in files:
+        fs_obj.open_inode(ino).read()
+
+    base = min(bench_calls(empty, args.reads) for i in xrange(args.rounds))
+    results = {}
+    for i in xrange(args.rounds):
+        for enabled in (False, True):
+            stats.set_enabled(enabled)
+            times = (bench_calls(timed_empty, args.reads),
+                     bench_reads(fs_obj, files, args.reads))
+            if enabled in results:
+                times = tuple(map(min, results[enabled], times))
+            results[enabled] = times
+
+    print 'plain call:            %8.3f us' % (base * 1e6)
+    for enabled in (False, True):
+        call, read = results[enabled]
+        print 'stats %-3s: call %8.3f us (+%.3f us)  4 KB read %8.2f us' % (
+            'on' if enabled else 'off', call * 1e6, (call - base) * 1e6,
+            read * 1e6)
+    print 'read overhead:         %8.1f %%' % (
+        (results[True][1] / results[False][1] - 1) * 100)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#! /usr/bin/python2
+"""
+bench/suite.py
+~~~~~~~~~~~~~~
+
+Benchmark suite running on a synthetic disc image (see wiiod.synth), or on a
+given image. Measures the time needed to open the disc and parse its
+filesystem, the sequential read throughput over all the files, the latency
+percentiles of random 4 KB reads and the peak memory growth of each of these
+steps.
+
+Each step runs in its own process, so that every step starts with cold
+caches and gets its own peak resident set size. Files of synthetic images
+are checked against their expected content before the measurements.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wiiod import cache, disc, partition, synth, wiiodfs
+
+# Size of the random reads and latency percentiles reported
+RANDOM_READ_SIZE = 4096
+PERCENTILES = (50, 90, 99)
+
+# Size of the data checked at the start and at the end of each file
+CHECK_SIZE = 64 * 1024
+
+def open_filesystem(image_path, cache_size):
+    """
+    Opens the first game partition of an image and returns its
+    wiiod.wiiodfs.Filesystem.
+    """
+    disc_obj = disc.open_disc(image_path, 'file')
+    infos = [p for p in disc_obj.partitions if p.type == 0][0]
+    part = partition.Partition(disc_obj, infos, cache.LRUCache(cache_size))
+    return wiiodfs.Filesystem(part)
+
+def list_files(fs_obj):
+    """
+    Returns the inodes of the non-empty files, sorted by data offset.
+    """
+    files = [ino for ino in xrange(fs_obj.inode_count)
+             if not fs_obj.inode_isdir(ino) and fs_obj.inode_size(ino)]
+    return sorted(files, key=fs_obj.inode_offset)
+
+def step_check(fs_obj, args):
+    """
+    Checks the start and the end of every file against the content of
+    synthetic images. Returns the number of files checked.
+    """
+    files = list_files(fs_obj)
+    for ino in files:
+        offset = fs_obj.inode_offset(ino)
+        size = fs_obj.inode_size(ino)
+        for start in (0, max(size - CHECK_SIZE, 0)):
+            length = min(CHECK_SIZE, size - start)
+            data = fs_obj.inode_read(ino, start, length)
+            if data != synth.pattern(offset + start, length):
+                raise ValueError("wrong content in %s at %d" % (
+                    fs_obj.inode_path(ino), start))
+    return len(files)
+
+def step_mount(fs_obj, args):
+    """
+    Returns the best time needed to open the image and parse its
+    filesystem.
+    """
+    image_path, cache_size, runs = args
+    fs_obj.disc.close()
+
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        fs_obj = open_filesystem(image_path, cache_size)
+        elapsed = time.time() - start
+        fs_obj.disc.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def step_sequential(fs_obj, args):
+    """
+    Copies every file to /dev/null in disc order. Returns the number of
+    bytes copied and the elapsed time.
+    """
+    total = 0
+    start = time.time()
+    with open(os.devnull, 'wb') as out:
+        for ino in list_files(fs_obj):
+            fp = fs_obj.open_inode(ino)
+            fp.copy_to(out)
+            fp.close()
+            total += fs_obj.inode_size(ino)
+    return total, time.time() - start
+
+def step_random(fs_obj, args):
+    """
+    Reads 4 KB at random offsets of random files. Returns the sorted list of
+    the latencies, in seconds.
+    """
+    reads, seed = args
+    files = list_files(fs_obj)
+    rand = random.Random(seed)
+
+    latencies = []
+    for i in xrange(reads):
+        ino = rand.choice(files)
+        offset = rand.randrange(fs_obj.inode_size(ino))
+        start = time.time()
+        fs_obj.inode_read(ino, offset, RANDOM_READ_SIZE)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+def run_step(args):
+    """
+    Runs a step on a new filesystem object and returns its result and the
+    peak memory growth of the process (in kB).
+    """
+    step, image_path, cache_size, step_args = args
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fs_obj = open_filesystem(image_path, cache_size)
+    result = step(fs_obj, step_args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result, after - before
+
+def in_process(step, image_path, cache_size, step_args=None):
+    """
+    Runs a step in a new process (see run_step).
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_step, ((step, image_path, cache_size,
+                                      step_args),))
+    finally:
+        pool.close()
+        pool.join()
+
+def percentile(values, pct):
+    """
+    Returns the given percentile of a sorted list of values.
+    """
+    return values[min(len(values) - 1, len(values) * pct / 100)]
+
+def main():
+    parser = argparse.ArgumentParser(description='wiiod benchmark suite.')
+    parser.add_argument('-i', '--image',
+                        help='disc image to use instead of a synthetic one')
+    parser.add_argument('-n', '--files', type=int, default=1000,
+                        help='number of files of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('-d', '--depth', type=int, default=4,
+                        help='maximum directory depth of the synthetic '
+                             'image (default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024,
+                        metavar='BYTES',
+                        help='maximum file size of the synthetic image '
+                             '(default: %(default)s)')
+    parser.add_argument('-D', '--decrypted', action='store_true',
+                        help='build a synthetic image with the encryption '
+                             'disabled')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-r', '--reads', type=int, default=2000,
+                        help='number of random reads (default: %(default)s)')
+    parser.add_argument('-c', '--cache-size', type=int, metavar='MB',
+                        default=cache.DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='decrypted clusters cache size, in MB '
+                             '(default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of runs of the mount step '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    cache_size = args.cache_size * 1024 * 1024
+    tmp_dir = None
+    try:
+        image_path = args.image
+        if image_path is None:
+            tmp_dir = tempfile.mkdtemp()
+            image_path = os.path.join(tmp_dir, 'synthetic.iso')
+            tree = synth.random_tree(args.files, args.depth,
+                                     max_size=args.max_size, seed=args.seed)
+
+            start = time.time()
+            synth.build_image(image_path, tree, not args.decrypted,
+                              seed=args.seed)
+            print 'image:       %d files, %.1f MB built in %.2f s' % (
+                len(tree), os.path.getsize(image_path) / 1048576.0,
+                time.time() - start)
+
+            checked, _ = in_process(step_check, image_path, cache_size)
+            print 'check:       %d files OK' % checked
+
+        mount, mount_mem = in_process(step_mount, image_path, cache_size,
+                                      (image_path, cache_size, args.runs))
+        print 'mount:       %8.2f ms            %8.1f MB peak growth' % (
+            mount * 1000, mount_mem / 1024.0)
+
+        (total, elapsed), seq_mem = in_process(step_sequential, image_path,
+                                               cache_size)
+        print 'sequential:  %8.2f MB/s          %8.1f MB peak growth' % (
+            total / 1048576.0 / max(elapsed, 1e-6), seq_mem / 1024.0)
+
+        latencies, rand_mem = in_process(step_random, image_path, cache_size,
+                                         (args.reads, args.seed))
+        print 'random 4K:   %s  max %.0f us  %8.1f MB peak growth' % (
+            '  '.join('p%d %.0f us' % (pct, percentile(latencies, pct) * 1e6)
+                      for pct in PERCENTILES),
+            latencies[-1] * 1e6, rand_mem / 1024.0)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -28,10 +28,21 @@ setup(
 
     packages=find_packages(),
     entry_points={
-        'console_scripts': ['wiiodmount = wiiod.entry:main']
+        'console_scripts': [
+            'wiiodmount = wiiod.entry:main',
+            'wiiodextract = wiiod.extract:main',
+            'wiiodverify = wiiod.verify:main',
+            'wiiodexport = wiiod.export:main',
+            'wiiodscrub = wiiod.scrub:main',
+            'wiiodcatalog = wiiod.catalog:main',
+            'wiiodhttpd = wiiod.httpd:main',
+        ]
     },
 
     install_requires=["fs", "pycrypto"],
+    extras_require={
+        'native': ["fusepy"],
+    },
 
     author="Pierre Bourdon",
     author_email="delroth@gmail.com",
@@ -0,0 +1,360 @@
+"""
+wiiod.cache
+~~~~~~~~~~~
+
+Caches for decrypted partition clusters. A cache is bounded by a byte budget
+and can be shared by several partitions, each partition using its own keys.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+
+# Default memory budget for decrypted clusters (a bit more than 128 clusters)
+DEFAULT_CACHE_SIZE = 4 * 1024 * 1024
+
+class ClusterCache(object):
+    """
+    Base class of the decrypted clusters caches. Caches are bounded by the
+    total size of the cached values and keep usage statistics. Subclasses
+    implement the replacement policy.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        """
+        Creates an empty cache which will hold at most max_bytes bytes of
+        data.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Returns the value cached for key, or None if it is not cached.
+        """
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key, value):
+        """
+        Adds a value to the cache, evicting other values if the byte budget
+        is exceeded.
+        """
+        with self._lock:
+            self._put(key, value)
+
+    def clear(self):
+        """
+        Removes all the values from the cache. Statistics are kept.
+        """
+        with self._lock:
+            self._clear()
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _put(self, key, value):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache usage statistics.
+        """
+        return {
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'size': self.size,
+            'max_size': self.max_bytes,
+        }
+
+class LRUCache(ClusterCache):
+    """
+    Least recently used replacement policy.
+    """
+
+    policy = 'lru'
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        super(LRUCache, self).__init__(max_bytes)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+        self._entries[key] = value
+        self.size += len(value)
+
+        while self.size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def _clear(self):
+        self._entries.clear()
+        self.size = 0
+
+class TwoQueueCache(ClusterCache):
+    """
+    2Q replacement policy (Johnson & Shasha). New values go to a FIFO queue
+    and are only promoted to the main LRU queue when they are accessed again
+    after leaving it, so a single sequential scan cannot flush the main queue.
+    """
+
+    policy = '2q'
+
+    # Share of the budget used by the FIFO queue, and size of the history of
+    # keys recently evicted from it (relative to the budget)
+    IN_RATIO = 0.25
+    OUT_RATIO = 0.5
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        super(TwoQueueCache, self).__init__(max_bytes)
+        self._in = collections.OrderedDict()
+        self._main = collections.OrderedDict()
+        self._out = collections.OrderedDict()
+        self._in_size = 0
+        self._out_size = 0
+
+    def __len__(self):
+        return len(self._in) + len(self._main)
+
+    def __contains__(self, key):
+        return key in self._main or key in self._in
+
+    def _get(self, key):
+        try:
+            value = self._main.pop(key)
+            self._main[key] = value
+        except KeyError:
+            value = self._in.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        size = len(value)
+        if key in self._main:
+            self.size += size - len(self._main.pop(key))
+            self._main[key] = value
+        elif key in self._in:
+            old_size = len(self._in[key])
+            self._in[key] = value
+            self._in_size += size - old_size
+            self.size += size - old_size
+        elif key in self._out:
+            self._out_size -= self._out.pop(key)
+            self._main[key] = value
+            self.size += size
+        else:
+            self._in[key] = value
+            self._in_size += size
+            self.size += size
+
+        self._reclaim()
+
+    def _clear(self):
+        self._in.clear()
+        self._main.clear()
+        self._out.clear()
+        self._in_size = 0
+        self._out_size = 0
+        self.size = 0
+
+    def _reclaim(self):
+        """
+        Evicts values until the cache fits in its budget. Keys evicted from
+        the FIFO queue are remembered in the history queue.
+        """
+        max_in = self.max_bytes * self.IN_RATIO
+        while self.size > self.max_bytes and (self._in or self._main):
+            if self._in and (self._in_size > max_in or not self._main):
+                key, value = self._in.popitem(last=False)
+                self._in_size -= len(value)
+                self._out[key] = len(value)
+                self._out_size += len(value)
+            else:
+                _, value = self._main.popitem(last=False)
+            self.size -= len(value)
+            self.evictions += 1
+
+        max_out = self.max_bytes * self.OUT_RATIO
+        while self._out_size > max_out:
+            self._out_size -= self._out.popitem(last=False)[1]
+
+class ARCCache(ClusterCache):
+    """
+    Adaptive Replacement Cache policy (Megiddo & Modha), with sizes counted
+    in bytes. Values seen once and values seen several times live in two LRU
+    lists whose target sizes adapt using the history of recent evictions.
+    """
+
+    policy = 'arc'
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        super(ARCCache, self).__init__(max_bytes)
+
+        # Resident lists (key -> value) and ghost lists (key -> size)
+        self._t1 = collections.OrderedDict()
+        self._t2 = collections.OrderedDict()
+        self._b1 = collections.OrderedDict()
+        self._b2 = collections.OrderedDict()
+        self._t1_size = 0
+        self._b1_size = 0
+        self._b2_size = 0
+
+        # Target size of the T1 list
+        self._p = 0
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
+    def __contains__(self, key):
+        return key in self._t1 or key in self._t2
+
+    def _get(self, key):
+        try:
+            value = self._t2.pop(key)
+        except KeyError:
+            try:
+                value = self._t1.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._t1_size -= len(value)
+
+        self._t2[key] = value
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        size = len(value)
+        from_b2 = False
+        if key in self._t1:
+            old_size = len(self._t1[key])
+            self._t1[key] = value
+            self._t1_size += size - old_size
+            self.size += size - old_size
+        elif key in self._t2:
+            self.size += size - len(self._t2[key])
+            self._t2[key] = value
+        elif key in self._b1:
+            ratio = max(self._b2_size // max(self._b1_size, 1), 1)
+            self._p = min(self.max_bytes, self._p + ratio * size)
+            self._b1_size -= self._b1.pop(key)
+            self._t2[key] = value
+            self.size += size
+        elif key in self._b2:
+            ratio = max(self._b1_size // max(self._b2_size, 1), 1)
+            self._p = max(0, self._p - ratio * size)
+            self._b2_size -= self._b2.pop(key)
+            self._t2[key] = value
+            self.size += size
+            from_b2 = True
+        else:
+            self._t1[key] = value
+            self._t1_size += size
+            self.size += size
+
+        self._replace(from_b2)
+
+    def _clear(self):
+        for lst in (self._t1, self._t2, self._b1, self._b2):
+            lst.clear()
+        self._t1_size = self._b1_size = self._b2_size = 0
+        self._p = 0
+        self.size = 0
+
+    def _replace(self, from_b2):
+        """
+        Evicts values to the ghost lists until the cache fits in its budget,
+        then trims the ghost lists.
+        """
+        while self.size > self.max_bytes and (self._t1 or self._t2):
+            if self._t1 and (self._t1_size > self._p or not self._t2 or
+                             (from_b2 and self._t1_size == self._p)):
+                key, value = self._t1.popitem(last=False)
+                self._t1_size -= len(value)
+                self._b1[key] = len(value)
+                self._b1_size += len(value)
+            else:
+                key, value = self._t2.popitem(last=False)
+                self._b2[key] = len(value)
+                self._b2_size += len(value)
+            self.size -= len(value)
+            self.evictions += 1
+
+        while self._b1 and self._t1_size + self._b1_size > self.max_bytes:
+            self._b1_size -= self._b1.popitem(last=False)[1]
+        while self._b2 and (self.size + self._b1_size + self._b2_size >
+                            2 * self.max_bytes):
+            self._b2_size -= self._b2.popitem(last=False)[1]
+
+# Available replacement policies, by name
+POLICIES = collections.OrderedDict([
+    ('lru', LRUCache),
+    ('2q', TwoQueueCache),
+    ('arc', ARCCache),
+])
+
+def new_cache(policy='lru', max_bytes=DEFAULT_CACHE_SIZE):
+    """
+    Creates a cluster cache using the named replacement policy.
+    """
+    try:
+        cls = POLICIES[policy]
+    except KeyError:
+        raise ValueError("unknown cache policy: %s" % policy)
+    return cls(max_bytes)
@@ -0,0 +1,420 @@
+"""
+wiiod.catalog
+~~~~~~~~~~~~~
+
+Catalog of the files of a library of disc images, stored in a SQLite
+database: the metadata and the partitions of every image and the path, size
+and data offset of every file of their partitions. Files can then be found
+by name, path or size without opening any image.
+
+Images are scanned in parallel by a pool of worker processes. Updates only
+scan the images added or modified (by size or modification time) since the
+last update, and remove the images which disappeared.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import cache, crypto, disc, discfs, library, partition, wiiodfs
+
+import argparse
+import collections
+import multiprocessing
+import os
+import os.path
+import sqlite3
+import struct
+import sys
+import time
+
+# Version of the database schema: catalogs of another version are rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    error TEXT,
+    %s
+);
+CREATE TABLE partitions (
+    id INTEGER PRIMARY KEY,
+    image INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    volume_group INTEGER NOT NULL,
+    part_index INTEGER NOT NULL,
+    data_offset INTEGER NOT NULL,
+    part_type INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE files (
+    partition INTEGER NOT NULL REFERENCES partitions(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    data_offset INTEGER NOT NULL
+);
+CREATE INDEX partitions_image ON partitions(image);
+CREATE INDEX files_partition ON files(partition);
+CREATE INDEX files_path ON files(path);
+CREATE INDEX files_name ON files(name);
+CREATE INDEX files_size ON files(size);
+''' % ',\n    '.join(disc.Metadata._fields)
+
+# Image of the catalog: path, size and modification time (in ns) of the
+# image file, wiiod.disc.Metadata (None if the image could not be read),
+# list of wiiod.disc.PartitionInfos and scan error message (or None)
+Image = collections.namedtuple('Image', ' '.join((
+    'path',
+    'size',
+    'mtime',
+    'metadata',
+    'partitions',
+    'error'
+)))
+
+# File of the catalog: image path, partition name (see
+# wiiod.discfs.partition_name), absolute path in the partition, size and data
+# offset in the partition
+Entry = collections.namedtuple('Entry', ' '.join((
+    'image',
+    'partition',
+    'path',
+    'size',
+    'offset'
+)))
+
+# Characters making a pattern match several names
+GLOB_CHARS = '*?['
+
+def image_key(path):
+    """
+    Returns the (size, modification time in ns) of an image file, which
+    tells if the image changed since it was scanned.
+    """
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime * 1000000000)
+
+def scan_image(args):
+    """
+    Reads the metadata, the partitions and the files of an image. Returns
+    the path, size and modification time of the image, its metadata (or
+    None), a list of (wiiod.disc.PartitionInfos, error message or None,
+    files) tuples, each file being a (path, size, data offset) tuple, and an
+    error message (or None).
+    """
+    path, backend = args
+    try:
+        size, mtime = image_key(path)
+    except EnvironmentError as e:
+        return path, 0, 0, None, [], str(e)
+    try:
+        disc_obj = disc.open_disc(path, backend, 'random')
+    except (EnvironmentError, ValueError, struct.error) as e:
+        return path, size, mtime, None, [], str(e)
+
+    try:
+        parts = []
+        for infos in disc_obj.partitions:
+            # The FST clusters are read once
+            part = partition.Partition(disc_obj, infos, cache.LRUCache(0))
+            try:
+                fs_obj = wiiodfs.Filesystem(part)
+                files = [(fs_obj.inode_path(ino), fs_obj.inode_size(ino),
+                          fs_obj.inode_offset(ino))
+                         for ino in xrange(fs_obj.inode_count)
+                         if not fs_obj.inode_isdir(ino)]
+            except (EnvironmentError, ValueError, struct.error) as e:
+                parts.append((infos, str(e), []))
+            else:
+                parts.append((infos, None, files))
+        return path, size, mtime, disc_obj.metadata, parts, None
+    except (EnvironmentError, ValueError, struct.error) as e:
+        return path, size, mtime, None, [], str(e)
+    finally:
+        disc_obj.close()
+
+def _init_worker(aes_backend):
+    """
+    Selects the AES backend in a worker process.
+    """
+    crypto.set_default_backend(aes_backend)
+
+class Catalog(object):
+    """
+    Catalog of disc images stored in a SQLite database.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the catalog stored at path, creating it if needed. Catalogs
+        created by another version are emptied.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # File names are not always valid UTF-8
+        self.db.text_factory = str
+        self.db.execute('PRAGMA foreign_keys = ON')
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self.db:
+                for table in ('files', 'partitions', 'images'):
+                    self.db.execute('DROP TABLE IF EXISTS %s' % table)
+                self.db.executescript(SCHEMA)
+                self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, directories, processes=None, backend='auto',
+               progress=None, aes_backend=None):
+        """
+        Updates the catalog with the images of the given directories (see
+        wiiod.library.scan): new and modified images are scanned using the
+        given number of worker processes (by default, one per CPU), images
+        removed from these directories are removed from the catalog. Images
+        are opened with the given wiiod.disc backend and decrypted with the
+        named wiiod.crypto backend. progress is called with the path of each
+        image scanned. Returns the number of images scanned and removed.
+        """
+        known = dict(((path, (size, mtime))
+                      for path, size, mtime in self.db.execute(
+                          'SELECT path, size, mtime FROM images')))
+
+        present = set()
+        changed = []
+        for directory in directories:
+            for _, path in library.scan(directory):
+                path = os.path.abspath(path)
+                present.add(path)
+                try:
+                    key = image_key(path)
+                except EnvironmentError:
+                    key = None
+                if known.get(path) != key:
+                    changed.append(path)
+
+        dirs = set(os.path.abspath(d) for d in directories)
+        removed = [path for path in known
+                   if os.path.dirname(path) in dirs and path not in present]
+        with self.db:
+            self.db.executemany('DELETE FROM images WHERE path = ?',
+                                ((path,) for path in removed))
+
+        if not changed:
+            return 0, len(removed)
+
+        pool = multiprocessing.Pool(processes, _init_worker, (aes_backend,))
+        try:
+            jobs = [(path, backend) for path in changed]
+            for result in pool.imap_unordered(scan_image, jobs):
+                self._store(*result)
+                if progress is not None:
+                    progress(result[0])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return len(changed), len(removed)
+
+    def _store(self, path, size, mtime, metadata, parts, error):
+        """
+        Replaces the content of the catalog for an image (see scan_image).
+        """
+        if metadata is None:
+            metadata = (None,) * len(disc.Metadata._fields)
+        with self.db:
+            self.db.execute('DELETE FROM images WHERE path = ?', (path,))
+            image_id = self.db.execute(
+                'INSERT INTO images (path, size, mtime, error, %s) '
+                'VALUES (?, ?, ?, ?, %s)' % (
+                    ', '.join(disc.Metadata._fields),
+                    ', '.join('?' * len(disc.Metadata._fields))),
+                (path, size, mtime, error) + tuple(metadata)).lastrowid
+
+            for infos, part_error, files in parts:
+                part_id = self.db.execute(
+                    'INSERT INTO partitions (image, volume_group, part_index, '
+                    'data_offset, part_type, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (image_id, infos.volume_group, infos.index, infos.offset,
+                     infos.type, part_error)).lastrowid
+                self.db.executemany(
+                    'INSERT INTO files (partition, path, name, size, '
+                    'data_offset) VALUES (?, ?, ?, ?, ?)',
+                    ((part_id, file_path, file_path.rsplit('/', 1)[1], size,
+                      offset) for file_path, size, offset in files))
+
+    def images(self):
+        """
+        Returns the list of the wiiod.catalog.Image of the catalog, sorted by
+        path.
+        """
+        parts = collections.defaultdict(list)
+        for row in self.db.execute(
+                'SELECT image, volume_group, part_index, data_offset, '
+                'part_type FROM partitions ORDER BY image, id'):
+            parts[row[0]].append(disc.PartitionInfos(*row[1:]))
+
+        result = []
+        for row in self.db.execute(
+                'SELECT id, path, size, mtime, error, %s FROM images '
+                'ORDER BY path' % ', '.join(disc.Metadata._fields)):
+            image_id, path, size, mtime, error = row[:5]
+            metadata = disc.Metadata(*row[5:]) if row[5] is not None else None
+            result.append(Image(path, size, mtime, metadata, parts[image_id],
+                                error))
+        return result
+
+    def find(self, pattern=None, min_size=None, max_size=None, limit=None):
+        """
+        Returns the list of the wiiod.catalog.Entry of the files matching
+        all the given criteria, sorted by image and path. pattern matches
+        the absolute path of the files if it contains a '/', their name
+        otherwise; it can contain the wildcards of sqlite GLOB (*, ? and
+        [...]).
+        """
+        conditions = []
+        params = []
+        if pattern is not None:
+            column = 'files.path' if '/' in pattern else 'files.name'
+            if any(c in pattern for c in GLOB_CHARS):
+                conditions.append('%s GLOB ?' % column)
+            else:
+                conditions.append('%s = ?' % column)
+            params.append(pattern)
+        if min_size is not None:
+            conditions.append('files.size >= ?')
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append('files.size <= ?')
+            params.append(max_size)
+
+        query = ('SELECT images.path, partitions.volume_group, '
+                 'partitions.part_index, partitions.data_offset, '
+                 'partitions.part_type, files.path, files.size, '
+                 'files.data_offset FROM files '
+                 'JOIN partitions ON partitions.id = files.partition '
+                 'JOIN images ON images.id = partitions.image')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY images.path, partitions.id, files.path'
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+
+        return [Entry(row[0], discfs.partition_name(
+                          disc.PartitionInfos(*row[1:5])), *row[5:])
+                for row in self.db.execute(query, params)]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Catalog of the files of a library of Wii optical disc '
+                    'images.')
+    parser.add_argument('catalog', help='path to the catalog database')
+    commands = parser.add_subparsers(dest='command')
+
+    update = commands.add_parser('update',
+                                 help='scan the new and modified images')
+    update.add_argument('directories', nargs='+', metavar='directory',
+                        help='directory of disc images (%s files)' %
+                             ', '.join(library.IMAGE_EXTENSIONS))
+    update.add_argument('-j', '--processes', type=int, metavar='N',
+                        help='number of worker processes (default: number '
+                             'of CPUs)')
+    update.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method (default: %(default)s)')
+    update.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to decrypt the '
+                             'clusters (default: fastest available)')
+    update.add_argument('-q', '--quiet', action='store_true',
+                        help='do not display the progress')
+
+    find = commands.add_parser('find', help='find files by name, path or '
+                                            'size')
+    find.add_argument('pattern', nargs='?',
+                      help='file name, or absolute path if it contains a /, '
+                           'with optional * ? [...] wildcards')
+    find.add_argument('-s', '--size', type=int, metavar='BYTES',
+                      help='exact file size')
+    find.add_argument('--min-size', type=int, metavar='BYTES',
+                      help='minimum file size')
+    find.add_argument('--max-size', type=int, metavar='BYTES',
+                      help='maximum file size')
+    find.add_argument('-l', '--limit', type=int, metavar='N',
+                      help='maximum number of results')
+
+    commands.add_parser('images', help='list the images of the catalog')
+    args = parser.parse_args()
+
+    try:
+        catalog = Catalog(args.catalog)
+    except sqlite3.Error as e:
+        print '%s: cannot open catalog %s: %s' % (sys.argv[0], args.catalog,
+                                                  e)
+        sys.exit(1)
+
+    if args.command == 'update':
+        for directory in args.directories:
+            if not os.path.isdir(directory):
+                print '%s: %s is not a directory' % (sys.argv[0], directory)
+                sys.exit(1)
+        try:
+            crypto.set_default_backend(args.aes_backend)
+        except ImportError:
+            print '%s: AES backend not available: %s' % (sys.argv[0],
+                                                         args.aes_backend)
+            sys.exit(1)
+
+        start = time.time()
+        done = [0]
+        def progress(path):
+            done[0] += 1
+            sys.stderr.write('\r%6d images scanned' % done[0])
+
+        scanned, removed = catalog.update(args.directories, args.processes,
+                                          args.backend,
+                                          None if args.quiet else progress,
+                                          args.aes_backend)
+        if scanned and not args.quiet:
+            sys.stderr.write('\n')
+        print 'Scanned %d images, removed %d in %.2f s.' % (
+            scanned, removed, time.time() - start)
+
+    elif args.command == 'find':
+        min_size, max_size = args.min_size, args.max_size
+        if args.size is not None:
+            min_size = max_size = args.size
+        for entry in catalog.find(args.pattern, min_size, max_size,
+                                  args.limit):
+            print '%s\t%s\t%s\t%d' % (entry.image, entry.partition,
+                                      entry.path, entry.size)
+
+    else:
+        for image in catalog.images():
+            if image.error is not None:
+                print '%s\terror: %s' % (image.path, image.error)
+                continue
+            meta = image.metadata
+            print '%s\t%s%s%s%s\t%s\t%s' % (
+                image.path, meta.disc_id, meta.game_code, meta.region_code,
+                meta.maker_code, meta.title, ' '.join(
+                    discfs.partition_name(infos)
+                    for infos in image.partitions))
+
+    catalog.close()
@@ -0,0 +1,180 @@
+"""
+wiiod.crypto
+~~~~~~~~~~~~
+
+AES-128-CBC backends. Several Python crypto libraries can be used to decrypt
+the clusters: the fastest available one is used by default, and another one
+can be chosen by name. Encryption is only needed to build images (see
+wiiod.synth).
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import stats
+
+import collections
+
+class CipherBackend(object):
+    """
+    Base class of the AES backends. Subclasses are only instantiated when
+    their library can be imported.
+    """
+
+    # Name of the backend, used to select it
+    name = None
+
+    def cbc_decrypt(self, key, iv, data):
+        """
+        Decrypts data (a multiple of 16 bytes long) with AES-128-CBC.
+        """
+        raise NotImplementedError
+
+    def cbc_encrypt(self, key, iv, data):
+        """
+        Encrypts data (a multiple of 16 bytes long) with AES-128-CBC.
+        """
+        raise NotImplementedError
+
+class CryptographyBackend(CipherBackend):
+    """
+    The cryptography package, which uses the OpenSSL implementation (with
+    AES-NI on the CPUs supporting it).
+    """
+
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import (Cipher,
+                                                            algorithms, modes)
+        self._backend = default_backend()
+        self._cipher = Cipher
+        self._aes = algorithms.AES
+        self._cbc = modes.CBC
+
+    @stats.timed('aes.decrypt', len)
+    def cbc_decrypt(self, key, iv, data):
+        decryptor = self._cipher(self._aes(key), self._cbc(iv),
+                                 self._backend).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+    def cbc_encrypt(self, key, iv, data):
+        encryptor = self._cipher(self._aes(key), self._cbc(iv),
+                                 self._backend).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+class PyCryptodomeBackend(CipherBackend):
+    """
+    pycryptodome, installed either as Cryptodome or as a replacement of
+    PyCrypto. Uses AES-NI on the CPUs supporting it.
+    """
+
+    name = 'pycryptodome'
+
+    def __init__(self):
+        try:
+            from Cryptodome.Cipher import AES
+        except ImportError:
+            import Crypto
+            if getattr(Crypto, 'version_info', (0,)) < (3,):
+                raise ImportError("Crypto is PyCrypto, not pycryptodome")
+            from Crypto.Cipher import AES
+        self._aes = AES
+
+    @stats.timed('aes.decrypt', len)
+    def cbc_decrypt(self, key, iv, data):
+        return self._aes.new(key, self._aes.MODE_CBC, iv).decrypt(data)
+
+    def cbc_encrypt(self, key, iv, data):
+        return self._aes.new(key, self._aes.MODE_CBC, iv).encrypt(data)
+
+class PyCryptoBackend(CipherBackend):
+    """
+    The original PyCrypto, with a portable C implementation of AES.
+    """
+
+    name = 'pycrypto'
+
+    def __init__(self):
+        import Crypto
+        if getattr(Crypto, 'version_info', (0,)) >= (3,):
+            raise ImportError("Crypto is pycryptodome, not PyCrypto")
+        from Crypto.Cipher import AES
+        self._aes = AES
+
+    @stats.timed('aes.decrypt', len)
+    def cbc_decrypt(self, key, iv, data):
+        return self._aes.new(key, self._aes.MODE_CBC, iv).decrypt(data)
+
+    def cbc_encrypt(self, key, iv, data):
+        return self._aes.new(key, self._aes.MODE_CBC, iv).encrypt(data)
+
+# Known backends, fastest first
+BACKENDS = collections.OrderedDict((cls.name, cls) for cls in (
+    CryptographyBackend,
+    PyCryptodomeBackend,
+    PyCryptoBackend,
+))
+
+# Instantiated backends, by name
+_instances = {}
+
+# Name of the backend returned by get_backend when no name is given
+_default = None
+
+def available_backends():
+    """
+    Returns the names of the backends which can be used, fastest first.
+    """
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_backend(name=None):
+    """
+    Returns the backend with the given name, or the default one (the
+    fastest available backend unless set_default_backend was called). Raises
+    ValueError for unknown names and ImportError if the library of the
+    backend is not installed.
+    """
+    if name is None:
+        name = _default
+    if name is None:
+        names = available_backends()
+        if not names:
+            raise ImportError("no AES library found, install cryptography, "
+                              "pycryptodome or pycrypto")
+        name = names[0]
+    if name not in BACKENDS:
+        raise ValueError("unknown AES backend: %s" % name)
+
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
+
+def set_default_backend(name):
+    """
+    Sets the backend used by default, after checking that it is available.
+    None selects the fastest available backend again.
+    """
+    global _default
+    if name is not None:
+        get_backend(name)
+    _default = name
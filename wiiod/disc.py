@@ -20,8 +20,17 @@ You should have received a copy of the GNU General Public License along with
 wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from wiiod import stats
+
+import array
 import collections
+import ctypes
+import ctypes.util
+import mmap
+import os
 import struct
+import sys
+import threading
 
 # Some magic constants
 WII_MAGIC_NUMBER = 0x5d1c9ea3
@@ -29,6 +38,24 @@ WII_MAGIC_NUMBER = 0x5d1c9ea3
 VGTABLE_OFFSET = 0x40000
 NUMBER_OF_VG = 4
 
+# Size of a Wii disc sector and number of sectors of a dual layer disc
+WII_SECTOR_SIZE = 0x8000
+WII_MAX_SECTORS = 2 * 143432
+
+# CISO header: magic, block size (little endian) and one byte per block
+# telling if it is stored in the file
+CISO_MAGIC = 'CISO'
+CISO_HEADER = struct.Struct('<4sL')
+CISO_HEADER_SIZE = 0x8000
+
+# WBFS header: magic, number of HD sectors, log2 of the HD sector size and of
+# the WBFS sector size, version. The table of used disc slots follows.
+WBFS_MAGIC = 'WBFS'
+WBFS_HEADER = struct.Struct('>4sLBBBx')
+
+# Size of the copy of the disc header at the start of a WBFS disc info
+WBFS_DISC_HEADER_SIZE = 0x100
+
 # Metadata from the disc image
 Metadata = collections.namedtuple('Metadata', ' '.join((
     'disc_id',
@@ -38,20 +65,64 @@ Metadata = collections.namedtuple('Metadata', ' '.join((
     'disc_number',
     'disc_version',
     'wii_magic_number',
-    'title'
+    'title',
+    'disable_hash_verification',
+    'disable_encryption'
 )))
 
+# Size of the metadata and offset of the encryption flag in the disc header
+METADATA_SIZE = 98
+DISABLE_ENCRYPTION_OFFSET = 0x61
+
 def _metadata_from_string(string):
-    binary_format = ">c2sc2sBB16xL4x64s"
+    binary_format = ">c2sc2sBB16xL4x64sBB"
     tup = struct.unpack(binary_format, string)
 
     # Remove NULs from the end of the title
-    title = tup[-1][:tup[-1].index('\0')]
-    tup = tup[:-1] + (title,)
+    title = tup[7][:tup[7].index('\0')]
+    tup = tup[:7] + (title,) + tup[8:]
 
     return Metadata(*tup)
 Metadata.from_string = staticmethod(_metadata_from_string)
 
+def _load_libc():
+    """
+    Returns the C library loaded with ctypes, or None if it cannot be found.
+    """
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+def _libc_pread():
+    """
+    Returns a pread(fd, size, offset) function with the semantics of
+    os.pread (only available since Python 3.3), calling the C library
+    through ctypes, or None if the C library has no pread. ctypes releases
+    the interpreter lock during the call, so that reads issued by several
+    threads run in parallel.
+    """
+    # pread64 takes a 64-bit offset even on 32-bit systems
+    func = getattr(_libc, 'pread64', None) or getattr(_libc, 'pread', None)
+    if func is None:
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                     ctypes.c_int64)
+    func.restype = ctypes.c_ssize_t
+
+    def pread(fd, size, offset):
+        buf = ctypes.create_string_buffer(size)
+        count = func(fd, buf, size, offset)
+        if count < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return buf.raw[:count]
+    return pread
+
+_pread = getattr(os, 'pread', None) or _libc_pread()
+
 # Partition informations. Really simple struct with only four fields.
 PartitionInfos = collections.namedtuple('PartitionInfos', ' '.join((
     'volume_group',
@@ -63,18 +134,88 @@ PartitionInfos = collections.namedtuple('PartitionInfos', ' '.join((
 class Disc(object):
     def __init__(self, fp):
         """
-        Initializes a disc object from an open file descriptor.
+        Initializes a disc object from an open file descriptor. Reads are
+        done with positional reads on the raw file descriptor (os.pread, or
+        the C library pread through ctypes on Python 2), so they can be
+        issued from several threads at once. Other file objects are read
+        with a locked seek + read.
         """
         self.fp = fp
+        self._fd = self._raw_fd(fp)
+        self._lock = threading.Lock()
+        self._read_container()
         self._read_metadata()
         self._read_vg_table()
 
+    @stats.timed('disc.read', len)
     def read(self, offset, size):
         """
         Reads data from an offset and a size.
         """
-        self.fp.seek(offset)
-        return self.fp.read(size)
+        return self._read_file(offset, size)
+
+    def _read_file(self, offset, size):
+        """
+        Reads data from an offset and a size of the image file.
+        """
+        if self._fd is None:
+            with self._lock:
+                self.fp.seek(offset)
+                return self.fp.read(size)
+
+        data = _pread(self._fd, size, offset)
+        if len(data) == size or not data:
+            return data
+
+        # Short read: continue until the requested size or the end of file
+        chunks = [data]
+        while size > len(data):
+            offset += len(data)
+            size -= len(data)
+            data = _pread(self._fd, size, offset)
+            if not data:
+                break
+            chunks.append(data)
+        return ''.join(chunks)
+
+    @stats.timed('disc.read', int)
+    def readinto(self, offset, buf):
+        """
+        Reads data from an offset into a writable buffer (bytearray or
+        memoryview). Returns the number of bytes read.
+        """
+        if self._fd is None:
+            with self._lock:
+                self.fp.seek(offset)
+                return self.fp.readinto(buf)
+
+        view = memoryview(buf)
+        data = self._read_file(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def advise(self, advice, offset=0, size=0):
+        """
+        Hints the expected access pattern ('normal', 'sequential', 'random'
+        or 'willneed') for size bytes at offset, or for the whole disc if size
+        is 0. Only meaningful for memory-mapped discs.
+        """
+        pass
+
+    def close(self):
+        """
+        Closes the underlying file. Later reads fail instead of using a file
+        descriptor which may have been reused.
+        """
+        self._fd = None
+        self.fp.close()
+
+    def stat(self):
+        """
+        Returns the os.stat_result of the image file, used to detect changes
+        of the image by the on-disk caches.
+        """
+        return os.fstat(self.fp.fileno())
 
     @property
     def partitions(self):
@@ -85,11 +226,33 @@ class Disc(object):
             for part in vg:
                 yield part
 
+    @staticmethod
+    def _raw_fd(fp):
+        """
+        Returns the file descriptor to use for positional reads on fp, or
+        None if positional reads are not possible.
+        """
+        if _pread is None:
+            return None
+        try:
+            fd = fp.fileno()
+            _pread(fd, 1, 0)
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        return fd
+
+    def _read_container(self):
+        """
+        Reads the headers of the image container, if any. Raw images do not
+        have any.
+        """
+        pass
+
     def _read_metadata(self):
         """
         Reads and caches the metadata at offset 0x0 on the disc.
         """
-        self.metadata = Metadata.from_string(self.read(0, 96))
+        self.metadata = Metadata.from_string(self.read(0, METADATA_SIZE))
 
         # Small sanity check
         if self.metadata.wii_magic_number != WII_MAGIC_NUMBER:
@@ -120,3 +283,248 @@ class Disc(object):
 
             infos = (volume_group, i, part_offset * 4, part_type)
             self.volume_groups[volume_group].append(PartitionInfos(*infos))
+
+# madvise flags for the Disc.advise access patterns (the values are the same
+# on Linux and on the BSDs)
+_MADVISE_FLAGS = {
+    'normal': 0,
+    'random': 1,
+    'sequential': 2,
+    'willneed': 3,
+}
+
+def _libc_madvise():
+    """
+    Returns the madvise function of the C library, or None if it does not
+    have one. Used before Python 3.8, whose mmap objects have no madvise
+    method.
+    """
+    func = getattr(_libc, 'madvise', None)
+    if func is None:
+        return None
+    func.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+    func.restype = ctypes.c_int
+    return func
+
+_madvise = _libc_madvise()
+
+def _map_address(map_obj):
+    """
+    Returns the address of the memory of a mmap object, or None if it
+    cannot be found. Read-only mappings cannot be used with
+    ctypes.from_buffer, their address is read through the old buffer API.
+    """
+    get_buffer = getattr(ctypes.pythonapi, 'PyObject_AsReadBuffer', None)
+    if get_buffer is None:
+        return None
+    address = ctypes.c_void_p()
+    length = ctypes.c_ssize_t()
+    get_buffer.argtypes = (ctypes.py_object, ctypes.POINTER(ctypes.c_void_p),
+                           ctypes.POINTER(ctypes.c_ssize_t))
+    try:
+        get_buffer(map_obj, ctypes.byref(address), ctypes.byref(length))
+    except (TypeError, ValueError):
+        return None
+    return address.value
+
+class MmapDisc(Disc):
+    """
+    Disc image read through a read-only memory mapping of the file: reads
+    are slices of the mapping and do not need any system call.
+    """
+
+    def __init__(self, fp, advice='normal'):
+        """
+        Maps the open file fp and initializes the disc object. Raises
+        EnvironmentError (or ValueError for empty files) if the file cannot
+        be mapped.
+        """
+        self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._address = None
+        if not hasattr(self._map, 'madvise') and _madvise is not None:
+            self._address = _map_address(self._map)
+        self.advise(advice)
+        super(MmapDisc, self).__init__(fp)
+
+    @stats.timed('disc.read', len)
+    def read(self, offset, size):
+        return self._map[offset:offset + size]
+
+    @stats.timed('disc.read', int)
+    def readinto(self, offset, buf):
+        view = memoryview(buf)
+        data = self._map[offset:offset + len(view)]
+        view[:len(data)] = data
+        return len(data)
+
+    def advise(self, advice, offset=0, size=0):
+        flag = _MADVISE_FLAGS[advice]
+
+        # The start of the advised range has to be page aligned
+        start = offset - offset % mmap.PAGESIZE
+        if size:
+            size += offset - start
+        else:
+            size = len(self._map) - start
+        size = min(size, len(self._map) - start)
+
+        # madvise is only exposed by mmap objects since Python 3.8, older
+        # versions call the C library on the address of the mapping. The
+        # hints are only hints: failures are ignored.
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(flag, start, size)
+        elif self._address is not None and size > 0:
+            _madvise(self._address + start, size, flag)
+
+    def close(self):
+        self._map.close()
+        super(MmapDisc, self).close()
+
+class BlockMapDisc(Disc):
+    """
+    Base class of the disc images stored in a container which only keeps
+    the used blocks of the disc. The block map, giving the offset in the
+    file of each block of the disc (0 for blocks which are not stored), is
+    loaded once by the subclasses. Reads of blocks which are not stored
+    return zeros without any I/O.
+    """
+
+    def __init__(self, fp):
+        self.block_size = None
+        self.block_map = array.array('L')
+        super(BlockMapDisc, self).__init__(fp)
+
+    @stats.timed('disc.read', len)
+    def read(self, offset, size):
+        block_size = self.block_size
+        block_map = self.block_map
+        chunks = []
+
+        # Runs of blocks stored contiguously in the file are read at once
+        run_start = run_size = 0
+        while size > 0:
+            block, block_off = divmod(offset, block_size)
+            if block >= len(block_map):
+                break
+            length = min(size, block_size - block_off)
+
+            file_off = block_map[block]
+            if (file_off and run_size and
+                    run_start + run_size == file_off + block_off):
+                run_size += length
+            else:
+                if run_size:
+                    chunks.append(self._read_file(run_start, run_size))
+                    run_size = 0
+                if file_off:
+                    run_start, run_size = file_off + block_off, length
+                else:
+                    chunks.append('\0' * length)
+
+            offset += length
+            size -= length
+
+        if run_size:
+            chunks.append(self._read_file(run_start, run_size))
+        return chunks[0] if len(chunks) == 1 else ''.join(chunks)
+
+    def readinto(self, offset, buf):
+        view = memoryview(buf)
+        data = self.read(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+class CISODisc(BlockMapDisc):
+    """
+    Disc image in the CISO format: a header holding the block size and a
+    flag for each block, followed by the stored blocks in disc order.
+    """
+
+    def _read_container(self):
+        header = self._read_file(0, CISO_HEADER_SIZE)
+        magic, self.block_size = CISO_HEADER.unpack_from(header)
+        if magic != CISO_MAGIC or len(header) != CISO_HEADER_SIZE:
+            raise ValueError("not a CISO disc image")
+        if not self.block_size:
+            raise ValueError("invalid CISO block size")
+
+        # The map is truncated to the size of a dual layer disc
+        blocks = min(-(-WII_MAX_SECTORS * WII_SECTOR_SIZE // self.block_size),
+                     CISO_HEADER_SIZE - CISO_HEADER.size)
+        file_off = CISO_HEADER_SIZE
+        for flag in header[CISO_HEADER.size:CISO_HEADER.size + blocks]:
+            if flag != '\0':
+                self.block_map.append(file_off)
+                file_off += self.block_size
+            else:
+                self.block_map.append(0)
+
+class WBFSDisc(BlockMapDisc):
+    """
+    Disc image in the WBFS format, as written by USB loaders for a single
+    disc: the first disc slot of the WBFS partition is used.
+    """
+
+    def _read_container(self):
+        header = self._read_file(0, WBFS_HEADER.size + 1)
+        if len(header) != WBFS_HEADER.size + 1:
+            raise ValueError("not a WBFS disc image")
+        magic, _, hd_sector_shift, wbfs_sector_shift, _ = \
+            WBFS_HEADER.unpack_from(header)
+        if magic != WBFS_MAGIC:
+            raise ValueError("not a WBFS disc image")
+        if header[WBFS_HEADER.size] == '\0':
+            raise ValueError("the WBFS image does not contain any disc")
+        if not 15 <= wbfs_sector_shift < 32:
+            raise ValueError("invalid WBFS sector size")
+
+        self.block_size = 1 << wbfs_sector_shift
+        blocks = (WII_MAX_SECTORS * WII_SECTOR_SIZE) >> wbfs_sector_shift
+
+        # The disc info of the first disc starts at the second HD sector
+        table_off = (1 << hd_sector_shift) + WBFS_DISC_HEADER_SIZE
+        table = array.array('H', self._read_file(table_off, 2 * blocks))
+        if len(table) != blocks:
+            raise ValueError("truncated WBFS disc image")
+        if sys.byteorder == 'little':
+            table.byteswap()
+
+        self.block_map.extend(wbfs_sector << wbfs_sector_shift
+                              for wbfs_sector in table)
+
+# Container formats, by magic number
+CONTAINERS = {
+    CISO_MAGIC: CISODisc,
+    WBFS_MAGIC: WBFSDisc,
+}
+
+# Available disc image backends
+BACKENDS = ('auto', 'mmap', 'file')
+
+def open_disc(path, backend='auto', advice='normal'):
+    """
+    Opens the disc image at path. The 'mmap' backend maps the image in
+    memory, the 'file' backend reads it with file reads. The 'auto' backend
+    uses a mapping when possible and falls back to file reads for sources
+    which cannot be mapped (pipes, character devices, ...). CISO and WBFS
+    images are detected by their magic number and always use file reads.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown disc backend: %s" % backend)
+
+    fp = open(path, 'rb')
+    try:
+        container = CONTAINERS.get(fp.read(4))
+        fp.seek(0)
+        if container is not None:
+            return container(fp)
+        if backend != 'file':
+            try:
+                return MmapDisc(fp, advice)
+            except (EnvironmentError, ValueError, OverflowError):
+                if backend == 'mmap':
+                    raise
+        return Disc(fp)
+    except:
+        fp.close()
+        raise
@@ -0,0 +1,343 @@
+"""
+wiiod.discfs
+~~~~~~~~~~~~
+
+Filesystem of a whole disc: every partition of the disc is a top-level
+directory holding the filesystem of the partition. Partitions are only
+opened and parsed when they are first accessed, and they all share the disc
+handle and the decrypted clusters cache.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import partition, wiiodfs
+from wiiod.cache import LRUCache
+
+import threading
+
+# Inode number of the root directory
+ROOT_INODE = 0
+
+# Inode numbers are made of the partition number + 1 in the high bits and of
+# the inode number in the partition filesystem in the low bits. FST indexes
+# are at most 24 bits long.
+PARTITION_SHIFT = 24
+
+# Names of the known partition types
+PARTITION_TYPES = {
+    0: 'game',
+    1: 'update',
+    2: 'channel',
+}
+
+def partition_name(infos):
+    """
+    Returns the directory name of a partition (wiiod.disc.PartitionInfos),
+    made of its volume group, its index and its type.
+    """
+    type_name = PARTITION_TYPES.get(infos.type, '%08x' % infos.type)
+    return 'vg%d-p%d-%s' % (infos.volume_group, infos.index, type_name)
+
+class CompositeFilesystem(object):
+    """
+    Base class of the filesystems made of several child filesystems (with
+    the interface of wiiod.wiiodfs.Filesystem), each one exposed as a
+    top-level directory. Inode numbers are made of the child number + 1
+    shifted by CHILD_SHIFT bits and of the inode number in the child, with
+    0 for the root directory. Subclasses set the names of the children and
+    implement filesystem.
+    """
+
+    # Number of bits of the inode numbers of the children
+    CHILD_SHIFT = PARTITION_SHIFT
+
+    def __init__(self, names):
+        """
+        Initializes the filesystem with the list of the names of its
+        children.
+        """
+        self.names = names
+        self._numbers = dict((name, number) for number, name in
+                             enumerate(names))
+        self._child_mask = (1 << self.CHILD_SHIFT) - 1
+
+    def filesystem(self, number):
+        """
+        Returns the filesystem of a child, opening it if needed.
+        """
+        raise NotImplementedError
+
+    def loaded_filesystems(self):
+        """
+        Returns the list of the child filesystems currently open.
+        """
+        raise NotImplementedError
+
+    def stat(self):
+        """
+        Returns the os.stat_result used for the attributes of the files.
+        """
+        raise NotImplementedError
+
+    def lookup(self, path):
+        """
+        Returns the inode number of a path. Raises IOError if the path does
+        not exist.
+        """
+        key = path.strip('/')
+        if not key:
+            return ROOT_INODE
+
+        name, _, rest = key.partition('/')
+        try:
+            number = self._numbers[name]
+        except KeyError:
+            raise IOError("file not found")
+        if not rest:
+            # Top-level directories are looked up without opening the child
+            return self._inode(number, wiiodfs.ROOT_INODE)
+        return self._inode(number, self.filesystem(number).lookup(rest))
+
+    def open(self, path):
+        """
+        Opens the provided path and returns a file-like object.
+        """
+        return self.open_inode(self.lookup(path))
+
+    def open_inode(self, ino):
+        """
+        Opens the file with the provided inode number and returns a file-like
+        object.
+        """
+        if ino == ROOT_INODE:
+            raise IOError("is a directory")
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.open_inode(sub_ino)
+
+    def listdir(self, path):
+        """
+        Lists the provided path and return a list of the direct child names.
+        """
+        ino = self.lookup(path)
+        if not self.inode_isdir(ino):
+            raise IOError("not a directory")
+        return [self.inode_name(child) for child in self.inode_children(ino)]
+
+    def isfile(self, path):
+        """
+        Checks if the provided path is a file.
+        """
+        try:
+            return not self.inode_isdir(self.lookup(path))
+        except IOError:
+            return False
+
+    def isdir(self, path):
+        """
+        Checks if the provided path is a directory.
+        """
+        try:
+            return self.inode_isdir(self.lookup(path))
+        except IOError:
+            return False
+
+    def exists(self, path):
+        """
+        Checks if a path exists on the filesystem.
+        """
+        try:
+            self.lookup(path)
+            return True
+        except IOError:
+            return False
+
+    def getsize(self, path):
+        """
+        Returns the size of a file.
+        """
+        ino = self.lookup(path)
+        if self.inode_isdir(ino):
+            raise IOError("not a file")
+        return self.inode_size(ino)
+
+    @property
+    def inode_count(self):
+        """
+        Number of inodes of the children currently open, top-level
+        directories and root directory included.
+        """
+        return 1 + len(self.names) + sum(
+            fs_obj.inode_count - 1 for fs_obj in self.loaded_filesystems())
+
+    def inode_isdir(self, ino):
+        """
+        Checks if the inode is a directory.
+        """
+        if ino == ROOT_INODE or ino & self._child_mask == wiiodfs.ROOT_INODE:
+            return True
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.inode_isdir(sub_ino)
+
+    def inode_size(self, ino):
+        """
+        Returns the size of a file inode (0 for directories).
+        """
+        if self.inode_isdir(ino):
+            return 0
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.inode_size(sub_ino)
+
+    def inode_read(self, ino, offset, size):
+        """
+        Reads at most size bytes of a file inode at offset.
+        """
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.inode_read(sub_ino, offset, size)
+
+    def inode_readahead(self, ino):
+        """
+        Returns a new wiiod.readahead.ReadaheadStream for a file inode, or
+        None if its filesystem does not prefetch data.
+        """
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.inode_readahead(sub_ino)
+
+    def inode_parent(self, ino):
+        """
+        Returns the inode number of the parent directory.
+        """
+        if ino == ROOT_INODE or ino & self._child_mask == wiiodfs.ROOT_INODE:
+            return ROOT_INODE
+        fs_obj, sub_ino = self._split(ino)
+        return (ino & ~self._child_mask) | fs_obj.inode_parent(sub_ino)
+
+    def inode_name(self, ino):
+        """
+        Returns the name of an inode ('' for the root directory).
+        """
+        if ino == ROOT_INODE:
+            return ''
+        if ino & self._child_mask == wiiodfs.ROOT_INODE:
+            return self._child_name(ino)
+        fs_obj, sub_ino = self._split(ino)
+        return fs_obj.inode_name(sub_ino)
+
+    def inode_path(self, ino):
+        """
+        Returns the absolute path of an inode.
+        """
+        if ino == ROOT_INODE:
+            return '/'
+        if ino & self._child_mask == wiiodfs.ROOT_INODE:
+            return '/' + self._child_name(ino)
+        fs_obj, sub_ino = self._split(ino)
+        return ('/' + self._child_name(ino) +
+                fs_obj.inode_path(sub_ino).rstrip('/'))
+
+    def inode_children(self, ino):
+        """
+        Iterates on the inode numbers of the direct children of a directory.
+        The top-level directories are listed without opening the children.
+        """
+        if ino == ROOT_INODE:
+            for number in xrange(len(self.names)):
+                yield self._inode(number, wiiodfs.ROOT_INODE)
+            return
+
+        fs_obj, sub_ino = self._split(ino)
+        for child in fs_obj.inode_children(sub_ino):
+            yield (ino & ~self._child_mask) | child
+
+    def _inode(self, number, sub_ino):
+        """
+        Returns the inode number of an inode of a child filesystem.
+        """
+        return ((number + 1) << self.CHILD_SHIFT) | sub_ino
+
+    def _child_name(self, ino):
+        """
+        Returns the name of the top-level directory of an inode.
+        """
+        number = (ino >> self.CHILD_SHIFT) - 1
+        if not 0 <= number < len(self.names):
+            raise IOError("invalid inode number")
+        return self.names[number]
+
+    def _split(self, ino):
+        """
+        Returns the child filesystem and the inode number in this
+        filesystem of an inode.
+        """
+        number = (ino >> self.CHILD_SHIFT) - 1
+        if not 0 <= number < len(self.names):
+            raise IOError("invalid inode number")
+        return self.filesystem(number), ino & self._child_mask
+
+class DiscFilesystem(CompositeFilesystem):
+    """
+    Filesystem of all the partitions of a disc, with the same interface as
+    wiiod.wiiodfs.Filesystem.
+    """
+
+    def __init__(self, disc, make_partition=None, index_dir=None):
+        """
+        Creates the filesystem of a wiiod.disc.Disc. make_partition is called
+        with the wiiod.disc.PartitionInfos of a partition when it is first
+        accessed and returns the wiiod.partition.Partition to use; by
+        default, all the partitions share a new LRU cache. index_dir is
+        passed to the partition filesystems (see wiiod.wiiodfs.Filesystem).
+        """
+        self.disc = disc
+        self.index_dir = index_dir
+
+        if make_partition is None:
+            shared_cache = LRUCache()
+            make_partition = lambda infos: partition.Partition(disc, infos,
+                                                               shared_cache)
+        self._make_partition = make_partition
+
+        self.part_infos = list(disc.partitions)
+        super(DiscFilesystem, self).__init__(
+            [partition_name(infos) for infos in self.part_infos])
+
+        self._filesystems = [None] * len(self.part_infos)
+        self._lock = threading.Lock()
+
+    def filesystem(self, number):
+        """
+        Returns the wiiod.wiiodfs.Filesystem of a partition, opening the
+        partition and parsing its filesystem on the first call.
+        """
+        fs_obj = self._filesystems[number]
+        if fs_obj is None:
+            with self._lock:
+                fs_obj = self._filesystems[number]
+                if fs_obj is None:
+                    part = self._make_partition(self.part_infos[number])
+                    fs_obj = wiiodfs.Filesystem(part, self.index_dir)
+                    self._filesystems[number] = fs_obj
+        return fs_obj
+
+    def loaded_filesystems(self):
+        return [fs_obj for fs_obj in self._filesystems if fs_obj is not None]
+
+    def loaded_partitions(self):
+        """
+        Returns the list of the partitions opened so far.
+        """
+        return [fs_obj.part for fs_obj in self.loaded_filesystems()]
+
+    def stat(self):
+        return self.disc.stat()
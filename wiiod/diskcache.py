@@ -0,0 +1,234 @@
+"""
+wiiod.diskcache
+~~~~~~~~~~~~~~~
+
+Persistent cache of decrypted clusters, kept on disk across mounts. Each
+partition gets a sparse data file, where cluster N is stored at offset
+N * CLUSTER_DATA_SIZE, and a bitmap file listing the clusters present in the
+data file.
+
+Cluster data is always synced to disk before the bitmap marking it as
+present is written, and the bitmap is replaced atomically: after a crash,
+the cache can miss clusters but never returns invalid data. The bitmap
+records the size and modification time of the image, and the cache is
+emptied when they do not match anymore.
+
+A cache is owned by one process at a time: the data file is locked
+exclusively (flock) while it is open, and other processes mounting the same
+partition get a CacheBusyError and run without the persistent cache. The
+data file is only emptied under this lock, so that a mount never truncates
+clusters another mount has written and is about to mark as present.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod.partition import CLUSTER_SIZE, CLUSTER_DATA_SIZE
+
+import errno
+import fcntl
+import os
+import os.path
+import struct
+import threading
+
+# Bitmap file header: magic, image size, image mtime (ns), partition data
+# start and number of clusters
+BITMAP_MAGIC = 'WIODPC01'
+BITMAP_HEADER = struct.Struct('>8sQQQQ')
+
+# Default size limit of the cache of each partition
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Number of clusters added between two bitmap updates
+FLUSH_INTERVAL = 256
+
+class CacheBusyError(IOError):
+    """
+    Raised when the cache files are already used by another process.
+    """
+    pass
+
+class PersistentCache(object):
+    """
+    On-disk cache of the decrypted clusters of one partition. Used by
+    wiiod.partition.Partition behind its in-memory cache.
+    """
+
+    def __init__(self, path, image_size, image_mtime, data_start, clusters,
+                 max_bytes=DEFAULT_MAX_SIZE):
+        """
+        Opens or creates the cache files path + '.data' and path + '.bitmap'
+        for a partition of the given number of clusters. The cache is emptied
+        if it was created for a different image or partition layout. Raises
+        CacheBusyError if another process has the cache open.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clusters = clusters
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._header = BITMAP_HEADER.pack(BITMAP_MAGIC, image_size,
+                                          image_mtime, data_start, clusters)
+
+        # The bitmap is only read once the lock is held: the previous owner
+        # may have written it while closing the cache
+        self._fd = os.open(path + '.data', os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._bitmap = self._load_bitmap()
+            self.count = sum(bin(byte).count('1') for byte in self._bitmap)
+            if not self.count:
+                os.ftruncate(self._fd, 0)
+        except EnvironmentError as e:
+            os.close(self._fd)
+            self._fd = None
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise CacheBusyError(e.errno, 'cache used by another process',
+                                     path + '.data')
+            raise
+        self._unflushed = 0
+
+    @classmethod
+    def for_partition(cls, directory, part, max_bytes=DEFAULT_MAX_SIZE):
+        """
+        Opens the persistent cache of a wiiod.partition.Partition in the
+        given directory. Files are named after the disc ID, disc number,
+        disc version and partition offset.
+        """
+        st = part.disc.stat()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return cls(os.path.join(directory, part.unique_name()), st.st_size,
+                   int(st.st_mtime * 1000000000), part.data_start,
+                   part.data_size / CLUSTER_SIZE, max_bytes)
+
+    def __contains__(self, idx):
+        return 0 <= idx < self.clusters and self._has(idx)
+
+    def get(self, idx):
+        """
+        Returns the decrypted cluster idx, or None if it is not cached.
+        """
+        if idx not in self:
+            self.misses += 1
+            return None
+
+        with self._lock:
+            os.lseek(self._fd, idx * CLUSTER_DATA_SIZE, os.SEEK_SET)
+            data = os.read(self._fd, CLUSTER_DATA_SIZE)
+        if len(data) != CLUSTER_DATA_SIZE:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def put(self, idx, data):
+        """
+        Stores a decrypted cluster, unless it is already stored or the cache
+        is full.
+        """
+        if (not 0 <= idx < self.clusters or self._has(idx) or
+                len(data) != CLUSTER_DATA_SIZE):
+            return
+
+        with self._lock:
+            if (self._has(idx) or
+                    (self.count + 1) * CLUSTER_DATA_SIZE > self.max_bytes):
+                return
+
+            os.lseek(self._fd, idx * CLUSTER_DATA_SIZE, os.SEEK_SET)
+            view = buffer(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+
+            self._bitmap[idx >> 3] |= 1 << (idx & 7)
+            self.count += 1
+            self._unflushed += 1
+            if self._unflushed >= FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """
+        Syncs the stored clusters to disk and writes the bitmap.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Flushes and closes the cache files, releasing the lock.
+        """
+        with self._lock:
+            self._flush()
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache usage statistics.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': self.count,
+            'size': self.count * CLUSTER_DATA_SIZE,
+            'max_size': self.max_bytes,
+        }
+
+    def _has(self, idx):
+        return self._bitmap[idx >> 3] & (1 << (idx & 7))
+
+    def _flush(self):
+        """
+        Syncs the data file, then atomically replaces the bitmap file. Must
+        be called with the lock held.
+        """
+        if not self._unflushed:
+            return
+        os.fsync(self._fd)
+
+        tmp_path = '%s.bitmap.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            contents = self._header + str(self._bitmap)
+            while contents:
+                contents = contents[os.write(fd, contents):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, self.path + '.bitmap')
+        self._unflushed = 0
+
+    def _load_bitmap(self):
+        """
+        Reads the bitmap file. Returns an empty bitmap if there is no bitmap
+        or if it does not match the image and partition.
+        """
+        size = (self.clusters + 7) / 8
+        try:
+            with open(self.path + '.bitmap', 'rb') as fp:
+                contents = fp.read()
+        except IOError:
+            return bytearray(size)
+
+        header = contents[:BITMAP_HEADER.size]
+        bitmap = contents[BITMAP_HEADER.size:]
+        if header != self._header or len(bitmap) != size:
+            return bytearray(size)
+        return bytearray(bitmap)
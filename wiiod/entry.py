@@ -21,54 +21,240 @@ wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
 
-from fs.expose import fuse
-from wiiod import disc, partition, wiiodfs, fs
+from wiiod import (cache, crypto, disc, discfs, diskcache, library,
+                   partition, readahead, stats, wiiodfs)
 
+import argparse
 import os.path
 import os
 import sys
 
-def main():
-    if len(sys.argv) < 3 or '--help' in sys.argv or '-h' in sys.argv:
-        print 'usage: %s <image> <mountpoint> [partition index]' % sys.argv[0]
-        sys.exit(1)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Mounts a Wii optical disc image using FUSE.')
+    parser.add_argument('image', help='path to the disc image (or to the '
+                                      'images directory with --library)')
+    parser.add_argument('mount_point', help='directory to mount the disc on')
+    parser.add_argument('part_index', nargs='?', help='game partition index')
+    add_filesystem_arguments(parser)
+    parser.add_argument('-A', '--adapter', default='pyfs',
+                        choices=('pyfs', 'native'),
+                        help='FUSE adapter: PyFS, or direct fusepy '
+                             'operations with kernel caching '
+                             '(default: %(default)s)')
+    parser.add_argument('-m', '--multithreaded', action='store_true',
+                        help='serve FUSE requests from several threads')
+    return parser.parse_args()
+
+def add_filesystem_arguments(parser):
+    """
+    Adds the options of open_filesystem to an argparse parser, which also
+    needs image and part_index arguments.
+    """
+    parser.add_argument('-M', '--all-partitions', action='store_true',
+                        help='expose every partition of the disc (game, '
+                             'update, channel) as a top-level directory')
+    parser.add_argument('-L', '--library', action='store_true',
+                        help='expose every disc image of the image directory '
+                             '(%s files) as a top-level directory' %
+                             ', '.join(library.IMAGE_EXTENSIONS))
+    parser.add_argument('-O', '--max-open', type=int, metavar='N',
+                        default=library.DEFAULT_MAX_OPEN,
+                        help='maximum number of images kept open with '
+                             '--library (default: %(default)s)')
+    parser.add_argument('-c', '--cache-size', type=int, metavar='MB',
+                        default=cache.DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='memory budget for decrypted clusters, in MB '
+                             '(default: %(default)s)')
+    parser.add_argument('-p', '--cache-policy', default='lru',
+                        choices=cache.POLICIES.keys(),
+                        help='replacement policy of the clusters cache '
+                             '(default: %(default)s)')
+    parser.add_argument('-P', '--persistent-cache', metavar='DIR',
+                        help='directory of the on-disk cache of decrypted '
+                             'clusters, kept across mounts (each partition '
+                             'cache is used by one mount at a time)')
+    parser.add_argument('-S', '--persistent-cache-size', type=int,
+                        metavar='MB',
+                        default=diskcache.DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help='size limit of the on-disk cache of each '
+                             'partition, in MB (default: %(default)s)')
+    parser.add_argument('-i', '--index-dir', metavar='DIR',
+                        help='directory of the filesystem table indexes, '
+                             'kept across mounts to skip the FST parsing')
+    parser.add_argument('-r', '--readahead', type=int, metavar='CLUSTERS',
+                        default=readahead.DEFAULT_WINDOW,
+                        help='number of clusters prefetched ahead of files '
+                             'read sequentially, 0 to disable '
+                             '(default: %(default)s)')
+    parser.add_argument('-w', '--readahead-workers', type=int, metavar='N',
+                        default=readahead.DEFAULT_WORKERS,
+                        help='number of readahead threads '
+                             '(default: %(default)s)')
+    parser.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method: memory mapping or '
+                             'file reads (default: %(default)s)')
+    parser.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to decrypt the '
+                             'clusters (default: fastest available)')
+    parser.add_argument('-V', '--verify', action='store_true',
+                        help='check the clusters against the disc hashes, '
+                             'reads of corrupted data fail with EIO')
+    parser.add_argument('-n', '--no-stats', action='store_true',
+                        help='do not collect runtime statistics (exposed in '
+                             '%s otherwise)' % stats.STATS_PATH)
 
+def open_filesystem(args):
+    """
+    Opens the filesystem described by the arguments of a parser set up with
+    add_filesystem_arguments, exiting with an error message if they are
+    invalid. Returns the filesystem (with the interface of
+    wiiod.wiiodfs.Filesystem) and a function returning the list of the
+    wiiod.partition.Partition opened so far.
+    """
     try:
-        image_file = open(sys.argv[1], 'rb')
-    except IOError:
-        print '%s: no such file or directory: %s' % (sys.argv[0], sys.argv[1])
+        part_index = int(args.part_index) if args.part_index else None
+    except ValueError:
+        print '%s: the partition index should be an integer' % sys.argv[0]
         sys.exit(1)
 
-    mount_point = sys.argv[2]
-    if not os.path.isdir(mount_point):
-        print '%s: %s is not a directory' % (sys.argv[0], sys.argv[2])
+    if args.cache_size <= 0:
+        print '%s: the cache size should be positive' % sys.argv[0]
         sys.exit(1)
 
-    try:
-        part_index = int(sys.argv[3]) if len(sys.argv) > 3 else None
-    except ValueError:
-        print '%s: the partition index should be an integer' % sys.argv[0]
+    if args.readahead < 0 or args.readahead_workers <= 0:
+        print '%s: invalid readahead settings' % sys.argv[0]
         sys.exit(1)
 
-    disc_obj = disc.Disc(image_file)
-    all_game_parts = [part for part in disc_obj.partitions
-                           if part.type == 0]
-    if len(all_game_parts) > 1 and part_index is None:
-        print 'There is %d game partitions on the disc.' % len(all_game_parts)
-        print 'Please relaunch the program and specify the partition index.'
+    stats.set_enabled(not args.no_stats)
+
+    try:
+        crypto.set_default_backend(args.aes_backend)
+    except ImportError:
+        print '%s: AES backend not available: %s' % (sys.argv[0],
+                                                     args.aes_backend)
         sys.exit(1)
 
-    if part_index is None:
-        part_index = 0
+    if args.library:
+        if not os.path.isdir(args.image):
+            print '%s: %s is not a directory' % (sys.argv[0], args.image)
+            sys.exit(1)
+        if part_index is not None or args.persistent_cache:
+            print '%s: --library cannot be used with a partition index or ' \
+                  'a persistent cache' % sys.argv[0]
+            sys.exit(1)
+        if args.max_open <= 0:
+            print '%s: the number of open images should be positive' % (
+                sys.argv[0])
+            sys.exit(1)
+    else:
+        try:
+            disc_obj = disc.open_disc(args.image, args.backend, 'random')
+        except EnvironmentError:
+            print '%s: cannot open disc image: %s' % (sys.argv[0],
+                                                      args.image)
+            sys.exit(1)
 
-    if part_index >= len(all_game_parts) or part_index < 0:
-        print 'Invalid partition index (out of bounds)'
+        all_game_parts = [part for part in disc_obj.partitions
+                               if part.type == 0]
+        if (len(all_game_parts) > 1 and part_index is None and
+                not args.all_partitions):
+            print 'There is %d game partitions on the disc.' % (
+                len(all_game_parts))
+            print 'Please relaunch the program and specify the partition ' \
+                  'index,'
+            print 'or use --all-partitions to mount all of them.'
+            sys.exit(1)
+
+        if part_index is None:
+            part_index = 0
+
+        if (part_index >= len(all_game_parts) or part_index < 0) and \
+                not args.all_partitions:
+            print 'Invalid partition index (out of bounds)'
+            sys.exit(1)
+
+    # All the partitions (of all the images) share the cache and the
+    # readahead threads
+    cluster_cache = cache.new_cache(args.cache_policy,
+                                    args.cache_size * 1024 * 1024)
+    if args.readahead:
+        prefetcher = readahead.Readahead(args.readahead,
+                                         args.readahead_workers)
+    else:
+        prefetcher = None
+
+    def make_partition(disc_obj, part_infos):
+        part = partition.Partition(disc_obj, part_infos, cluster_cache,
+                                   prefetcher, verify=args.verify)
+        if args.persistent_cache:
+            try:
+                part.persistent_cache = \
+                    diskcache.PersistentCache.for_partition(
+                        args.persistent_cache, part,
+                        args.persistent_cache_size * 1024 * 1024)
+            except diskcache.CacheBusyError:
+                print '%s: persistent cache of %s used by another ' \
+                      'process, not using it' % (sys.argv[0],
+                                                 part.unique_name())
+        return part
+
+    if args.library:
+        fs_obj = library.LibraryFilesystem(args.image, make_partition,
+                                           args.index_dir, args.max_open,
+                                           args.all_partitions, args.backend)
+        loaded_partitions = fs_obj.loaded_partitions
+        stats.register('library', fs_obj.stats)
+    elif args.all_partitions:
+        fs_obj = discfs.DiscFilesystem(
+            disc_obj, lambda infos: make_partition(disc_obj, infos),
+            args.index_dir)
+        loaded_partitions = fs_obj.loaded_partitions
+    else:
+        part = make_partition(disc_obj, all_game_parts[part_index])
+        fs_obj = wiiodfs.Filesystem(part, args.index_dir)
+        loaded_partitions = lambda: [part]
+
+    stats.register('cache', cluster_cache.stats)
+    stats.register('persistent_caches', lambda: dict(
+        (part.unique_name(), part.persistent_cache.stats())
+        for part in loaded_partitions()
+        if part.persistent_cache is not None))
+    return fs_obj, loaded_partitions
+
+def main():
+    args = parse_args()
+
+    mount_point = args.mount_point
+    if not os.path.isdir(mount_point):
+        print '%s: %s is not a directory' % (sys.argv[0], mount_point)
         sys.exit(1)
 
-    part = partition.Partition(disc_obj, all_game_parts[part_index])
-    fs_obj = wiiodfs.Filesystem(part)
-    pyfs_obj = fs.WiiODFS(fs_obj)
+    fs_obj, loaded_partitions = open_filesystem(args)
+
+    if args.adapter == 'native':
+        try:
+            from wiiod import fuseops
+        except (ImportError, EnvironmentError):
+            print '%s: the native adapter needs fusepy' % sys.argv[0]
+            sys.exit(1)
+        mount = lambda: fuseops.mount(fs_obj, mount_point,
+                                      nothreads=not args.multithreaded)
+    else:
+        try:
+            from fs.expose import fuse
+            from wiiod import fs
+        except (ImportError, EnvironmentError):
+            print '%s: the PyFS adapter needs PyFS and FUSE' % sys.argv[0]
+            sys.exit(1)
+        pyfs_obj = fs.WiiODFS(fs_obj)
+        mount = lambda: fuse.mount(pyfs_obj, mount_point, foreground=True,
+                                   nothreads=not args.multithreaded)
 
     print 'Use fusermount -u %s to unmount the disc after use.' % mount_point
     if not os.fork():
-        fuse.mount(pyfs_obj, mount_point, foreground=True)
+        mount()
+        for part in loaded_partitions():
+            if part.persistent_cache is not None:
+                part.persistent_cache.close()
@@ -0,0 +1,150 @@
+"""
+wiiod.export
+~~~~~~~~~~~~
+
+Exports a disc image with all its partitions decrypted. The clusters keep
+their layout (hash block followed by the data) and the encryption is
+disabled in the disc header, so that wiiod.partition.Partition reads the
+exported image without any AES computation. Clusters which are not used by
+the filesystem can be scrubbed (left as holes in the exported file).
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import cache, crypto, disc, partition, scrub
+from wiiod.partition import CLUSTER_SIZE, CLUSTERS_PER_GROUP
+
+import argparse
+import sys
+import time
+
+# Size of the chunks used to copy the areas which are not partition data
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def _copy_raw(disc_obj, out, start, end):
+    """
+    Copies the raw disc data between start and end to the output file.
+    """
+    out.seek(start)
+    while start < end:
+        data = disc_obj.read(start, min(COPY_CHUNK_SIZE, end - start))
+        if not data:
+            break
+        out.write(data)
+        start += len(data)
+
+def export(image_path, target, scrub_unused=False, backend='auto',
+           progress=None):
+    """
+    Writes a decrypted copy of the disc image to the target path. The
+    clusters of each partition are written with their hash block and their
+    data decrypted; the other areas of the disc are copied unchanged, up to
+    the end of the last partition. With scrub_unused, clusters not used by
+    the filesystem of their partition (see wiiod.scrub.ClusterMap) are not
+    written and read as zeros. progress is called with the number of bytes
+    processed so far after each hash group. Returns the number of clusters
+    written and the number of clusters scrubbed.
+    """
+    disc_obj = disc.open_disc(image_path, backend, 'sequential')
+    try:
+        parts = [partition.Partition(disc_obj, infos, cache.LRUCache(0))
+                 for infos in disc_obj.partitions]
+        parts.sort(key=lambda part: part.disc_infos.offset)
+
+        written = scrubbed = 0
+        with open(target, 'wb') as out:
+            pos = 0
+            for part in parts:
+                start = part.disc_infos.offset + part.data_start
+                _copy_raw(disc_obj, out, pos, start)
+
+                used = None
+                if scrub_unused:
+                    used = scrub.ClusterMap.for_partition(part)
+
+                out.seek(start)
+                clusters = part.data_size / CLUSTER_SIZE
+                for first in xrange(0, clusters, CLUSTERS_PER_GROUP):
+                    count = min(CLUSTERS_PER_GROUP, clusters - first)
+                    indexes = range(first, first + count)
+                    if used is not None:
+                        indexes = [idx for idx in indexes if idx in used]
+
+                    data = ''
+                    if indexes:
+                        data = part.plain_clusters(first, count)
+                    for idx in indexes:
+                        off = (idx - first) * CLUSTER_SIZE
+                        out.seek(start + idx * CLUSTER_SIZE)
+                        out.write(buffer(data, off, CLUSTER_SIZE))
+
+                    written += len(indexes)
+                    scrubbed += count - len(indexes)
+                    if progress is not None:
+                        progress(start + (first + count) * CLUSTER_SIZE)
+                pos = start + clusters * CLUSTER_SIZE
+
+            # Scrubbed clusters at the end of the image are holes too
+            out.truncate(pos)
+            out.seek(disc.DISABLE_ENCRYPTION_OFFSET)
+            out.write('\x01')
+    finally:
+        disc_obj.close()
+    return written, scrubbed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Writes a decrypted copy of a Wii optical disc image.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('target', help='path of the decrypted image')
+    parser.add_argument('-s', '--scrub', action='store_true',
+                        help='do not write the clusters which are not used '
+                             'by the filesystem')
+    parser.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method (default: %(default)s)')
+    parser.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to decrypt the '
+                             'clusters (default: fastest available)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not display the progress')
+    args = parser.parse_args()
+
+    try:
+        crypto.set_default_backend(args.aes_backend)
+    except ImportError:
+        print '%s: AES backend not available: %s' % (sys.argv[0],
+                                                     args.aes_backend)
+        sys.exit(1)
+
+    start = time.time()
+    def progress(total):
+        elapsed = time.time() - start
+        sys.stderr.write('\r%8.1f MB  %8.2f MB/s' % (
+            total / 1048576.0, total / 1048576.0 / max(elapsed, 1e-6)))
+
+    try:
+        written, scrubbed = export(args.image, args.target, args.scrub,
+                                   args.backend,
+                                   None if args.quiet else progress)
+    except EnvironmentError as e:
+        print '%s: cannot export disc image: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    elapsed = time.time() - start
+    if not args.quiet:
+        sys.stderr.write('\n')
+
+    print 'Exported %d clusters (%d scrubbed) in %.2f s' % (
+        written, scrubbed, elapsed)
@@ -0,0 +1,315 @@
+"""
+wiiod.extract
+~~~~~~~~~~~~~
+
+Extracts all the files of a disc partition to a directory, decrypting the
+clusters in parallel using a pool of worker processes.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import cache, crypto, disc, partition, wiiodfs
+from wiiod.partition import CLUSTER_DATA_SIZE, CLUSTERS_PER_GROUP
+
+import argparse
+import ctypes
+import errno
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+
+# Files are never written through a symbolic link
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+# Decrypted data stored in a hash group: the unit of work of the processes
+GROUP_DATA_SIZE = CLUSTERS_PER_GROUP * CLUSTER_DATA_SIZE
+
+# Partition opened by each worker process
+_worker_part = None
+
+# Names of the image which cannot be used as a file name in the target
+UNSAFE_NAMES = ('', '.', '..')
+
+def _libc_fallocate():
+    """
+    Returns a fallocate(fd, size) function allocating the blocks of the
+    first size bytes of a file with the posix_fallocate of the C library
+    (os.posix_fallocate is only available since Python 3.3), or None if the
+    C library has no posix_fallocate. The function raises OSError on
+    failure.
+    """
+    # posix_fallocate64 takes 64-bit offsets even on 32-bit systems
+    func = (getattr(disc._libc, 'posix_fallocate64', None) or
+            getattr(disc._libc, 'posix_fallocate', None))
+    if func is None:
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    func.restype = ctypes.c_int
+
+    def fallocate(fd, size):
+        # The error number is returned instead of being stored in errno
+        err = func(fd, 0, size)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return fallocate
+
+_fallocate = _libc_fallocate()
+
+def preallocate(fd, size):
+    """
+    Sets the size of a file and allocates its blocks so that the extracted
+    data is not written to a sparse, fragmented file. Falls back to a
+    sparse file when the filesystem cannot allocate blocks in advance.
+    """
+    if size and _fallocate is not None:
+        try:
+            _fallocate(fd, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+    os.ftruncate(fd, size)
+
+def relative_path(fs_obj, ino):
+    """
+    Returns the path of an inode relative to the target directory. Raises
+    ValueError if the name of the inode or of one of its parents could
+    designate a file outside of its directory ('.', '..', or a name holding
+    a '/').
+    """
+    names = []
+    while ino:
+        name = fs_obj.inode_name(ino)
+        if name in UNSAFE_NAMES or '/' in name or '\0' in name:
+            raise ValueError('unsafe file name in the image: %r' % name)
+        names.append(name)
+        ino = fs_obj.inode_parent(ino)
+    return os.path.join(*reversed(names)) if names else ''
+
+def target_path(target, path):
+    """
+    Returns the path of a relative path in the target directory. Raises
+    ValueError if it resolves (through symbolic links) to a path outside of
+    the target directory.
+    """
+    root = os.path.realpath(target)
+    full = os.path.join(target, path)
+    real = os.path.realpath(full)
+    if real != root and not real.startswith(os.path.join(root, '')):
+        raise ValueError('%s is outside of %s' % (full, target))
+    return full
+
+def plan_jobs(fs_obj):
+    """
+    Splits the data of all the files of a wiiod.wiiodfs.Filesystem into jobs
+    of at most one hash group. Returns a list of (first cluster, number of
+    clusters, pieces) tuples, each piece being a (relative path, position in
+    the file, position in the decrypted job data, length) tuple.
+    """
+    groups = {}
+    for ino in xrange(fs_obj.inode_count):
+        size = fs_obj.inode_size(ino)
+        if fs_obj.inode_isdir(ino) or not size:
+            continue
+
+        path = relative_path(fs_obj, ino)
+        offset = fs_obj.inode_offset(ino)
+        pos = 0
+        while pos < size:
+            group, group_off = divmod(offset + pos, GROUP_DATA_SIZE)
+            length = min(size - pos, GROUP_DATA_SIZE - group_off)
+            groups.setdefault(group, []).append((path, pos, group_off,
+                                                 length))
+            pos += length
+
+    jobs = []
+    for group in sorted(groups):
+        pieces = groups[group]
+        first = min(p[2] for p in pieces) / CLUSTER_DATA_SIZE
+        last = max(p[2] + p[3] - 1 for p in pieces) / CLUSTER_DATA_SIZE
+        start = first * CLUSTER_DATA_SIZE
+        pieces = [(path, pos, group_off - start, length)
+                  for path, pos, group_off, length in pieces]
+        jobs.append((group * CLUSTERS_PER_GROUP + first, last - first + 1,
+                     pieces))
+    return jobs
+
+def create_tree(fs_obj, target):
+    """
+    Creates the directories and the files of the filesystem in the target
+    directory, preallocating the files to their final size. Raises
+    ValueError if a name of the filesystem would create a file outside of
+    the target directory.
+    """
+    # All the names are checked before anything is created
+    paths = [relative_path(fs_obj, ino) for ino in xrange(fs_obj.inode_count)]
+    for ino, path in enumerate(paths):
+        path = target_path(target, path)
+        if fs_obj.inode_isdir(ino):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            continue
+
+        size = fs_obj.inode_size(ino)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_NOFOLLOW,
+                     0644)
+        try:
+            preallocate(fd, size)
+        finally:
+            os.close(fd)
+
+def _init_worker(image_path, backend, part_offset, aes_backend):
+    """
+    Opens the disc image and the partition in a worker process. Every
+    process needs its own file descriptor.
+    """
+    global _worker_part
+    crypto.set_default_backend(aes_backend)
+    disc_obj = disc.open_disc(image_path, backend, 'sequential')
+    infos = [p for p in disc_obj.partitions if p.offset == part_offset][0]
+
+    # Every cluster is read once: do not keep them around
+    _worker_part = partition.Partition(disc_obj, infos, cache.LRUCache(0))
+
+def _run_job(args):
+    """
+    Decrypts the clusters of a job and writes the pieces to the files.
+    Returns the number of bytes written.
+    """
+    target, first, count, pieces = args
+    data = ''.join(_worker_part.read_clusters(first, count))
+
+    written = 0
+    for path, pos, data_off, length in pieces:
+        fd = os.open(target_path(target, path), os.O_WRONLY | O_NOFOLLOW)
+        try:
+            os.lseek(fd, pos, os.SEEK_SET)
+            chunk = buffer(data, data_off, length)
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+        written += length
+    return written
+
+def extract(image_path, part_infos, target, processes=None, backend='auto',
+            progress=None, aes_backend=None):
+    """
+    Extracts the files of the partition described by part_infos (of type
+    wiiod.disc.PartitionInfos) to the target directory, using the given
+    number of worker processes (by default, one per CPU). Raises ValueError
+    if a file name of the partition is not safe (see relative_path) before
+    writing any file. progress is
+    called with the number of bytes written so far after each job. Clusters
+    are decrypted with the named wiiod.crypto backend, by default the
+    fastest available one. Returns the number of files and the number of
+    bytes extracted.
+    """
+    disc_obj = disc.open_disc(image_path, backend)
+    try:
+        part = partition.Partition(disc_obj, part_infos,
+                                   cipher=crypto.get_backend(aes_backend))
+        fs_obj = wiiodfs.Filesystem(part)
+        create_tree(fs_obj, target)
+        jobs = plan_jobs(fs_obj)
+        files = sum(1 for ino in xrange(fs_obj.inode_count)
+                    if not fs_obj.inode_isdir(ino))
+    finally:
+        disc_obj.close()
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (image_path, backend, part_infos.offset,
+                                 aes_backend))
+    try:
+        total = 0
+        jobs = [(target,) + job for job in jobs]
+        for written in pool.imap_unordered(_run_job, jobs):
+            total += written
+            if progress is not None:
+                progress(total)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return files, total
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extracts the files of a Wii optical disc image.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('target', help='directory to extract the files to')
+    parser.add_argument('part_index', nargs='?', type=int, default=0,
+                        help='game partition index (default: %(default)s)')
+    parser.add_argument('-j', '--processes', type=int, metavar='N',
+                        help='number of worker processes (default: number '
+                             'of CPUs)')
+    parser.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method (default: %(default)s)')
+    parser.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to decrypt the '
+                             'clusters (default: fastest available)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not display the progress')
+    args = parser.parse_args()
+
+    try:
+        crypto.set_default_backend(args.aes_backend)
+    except ImportError:
+        print '%s: AES backend not available: %s' % (sys.argv[0],
+                                                     args.aes_backend)
+        sys.exit(1)
+
+    try:
+        disc_obj = disc.open_disc(args.image, args.backend)
+    except (EnvironmentError, ValueError):
+        print '%s: cannot open disc image: %s' % (sys.argv[0], args.image)
+        sys.exit(1)
+    all_game_parts = [part for part in disc_obj.partitions
+                           if part.type == 0]
+    disc_obj.close()
+
+    if args.part_index >= len(all_game_parts) or args.part_index < 0:
+        print 'Invalid partition index (out of bounds)'
+        sys.exit(1)
+
+    if not os.path.isdir(args.target):
+        os.makedirs(args.target)
+
+    start = time.time()
+    def progress(total):
+        elapsed = time.time() - start
+        sys.stderr.write('\r%8.1f MB  %8.2f MB/s' % (
+            total / 1048576.0, total / 1048576.0 / max(elapsed, 1e-6)))
+
+    try:
+        files, total = extract(args.image, all_game_parts[args.part_index],
+                               args.target, args.processes, args.backend,
+                               None if args.quiet else progress,
+                               args.aes_backend)
+    except ValueError as e:
+        print '%s: cannot extract the files: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    elapsed = time.time() - start
+    if not args.quiet:
+        sys.stderr.write('\n')
+
+    print 'Extracted %d files (%.1f MB) in %.2f s: %.2f MB/s' % (
+        files, total / 1048576.0, elapsed,
+        total / 1048576.0 / max(elapsed, 1e-6))
@@ -25,8 +25,10 @@ from __future__ import absolute_import
 from fs.base import FS
 from fs.errors import UnsupportedError, ResourceInvalidError, \
                       ResourceNotFoundError
-from fs.path import normpath
+from fs.path import abspath, normpath
+from wiiod import stats
 
+import cStringIO
 import stat
 
 class WiiODFS(FS):
@@ -40,50 +42,99 @@ class WiiODFS(FS):
 
     def __init__(self, fs):
         """
-        Constructor which takes a wiiod.wiiodfs.Filesystem.
+        Constructor which takes a wiiod.wiiodfs.Filesystem. While the
+        statistics are enabled, they are readable from the virtual file
+        wiiod.stats.STATS_PATH.
         """
         self.fs = fs
 
     def close(self):
         pass
 
+    @stats.timed('fs.open')
     def open(self, path, mode="r", **kwargs):
         if '+' in mode or 'w' in mode or 'a' in mode:
             raise UnsupportedError("write access")
         path = normpath(path)
 
-        if not self.isfile(path):
-            if self.isdir(path):
-                raise ResourceInvalidError(path)
-            else:
-                raise ResourceNotFoundError(path)
+        virtual = self._virtual(path)
+        if virtual == stats.STATS_PATH:
+            return cStringIO.StringIO(stats.report())
+        elif virtual is not None:
+            raise ResourceInvalidError(path)
 
-        return self.fs.open(path)
+        try:
+            ino = self.fs.lookup(path)
+        except IOError:
+            raise ResourceNotFoundError(path)
+        if self.fs.inode_isdir(ino):
+            raise ResourceInvalidError(path)
+
+        return self.fs.open_inode(ino)
 
     def isfile(self, path):
-        return self.fs.isfile(normpath(path))
+        path = normpath(path)
+        virtual = self._virtual(path)
+        if virtual is not None:
+            return virtual == stats.STATS_PATH
+        return self.fs.isfile(path)
 
     def isdir(self, path):
-        return self.fs.isdir(normpath(path))
+        path = normpath(path)
+        virtual = self._virtual(path)
+        if virtual is not None:
+            return virtual == stats.STATS_DIR
+        return self.fs.isdir(path)
 
     def exists(self, path):
-        return self.fs.exists(normpath(path))
+        path = normpath(path)
+        return self._virtual(path) is not None or self.fs.exists(path)
 
+    @stats.timed('fs.listdir')
     def listdir(self, path="/", wildcard=None, full=False, absolute=False,
                 dirs_only=False, files_only=False):
         path = normpath(path)
-        if not self.fs.isdir(path):
+        virtual = self._virtual(path)
+        if virtual == stats.STATS_DIR:
+            paths = [stats.STATS_PATH.rsplit('/', 1)[1]]
+        elif virtual is not None or not self.fs.isdir(path):
             raise ResourceInvalidError(path, msg="not a directory")
-        paths = self.fs.listdir(path)
+        else:
+            paths = self.fs.listdir(path)
+            if stats.enabled and abspath(path) == '/':
+                paths.append(stats.STATS_DIR.lstrip('/'))
         return self._listdir_helper(path, paths, wildcard, full, absolute,
                                     dirs_only, files_only)
 
+    @stats.timed('fs.getinfo')
     def getinfo(self, path):
         path = normpath(path)
-        if self.fs.isdir(path):
+        virtual = self._virtual(path)
+        if virtual == stats.STATS_DIR:
             return { 'st_mode': 0555 | stat.S_IFDIR }
-        elif self.fs.isfile(path):
+        elif virtual == stats.STATS_PATH:
             return { 'st_mode': 0444 | stat.S_IFREG,
-                     'size': self.fs.getsize(path) }
-        else:
+                     'size': stats.report_size() }
+
+        try:
+            ino = self.fs.lookup(path)
+        except IOError:
             raise ResourceNotFoundError(path)
+
+        if self.fs.inode_isdir(ino):
+            return { 'st_mode': 0555 | stat.S_IFDIR, 'st_ino': ino }
+        else:
+            return { 'st_mode': 0444 | stat.S_IFREG, 'st_ino': ino,
+                     'size': self.fs.inode_size(ino) }
+
+    def _virtual(self, path):
+        """
+        Returns the absolute path of a virtual statistics file or directory,
+        or None for the other paths.
+        """
+        if not stats.enabled:
+            return None
+        path = abspath(path)
+        if path in (stats.STATS_DIR, stats.STATS_PATH):
+            return path
+        return None
@@ -0,0 +1,240 @@
+"""
+wiiod.fuseops
+~~~~~~~~~~~~~
+
+Direct FUSE adapter for wiiod.wiiodfs.Filesystem, using fusepy. Compared to
+exposing wiiod.fs.WiiODFS through PyFS, paths are resolved once per request,
+reads are served by offset without any file object, and the kernel is
+allowed to cache entries, attributes and file pages for a long time since
+the image is read-only.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from fuse import FUSE, FuseOSError, Operations
+from wiiod import stats
+
+import errno
+import itertools
+import os
+import stat
+import threading
+
+# FUSE reserves the inode number 0: inode numbers are shifted by one, so
+# that the root directory is inode 1 as usual
+INODE_OFFSET = 1
+
+# Entry and attribute cache timeouts (in seconds) and maximum read size
+DEFAULT_TIMEOUT = 24 * 60 * 60
+DEFAULT_MAX_READ = 1024 * 1024
+
+# Paths are passed as unicode strings by fusepy: latin-1 maps each byte of
+# the disc filenames to one character and back
+ENCODING = 'latin-1'
+
+# Block size reported by stat and statfs
+BLOCK_SIZE = 512
+
+# Inode numbers of the virtual statistics directory and file, above the
+# inode numbers of the filesystems
+STATS_DIR_INODE = 1 << 62
+STATS_INODE = STATS_DIR_INODE + 1
+
+class WiiODOperations(Operations):
+    """
+    fusepy operations exposing a wiiod.wiiodfs.Filesystem or a
+    wiiod.discfs.DiscFilesystem. Must be mounted with raw_fi (see mount).
+    While the statistics are enabled, they are readable from the virtual
+    file wiiod.stats.STATS_PATH.
+    """
+
+    def __init__(self, fs):
+        """
+        Constructor which takes a wiiod.wiiodfs.Filesystem or a
+        wiiod.discfs.DiscFilesystem.
+        """
+        self.fs = fs
+
+        # Files get the uid, gid and times of the image
+        st = fs.stat()
+        self._image_size = st.st_size
+        self._uid = st.st_uid
+        self._gid = st.st_gid
+        self._time = st.st_mtime
+
+        # Open files: handle -> (inode, readahead stream or None), or
+        # (STATS_INODE, statistics report) for the virtual file
+        self._files = {}
+        self._handles = itertools.count(1)
+        self._files_lock = threading.Lock()
+
+    @stats.timed('fuse.getattr')
+    def getattr(self, path, fh=None):
+        return self._attrs(self._lookup(path))
+
+    @stats.timed('fuse.readdir')
+    def readdir(self, path, fh):
+        ino = self._lookup(path)
+        if ino == STATS_DIR_INODE:
+            name = stats.STATS_PATH.rsplit('/', 1)[1].decode(ENCODING)
+            return ['.', '..', (name, self._attrs(STATS_INODE), 0)]
+        if not self._isdir(ino):
+            raise FuseOSError(errno.ENOTDIR)
+
+        # Attributes are returned with the names to save getattr calls
+        entries = ['.', '..']
+        for child in self.fs.inode_children(ino):
+            name = self.fs.inode_name(child).decode(ENCODING)
+            entries.append((name, self._attrs(child), 0))
+        if path == '/' and stats.enabled:
+            name = stats.STATS_DIR.lstrip('/').decode(ENCODING)
+            entries.append((name, self._attrs(STATS_DIR_INODE), 0))
+        return entries
+
+    @stats.timed('fuse.open')
+    def open(self, path, fi):
+        if fi.flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(errno.EROFS)
+        ino = self._lookup(path)
+        if self._isdir(ino):
+            raise FuseOSError(errno.EISDIR)
+
+        if ino == STATS_INODE:
+            # The report is built once per open and bypasses the kernel
+            # cache, so that each open gets fresh statistics
+            with self._files_lock:
+                fh = next(self._handles)
+                self._files[fh] = (ino, stats.report())
+            fi.fh = fh
+            fi.direct_io = 1
+            return 0
+
+        stream = self.fs.inode_readahead(ino)
+        with self._files_lock:
+            fh = next(self._handles)
+            self._files[fh] = (ino, stream)
+
+        fi.fh = fh
+        fi.keep_cache = 1
+        return 0
+
+    @stats.timed('fuse.read', len)
+    def read(self, path, size, offset, fi):
+        ino, stream = self._files[fi.fh]
+        if ino == STATS_INODE:
+            return stream[offset:offset + size]
+
+        file_size = self.fs.inode_size(ino)
+        if offset >= file_size:
+            return ''
+
+        size = min(size, file_size - offset)
+        if stream is not None:
+            stream.access(offset, size)
+        try:
+            return self.fs.inode_read(ino, offset, size)
+        except IOError as e:
+            raise FuseOSError(e.errno or errno.EIO)
+
+    def release(self, path, fi):
+        with self._files_lock:
+            ino, stream = self._files.pop(fi.fh)
+        if stream is not None and ino != STATS_INODE:
+            stream.cancel()
+        return 0
+
+    def statfs(self, path):
+        return {
+            'f_bsize': BLOCK_SIZE,
+            'f_frsize': BLOCK_SIZE,
+            'f_blocks': self._image_size / BLOCK_SIZE,
+            'f_bfree': 0,
+            'f_bavail': 0,
+            'f_files': self.fs.inode_count,
+            'f_ffree': 0,
+            'f_favail': 0,
+            'f_namemax': 255,
+        }
+
+    def access(self, path, amode):
+        self._lookup(path)
+        if amode & os.W_OK:
+            raise FuseOSError(errno.EROFS)
+        return 0
+
+    def _lookup(self, path):
+        """
+        Returns the inode of a path given by fusepy.
+        """
+        path = path.encode(ENCODING)
+        if stats.enabled:
+            if path == stats.STATS_DIR:
+                return STATS_DIR_INODE
+            elif path == stats.STATS_PATH:
+                return STATS_INODE
+        try:
+            return self.fs.lookup(path)
+        except IOError:
+            raise FuseOSError(errno.ENOENT)
+
+    def _isdir(self, ino):
+        """
+        Checks if an inode, possibly virtual, is a directory.
+        """
+        if ino == STATS_DIR_INODE:
+            return True
+        elif ino == STATS_INODE:
+            return False
+        return self.fs.inode_isdir(ino)
+
+    def _attrs(self, ino):
+        """
+        Returns the stat dictionary of an inode.
+        """
+        attrs = {
+            'st_ino': ino + INODE_OFFSET,
+            'st_uid': self._uid,
+            'st_gid': self._gid,
+            'st_atime': self._time,
+            'st_mtime': self._time,
+            'st_ctime': self._time,
+        }
+        if self._isdir(ino):
+            attrs['st_mode'] = 0555 | stat.S_IFDIR
+            attrs['st_nlink'] = 2
+        else:
+            if ino == STATS_INODE:
+                size = stats.report_size()
+            else:
+                size = self.fs.inode_size(ino)
+            attrs['st_mode'] = 0444 | stat.S_IFREG
+            attrs['st_nlink'] = 1
+            attrs['st_size'] = size
+            attrs['st_blocks'] = (size + BLOCK_SIZE - 1) / BLOCK_SIZE
+        return attrs
+
+def mount(fs, mount_point, foreground=True, nothreads=True,
+          timeout=DEFAULT_TIMEOUT, max_read=DEFAULT_MAX_READ):
+    """
+    Mounts a wiiod.wiiodfs.Filesystem (or wiiod.discfs.DiscFilesystem)
+    read-only on mount_point, with the given entry and attribute cache
+    timeout (in seconds) and maximum read size. Returns when the filesystem
+    is unmounted.
+    """
+    FUSE(WiiODOperations(fs), mount_point, raw_fi=True, encoding=ENCODING,
+         foreground=foreground, nothreads=nothreads, ro=True, use_ino=True,
+         kernel_cache=True, entry_timeout=timeout, attr_timeout=timeout,
+         negative_timeout=timeout, max_read=max_read, fsname='wiiodfs',
+         subtype='wiiodfs')
@@ -0,0 +1,287 @@
+"""
+wiiod.httpd
+~~~~~~~~~~~
+
+HTTP server exposing a wiiod.wiiodfs.Filesystem (or any filesystem with the
+same interface) without FUSE: directories are served as HTML listings and
+files with support for byte range requests, which are read directly at the
+requested offset of the partition. Connections are kept alive and every
+client is served by its own thread, all of them sharing the filesystem, so
+one disc handle and one clusters cache.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import entry, stats, wiiodfs
+
+import argparse
+import BaseHTTPServer
+import cgi
+import posixpath
+import re
+import SocketServer
+import sys
+import urllib
+import urlparse
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+
+# Size of the reads of the partition while sending a file
+DEFAULT_CHUNK_SIZE = wiiodfs.DEFAULT_CHUNK_SIZE
+
+# Single byte range: first-last, first- or -suffix length
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    Parses a Range header for a file of the given size. Returns None to
+    serve the whole file (no header, or a form not supported like multiple
+    ranges), the (first, last) byte positions of the range, or False if the
+    range cannot be satisfied.
+    """
+    if header is None:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    # No byte of an empty file can be selected, not even by a suffix range
+    if not size:
+        return False
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the files and the directories of the filesystem of the server.
+    While the statistics are enabled, they are served at
+    wiiod.stats.STATS_PATH.
+    """
+
+    server_version = 'wiiodfs/0.1'
+    protocol_version = 'HTTP/1.1'
+
+    # Headers are buffered and sent with the start of the body
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    @stats.timed('http.get')
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def _serve(self, send_body):
+        """
+        Answers a GET (or HEAD, without the body) request.
+        """
+        path = urllib.unquote(urlparse.urlsplit(self.path).path)
+        path = posixpath.normpath(path)
+        if path.startswith('//'):
+            path = path[1:]
+
+        if stats.enabled and path == stats.STATS_PATH:
+            report = stats.report().rstrip() + '\n'
+            self._send_data(report, 'application/json', send_body)
+            return
+
+        fs_obj = self.server.fs
+        try:
+            ino = fs_obj.lookup(path)
+        except IOError:
+            self.send_error(404)
+            return
+
+        if fs_obj.inode_isdir(ino):
+            if not self.path.split('?', 1)[0].endswith('/'):
+                self._redirect(path.rstrip('/') + '/')
+            else:
+                self._send_listing(ino, path, send_body)
+        else:
+            self._send_file(ino, send_body)
+
+    def _send_file(self, ino, send_body):
+        """
+        Sends the content of a file inode, or the requested range of it.
+        """
+        fs_obj = self.server.fs
+        size = fs_obj.inode_size(ino)
+        byte_range = parse_range(self.headers.getheader('Range'), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            first, last = 0, size - 1
+            self.send_response(200)
+        else:
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                first, last, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified',
+                         self.date_time_string(self.server.mtime))
+        self.end_headers()
+        if not send_body or last < first:
+            return
+
+        # Ranges spanning several chunks are read ahead like sequential files
+        stream = None
+        if last - first >= self.server.chunk_size:
+            stream = fs_obj.inode_readahead(ino)
+        try:
+            pos = first
+            while pos <= last:
+                length = min(self.server.chunk_size, last - pos + 1)
+                if stream is not None:
+                    stream.access(pos, length)
+                data = fs_obj.inode_read(ino, pos, length)
+                self.wfile.write(data)
+                pos += length
+        except IOError as e:
+            # The headers are sent: the only way to report the error is to
+            # close the connection before the end of the body
+            self.log_error('cannot read %s: %s', self.path, e)
+            self.close_connection = 1
+        finally:
+            if stream is not None:
+                stream.cancel()
+
+    def _send_listing(self, ino, path, send_body):
+        """
+        Sends the HTML listing of a directory inode.
+        """
+        fs_obj = self.server.fs
+        names = sorted(fs_obj.inode_name(child) + (
+                           '/' if fs_obj.inode_isdir(child) else '')
+                       for child in fs_obj.inode_children(ino))
+        if path == '/' and stats.enabled:
+            names.append(stats.STATS_PATH.lstrip('/'))
+
+        title = cgi.escape(path)
+        lines = ['<!DOCTYPE html>',
+                 '<html><head><title>%s</title></head><body>' % title,
+                 '<h1>%s</h1>' % title, '<ul>']
+        if path != '/':
+            lines.append('<li><a href="../">../</a></li>')
+        for name in names:
+            lines.append('<li><a href="%s">%s</a></li>' % (
+                urllib.quote(name), cgi.escape(name)))
+        lines.append('</ul></body></html>\n')
+        self._send_data('\n'.join(lines), 'text/html', send_body)
+
+    def _send_data(self, data, content_type, send_body):
+        """
+        Sends a complete response made of the given data.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def _redirect(self, location):
+        self.send_response(301)
+        self.send_header('Location', urllib.quote(location))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server of a filesystem with the interface of
+    wiiod.wiiodfs.Filesystem.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fs, address=(DEFAULT_HOST, DEFAULT_PORT),
+                 chunk_size=DEFAULT_CHUNK_SIZE, verbose=False):
+        """
+        Creates a server of the given filesystem listening on address (a
+        (host, port) tuple, port 0 picks a free port). Files are read by
+        chunks of chunk_size bytes. With verbose, requests are logged to
+        the standard error.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.fs = fs
+        self.mtime = fs.stat().st_mtime
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves the files of a Wii optical disc image over '
+                    'HTTP.')
+    parser.add_argument('image', help='path to the disc image (or to the '
+                                      'images directory with --library)')
+    parser.add_argument('part_index', nargs='?', help='game partition index')
+    entry.add_filesystem_arguments(parser)
+    parser.add_argument('-H', '--host', default=DEFAULT_HOST,
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('-t', '--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+
+    fs_obj, loaded_partitions = entry.open_filesystem(args)
+    try:
+        server = HTTPServer(fs_obj, (args.host, args.port),
+                            verbose=args.verbose)
+    except EnvironmentError as e:
+        print '%s: cannot listen on %s:%d: %s' % (sys.argv[0], args.host,
+                                                  args.port, e)
+        sys.exit(1)
+
+    print 'Serving on http://%s:%d/' % server.server_address[:2]
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for part in loaded_partitions():
+            if part.persistent_cache is not None:
+                part.persistent_cache.close()
@@ -0,0 +1,381 @@
+"""
+wiiod.library
+~~~~~~~~~~~~~
+
+Filesystem of a directory of disc images: every image is a top-level
+directory holding the filesystem of its game partition (or of all its
+partitions). Images are only opened when they are first accessed, and at
+most a given number of them are kept open: the least recently used ones are
+closed when more images are opened (or as soon as the reads and the files
+still using them end). All the images share one decrypted clusters cache,
+where an image opened again finds the clusters it left, so the memory and
+file descriptors used only depend on the images being accessed, not on the
+size of the library.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import disc, discfs, partition, wiiodfs
+from wiiod.cache import LRUCache
+
+import collections
+import errno
+import os
+import os.path
+import struct
+import threading
+
+# File extensions of the disc images of a library
+IMAGE_EXTENSIONS = ('.iso', '.ciso', '.wbfs')
+
+# Default number of images kept open
+DEFAULT_MAX_OPEN = 16
+
+# Inode numbers are made of the image number + 1 in the high bits and of the
+# inode number in the image filesystem in the low bits, which can hold the
+# inode numbers of a wiiod.discfs.DiscFilesystem
+IMAGE_SHIFT = 32
+
+def scan(directory):
+    """
+    Returns the sorted list of (name, path) of the disc images of a
+    directory. Images are named after their file name without its
+    extension, unless several images have the same name.
+    """
+    paths = []
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in IMAGE_EXTENSIONS and os.path.isfile(path):
+            paths.append((os.path.splitext(filename)[0], filename, path))
+
+    names = collections.Counter(name for name, _, _ in paths)
+    return [(name if names[name] == 1 else filename, path)
+            for name, filename, path in paths]
+
+class _PinnedFile(object):
+    """
+    File object of an image of a library, which keeps the image open until
+    it is closed.
+    """
+
+    def __init__(self, library, fs_obj, fp):
+        self._library = library
+        self._fs = fs_obj
+        self._fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def close(self):
+        fs_obj, self._fs = self._fs, None
+        self._fp.close()
+        if fs_obj is not None:
+            self._library._unpin(fs_obj)
+
+class _PinnedStream(object):
+    """
+    wiiod.readahead.ReadaheadStream of a file of an image of a library,
+    which keeps the image open until it is cancelled.
+    """
+
+    def __init__(self, library, fs_obj, stream):
+        self._library = library
+        self._fs = fs_obj
+        self._stream = stream
+
+    def access(self, pos, size):
+        self._stream.access(pos, size)
+
+    def cancel(self):
+        fs_obj, self._fs = self._fs, None
+        self._stream.cancel()
+        if fs_obj is not None:
+            self._library._unpin(fs_obj)
+
+class LibraryFilesystem(discfs.CompositeFilesystem):
+    """
+    Filesystem of a directory of disc images, with the same interface as
+    wiiod.wiiodfs.Filesystem.
+    """
+
+    CHILD_SHIFT = IMAGE_SHIFT
+
+    def __init__(self, directory, make_partition=None, index_dir=None,
+                 max_open=DEFAULT_MAX_OPEN, all_partitions=False,
+                 backend='auto'):
+        """
+        Creates the filesystem of the images of a directory (see scan),
+        keeping at most max_open of them open. Images are opened with the
+        given wiiod.disc backend. make_partition is called with the
+        wiiod.disc.Disc and the wiiod.disc.PartitionInfos of each partition
+        opened and returns the wiiod.partition.Partition to use; by default,
+        all the partitions share a new LRU cache. index_dir is passed to the
+        partition filesystems (see wiiod.wiiodfs.Filesystem). With
+        all_partitions, every partition of the images is exposed (see
+        wiiod.discfs.DiscFilesystem), otherwise only the first game
+        partition.
+        """
+        self.directory = directory
+        self.index_dir = index_dir
+        self.max_open = max_open
+        self.all_partitions = all_partitions
+        self.backend = backend
+
+        if make_partition is None:
+            shared_cache = LRUCache()
+            make_partition = lambda disc_obj, infos: partition.Partition(
+                disc_obj, infos, shared_cache)
+        self._make_partition = make_partition
+
+        images = scan(directory)
+        self.paths = [path for _, path in images]
+        super(LibraryFilesystem, self).__init__([name for name, _ in images])
+
+        # Open images, least recently used first. Images are pinned while
+        # they are read or have open files: evicted images which are still
+        # pinned are closed when they are unpinned.
+        self._open = collections.OrderedDict()
+        self._pins = {}
+        self._evicted = {}
+        self._lock = threading.Lock()
+        self._image_locks = [threading.Lock() for _ in self.paths]
+
+        self.opens = 0
+        self.evictions = 0
+
+    def filesystem(self, number):
+        """
+        Returns the filesystem of an image, opening the image if it is not
+        open. The least recently used images are closed when more than
+        max_open images are open.
+        """
+        return self._get(number, False)
+
+    # The operations which may read the image (file data, or the filesystem
+    # of a partition opened lazily) pin it while they run
+
+    def lookup(self, path):
+        name, _, rest = path.strip('/').partition('/')
+        number = self._numbers.get(name)
+        if number is None or not rest:
+            return super(LibraryFilesystem, self).lookup(path)
+
+        fs_obj = self._get(number, True)
+        try:
+            return self._inode(number, fs_obj.lookup(rest))
+        finally:
+            self._unpin(fs_obj)
+
+    def inode_children(self, ino):
+        if ino == discfs.ROOT_INODE:
+            return super(LibraryFilesystem, self).inode_children(ino)
+
+        fs_obj, sub_ino = self._split_pinned(ino)
+        try:
+            children = list(fs_obj.inode_children(sub_ino))
+        finally:
+            self._unpin(fs_obj)
+        return iter([(ino & ~self._child_mask) | child
+                     for child in children])
+
+    def open_inode(self, ino):
+        fs_obj, sub_ino = self._split_pinned(ino)
+        try:
+            fp = fs_obj.open_inode(sub_ino)
+        except:
+            self._unpin(fs_obj)
+            raise
+        return _PinnedFile(self, fs_obj, fp)
+
+    def inode_read(self, ino, offset, size):
+        fs_obj, sub_ino = self._split_pinned(ino)
+        try:
+            return fs_obj.inode_read(sub_ino, offset, size)
+        finally:
+            self._unpin(fs_obj)
+
+    def inode_readahead(self, ino):
+        fs_obj, sub_ino = self._split_pinned(ino)
+        try:
+            stream = fs_obj.inode_readahead(sub_ino)
+        except:
+            self._unpin(fs_obj)
+            raise
+        if stream is None:
+            self._unpin(fs_obj)
+            return None
+        return _PinnedStream(self, fs_obj, stream)
+
+    def _split_pinned(self, ino):
+        """
+        Returns the filesystem of the image of an inode, pinned (see
+        _unpin), and the inode number in this filesystem.
+        """
+        number = (ino >> self.CHILD_SHIFT) - 1
+        if not 0 <= number < len(self.names):
+            raise IOError("invalid inode number")
+        return self._get(number, True), ino & self._child_mask
+
+    def _get(self, number, pin):
+        """
+        Returns the filesystem of an image (see filesystem). With pin, the
+        image is not closed before _unpin is called.
+        """
+        with self._lock:
+            fs_obj = self._open.pop(number, None)
+            if fs_obj is not None:
+                self._open[number] = fs_obj
+                if pin:
+                    self._pins[fs_obj] = self._pins.get(fs_obj, 0) + 1
+                return fs_obj
+
+        # Only one thread opens a given image, other images can be opened
+        # meanwhile. An evicted image which is still pinned is used again
+        # instead of opening the image a second time.
+        with self._image_locks[number]:
+            with self._lock:
+                fs_obj = (self._open.get(number) or
+                          self._evicted.pop(number, None))
+            opened = fs_obj is None
+            if opened:
+                fs_obj = self._open_image(number)
+
+            closed = []
+            with self._lock:
+                if opened:
+                    self.opens += 1
+                self._open.pop(number, None)
+                self._open[number] = fs_obj
+                if pin:
+                    self._pins[fs_obj] = self._pins.get(fs_obj, 0) + 1
+                while len(self._open) > self.max_open:
+                    old_number, old = self._open.popitem(last=False)
+                    self.evictions += 1
+                    if old in self._pins:
+                        self._evicted[old_number] = old
+                    else:
+                        closed.append(old)
+            for old in closed:
+                self._close_image(old)
+        return fs_obj
+
+    def _unpin(self, fs_obj):
+        """
+        Releases a pin of the filesystem of an image, closing the image if
+        it was evicted and this was its last pin.
+        """
+        with self._lock:
+            pins = self._pins[fs_obj] - 1
+            if pins:
+                self._pins[fs_obj] = pins
+                return
+            del self._pins[fs_obj]
+            numbers = [number for number, evicted in self._evicted.iteritems()
+                       if evicted is fs_obj]
+            if not numbers:
+                return
+            del self._evicted[numbers[0]]
+        self._close_image(fs_obj)
+
+    def loaded_filesystems(self):
+        with self._lock:
+            return self._open.values()
+
+    def loaded_partitions(self):
+        """
+        Returns the list of the partitions of the open images.
+        """
+        parts = []
+        for fs_obj in self.loaded_filesystems():
+            parts.extend(self._partitions(fs_obj))
+        return parts
+
+    def close(self):
+        """
+        Closes all the open images.
+        """
+        with self._lock:
+            open_fs = self._open.values() + self._evicted.values()
+            self._open.clear()
+            self._evicted.clear()
+        for fs_obj in open_fs:
+            self._close_image(fs_obj)
+
+    def stat(self):
+        return os.stat(self.directory)
+
+    def stats(self):
+        """
+        Returns a dictionary of the library usage statistics.
+        """
+        return {
+            'images': len(self.names),
+            'open': len(self._open),
+            'max_open': self.max_open,
+            'opens': self.opens,
+            'evictions': self.evictions,
+        }
+
+    @staticmethod
+    def _partitions(fs_obj):
+        """
+        Returns the list of the partitions opened in the filesystem of an
+        image.
+        """
+        if isinstance(fs_obj, discfs.DiscFilesystem):
+            return fs_obj.loaded_partitions()
+        return [fs_obj.part]
+
+    def _close_image(self, fs_obj):
+        """
+        Closes the persistent caches of the partitions of an image and its
+        disc image file.
+        """
+        for part in self._partitions(fs_obj):
+            if part.persistent_cache is not None:
+                part.persistent_cache.close()
+                part.persistent_cache = None
+        fs_obj.disc.close()
+
+    def _open_image(self, number):
+        """
+        Opens an image and returns its filesystem. Raises IOError if the
+        image cannot be read.
+        """
+        path = self.paths[number]
+        try:
+            disc_obj = disc.open_disc(path, self.backend, 'random')
+        except (EnvironmentError, ValueError, struct.error) as e:
+            raise IOError(errno.EIO, "cannot open disc image %s: %s" % (
+                path, e))
+
+        factory = self._make_partition
+        make_partition = lambda infos: factory(disc_obj, infos)
+        try:
+            if self.all_partitions:
+                return discfs.DiscFilesystem(disc_obj, make_partition,
+                                             self.index_dir)
+
+            game_parts = [infos for infos in disc_obj.partitions
+                          if infos.type == 0]
+            if not game_parts:
+                raise IOError(errno.EIO, "no game partition")
+            return wiiodfs.Filesystem(make_partition(game_parts[0]),
+                                      self.index_dir)
+        except (EnvironmentError, ValueError, struct.error) as e:
+            disc_obj.close()
+            raise IOError(errno.EIO, "cannot read disc image %s: %s" % (
+                path, e))
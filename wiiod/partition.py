@@ -20,14 +20,20 @@ You should have received a copy of the GNU General Public License along with
 wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from Crypto.Cipher import AES
+from wiiod import crypto, stats
+from wiiod.cache import LRUCache
 
-import collections
+import errno
+import hashlib
+import itertools
+import stat
 import struct
+import threading
 
 # Some magic locations :)
 TITLE_KEY_OFFSET = 0x1BF
 TITLE_ID_OFFSET = 0x1DC
+H3_OFFSET_OFFSET = 0x2B4
 DATA_START_OFFSET = 0x2B8
 DATA_SIZE_OFFSET = 0x2BC
 
@@ -41,38 +47,135 @@ MASTER_KEY_KOREAN = ("\x63\xb8\x2b\xb4\xf4\x61\x4e\x2e"
 CLUSTER_SIZE = 0x8000
 CLUSTER_DATA_SIZE = 0x7C00
 
-# Number of decrypted clusters stored in the LRU cache
-CLUSTER_CACHE_SIZE = 128
-
-# Decorator implementing an LRU cache, a-la-functools.lru_cache
-def lru_cached(cache_size):
-    def decorator(wrapped):
-        cache = collections.OrderedDict()
-        def wrapper(self, idx):
-            try:
-                result = cache[idx]
-                del cache[idx]
-                cache[idx] = result
-            except KeyError:
-                result = wrapped(self, idx)
-                cache[idx] = result
-                if len(cache) > cache_size:
-                    cache.popitem(0)
-            return result
-        return wrapper
-    return decorator
+# Number of clusters in a hash group (2MB of raw data)
+CLUSTERS_PER_GROUP = 64
+
+# Hash tree: the hash block of each cluster holds the SHA-1 of its 31 data
+# blocks (H0), of the H0 tables of the 8 clusters of its subgroup (H1) and of
+# the H1 tables of the 8 subgroups of its group (H2). The H3 table, stored
+# outside of the data, holds the SHA-1 of the H2 table of each group.
+HASH_BLOCK_SIZE = 0x400
+DATA_BLOCK_SIZE = 0x400
+H0_OFFSET, H0_SIZE = 0x000, 31 * 20
+H1_OFFSET, H1_SIZE = 0x280, 8 * 20
+H2_OFFSET, H2_SIZE = 0x340, 8 * 20
+H3_TABLE_SIZE = 0x18000
+
+# Unique identifiers used to build the cache keys of each partition, and
+# identifiers already given to the partitions of image files
+_partition_ids = itertools.count()
+_image_partition_ids = {}
+_ids_lock = threading.Lock()
+
+class IntegrityError(IOError):
+    """
+    Raised when a cluster does not match the hash tree of its partition.
+    """
+
+    def __init__(self, cluster, level):
+        IOError.__init__(self, errno.EIO, "cluster %d does not match its %s "
+                                          "hash" % (cluster, level))
+        self.cluster = cluster
+        self.level = level
+
+class _PendingCluster(object):
+    """
+    Cluster being decrypted by a thread, which other threads can wait for.
+    """
+
+    def __init__(self):
+        self.data = None
+        self._event = threading.Event()
+
+    def done(self, data):
+        self.data = data
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+        return self.data
 
 class Partition(object):
-    def __init__(self, disc, part_infos):
+    def __init__(self, disc, part_infos, cache=None, readahead=None,
+                 cipher=None, verify=False):
         """
         Initializes a partition object from a wiiod.disc.Disc and partition
-        informations (of type wiiod.disc.PartitionInfos).
+        informations (of type wiiod.disc.PartitionInfos). Decrypted clusters
+        are stored in the provided wiiod.cache.ClusterCache, which may be
+        shared with other partitions, or in a new private cache. Files read
+        sequentially are prefetched using the optional
+        wiiod.readahead.Readahead pool. Clusters are decrypted with the
+        given wiiod.crypto backend, or with the default one. In verify
+        mode, clusters are checked against the hash tree when they are
+        decrypted, and IntegrityError is raised for corrupted clusters.
+        Clusters found in the persistent cache are not checked again.
+
+        Images with the encryption disabled in their header (for example
+        written by wiiod.export) store the clusters in clear: they are read
+        without any decryption.
         """
         self.disc = disc
         self.disc_infos = part_infos
+        self.cipher = cipher if cipher is not None else crypto.get_backend()
+        self.encrypted = not disc.metadata.disable_encryption
+
+        self.cache = cache if cache is not None else LRUCache()
+        self._cache_id = self._new_cache_id()
+
+        # Clusters being decrypted, by index
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        self.readahead = readahead
+
+        # Optional wiiod.diskcache.PersistentCache used on cache misses
+        self.persistent_cache = None
+
+        self.verify = verify
+        self._h3_table = None
 
         self._read_header()
 
+        # Bitmap of the clusters which already passed the hash checks
+        self._verified = bytearray((self.data_size / CLUSTER_SIZE + 7) / 8)
+
+    def unique_name(self):
+        """
+        Returns a name identifying this partition of this disc, made of the
+        disc ID, disc number, disc version and partition offset. Used to name
+        the on-disk caches.
+        """
+        meta = self.disc.metadata
+        return '%s%s%s%s-%d-%d-%x' % (meta.disc_id, meta.game_code,
+                                      meta.region_code, meta.maker_code,
+                                      meta.disc_number, meta.disc_version,
+                                      self.disc_infos.offset)
+
+    def _new_cache_id(self):
+        """
+        Returns the identifier of the partition in the keys of the cluster
+        cache. The partitions of regular image files get the same identifier
+        each time they are opened while the file (its device and inode
+        numbers), its size and its modification time do not change, so that
+        an image opened again (see wiiod.library) finds its clusters in a
+        shared cache. File names are not used: file objects opened from a
+        descriptor all have the same one.
+        """
+        try:
+            st = self.disc.stat()
+        except (AttributeError, EnvironmentError):
+            return next(_partition_ids)
+        if not stat.S_ISREG(st.st_mode):
+            return next(_partition_ids)
+
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+               self.disc_infos.offset)
+        with _ids_lock:
+            cache_id = _image_partition_ids.get(key)
+            if cache_id is None:
+                cache_id = _image_partition_ids[key] = next(_partition_ids)
+        return cache_id
+
     def read_raw(self, offset, size):
         """
         Read raw non-decrypted data relative to the partition start.
@@ -83,31 +186,276 @@ class Partition(object):
         """
         Reads decrypted data from the partition.
         """
-        data = ''
-        while size > 0:
-            cluster_data = self.read_cluster(offset / CLUSTER_DATA_SIZE)
+        chunks = [cluster_data[start_off:end_off] for cluster_data, start_off,
+                  end_off in self._cluster_slices(offset, size)]
+        return chunks[0] if len(chunks) == 1 else ''.join(chunks)
 
-            start_off = offset % CLUSTER_DATA_SIZE
-            last_off = min(start_off + size, CLUSTER_DATA_SIZE)
-            read_size = last_off - start_off
+    def readinto(self, offset, buf):
+        """
+        Reads decrypted data from the partition into a writable buffer
+        (bytearray or memoryview), filling it entirely. Cached clusters are
+        copied straight into the buffer without intermediate strings.
+        """
+        view = memoryview(buf)
+        size = len(view)
+        pos = 0
+        for cluster_data, start_off, end_off in self._cluster_slices(offset,
+                                                                     size):
+            read_size = end_off - start_off
+            view[pos:pos + read_size] = \
+                memoryview(cluster_data)[start_off:end_off]
+            pos += read_size
+        return size
 
-            data += cluster_data[start_off:last_off]
+    def read_cluster(self, idx):
+        """
+        Reads a decrypted data cluster, from the cache if possible.
+        """
+        return self.read_clusters(idx, 1)[0]
 
-            offset += read_size
-            size -= read_size
-        return data
+    @stats.timed('partition.read_clusters',
+                 lambda clusters: len(clusters) * CLUSTER_DATA_SIZE)
+    def read_clusters(self, first, count):
+        """
+        Reads a list of consecutive decrypted data clusters, from the cache
+        if possible.
+        """
+        keys = [(self._cache_id, idx) for idx in xrange(first, first + count)]
+        clusters = [self.cache.get(key) for key in keys]
+        self._fill_clusters(first, keys, clusters)
+        return clusters
 
-    @lru_cached(cache_size=CLUSTER_CACHE_SIZE)
-    def read_cluster(self, idx):
+    def load_clusters(self, first, count):
+        """
+        Makes sure consecutive clusters are in the cache, decrypting the
+        missing ones. Used for prefetching: cache statistics are not updated.
         """
-        Reads and decrypts a data cluster from the disc. Will often be
-        cached to avoid redecrypting.
+        keys = [(self._cache_id, idx) for idx in xrange(first, first + count)]
+        clusters = [True if key in self.cache else None for key in keys]
+        self._fill_clusters(first, keys, clusters)
+
+    def _fill_clusters(self, first, keys, clusters):
         """
-        raw_cluster = self.read_raw(self.data_start + idx * CLUSTER_SIZE,
-                                    CLUSTER_SIZE)
-        iv = raw_cluster[0x3D0:0x3E0]
-        aes = AES.new(self.decryption_key, AES.MODE_CBC, iv)
-        return aes.decrypt(raw_cluster[0x400:])
+        Replaces the None items of the clusters list by decrypted clusters,
+        reading each run of missing clusters from the disc in one request
+        (bounded by the hash group), and adds them to the cache. Clusters
+        found in the persistent cache are not decrypted, and clusters already
+        being decrypted by another thread are waited for instead of being
+        decrypted twice.
+        """
+        count = len(clusters)
+        owned = [False] * count
+        waiting = []
+        with self._inflight_lock:
+            for i in xrange(count):
+                if clusters[i] is not None:
+                    continue
+                pending = self._inflight.get(first + i)
+                if pending is None:
+                    self._inflight[first + i] = _PendingCluster()
+                    owned[i] = True
+                else:
+                    waiting.append((i, pending))
+
+        try:
+            persistent = self.persistent_cache
+            if persistent is not None:
+                for i in xrange(count):
+                    if owned[i]:
+                        data = persistent.get(first + i)
+                        if data is not None:
+                            clusters[i] = data
+                            self.cache.put(keys[i], data)
+
+            i = 0
+            while i < count:
+                if not owned[i] or clusters[i] is not None:
+                    i += 1
+                    continue
+
+                # Extend the run up to the next cluster we do not have to
+                # decrypt or to the group boundary
+                j = i + 1
+                while (j < count and owned[j] and clusters[j] is None and
+                       (first + j) % CLUSTERS_PER_GROUP != 0):
+                    j += 1
+
+                decrypted = self.decrypt_clusters(first + i, j - i)
+                for k, data in enumerate(decrypted, i):
+                    clusters[k] = data
+                    self.cache.put(keys[k], data)
+                    if persistent is not None:
+                        persistent.put(first + k, data)
+                i = j
+        finally:
+            with self._inflight_lock:
+                for i in xrange(count):
+                    if owned[i]:
+                        self._inflight.pop(first + i).done(clusters[i])
+
+        for i, pending in waiting:
+            data = pending.wait()
+            if data is None:
+                # The other thread failed: try again to get the error
+                data = self.decrypt_cluster(first + i)
+            clusters[i] = data
+
+    def decrypt_cluster(self, idx):
+        """
+        Reads and decrypts a data cluster from the disc, bypassing the cache.
+        """
+        return self.decrypt_clusters(idx, 1)[0]
+
+    @stats.timed('partition.decrypt_clusters',
+                 lambda clusters: len(clusters) * CLUSTER_DATA_SIZE)
+    def decrypt_clusters(self, first, count):
+        """
+        Reads consecutive data clusters from the disc with a single request
+        and decrypts them, bypassing the cache.
+        """
+        raw = self._read_raw_clusters(first, count)
+        if self.encrypted:
+            key = self.decryption_key
+            decrypt = self.cipher.cbc_decrypt
+            clusters = [decrypt(key, raw[off + 0x3D0:off + 0x3E0],
+                                raw[off + HASH_BLOCK_SIZE:off + CLUSTER_SIZE])
+                        for off in xrange(0, len(raw), CLUSTER_SIZE)]
+        else:
+            clusters = [raw[off + HASH_BLOCK_SIZE:off + CLUSTER_SIZE]
+                        for off in xrange(0, len(raw), CLUSTER_SIZE)]
+
+        if self.verify:
+            for i, data in enumerate(clusters):
+                idx = first + i
+                if self._verified[idx >> 3] & (1 << (idx & 7)):
+                    continue
+                hashes = self._hash_block(raw, i * CLUSTER_SIZE)
+                level = self._check_hashes(idx, hashes, data)
+                if level is not None:
+                    raise IntegrityError(idx, level)
+        return clusters
+
+    def check_clusters(self, first, count):
+        """
+        Reads consecutive data clusters from the disc and checks them against
+        the hash tree, bypassing the cache. Returns the list of (cluster
+        index, hash level) tuples of the corrupted clusters, the hash level
+        being the first one ('H0' to 'H3') which does not match.
+        """
+        raw = self._read_raw_clusters(first, count)
+        errors = []
+        for i, cluster in enumerate(self._split_clusters(raw)):
+            level = self._check_hashes(first + i, cluster[:HASH_BLOCK_SIZE],
+                                       cluster[HASH_BLOCK_SIZE:])
+            if level is not None:
+                errors.append((first + i, level))
+        return errors
+
+    def plain_clusters(self, first, count):
+        """
+        Reads consecutive clusters from the disc and returns them with their
+        hash block and their data decrypted, as stored in images with the
+        encryption disabled.
+        """
+        raw = self._read_raw_clusters(first, count)
+        if not self.encrypted:
+            return raw
+        return ''.join(self._split_clusters(raw))
+
+    def _split_clusters(self, raw):
+        """
+        Returns the list of the clusters of raw, with their hash block and
+        their data decrypted.
+        """
+        if not self.encrypted:
+            return [raw[off:off + CLUSTER_SIZE]
+                    for off in xrange(0, len(raw), CLUSTER_SIZE)]
+
+        key = self.decryption_key
+        decrypt = self.cipher.cbc_decrypt
+        return [self._hash_block(raw, off) +
+                decrypt(key, raw[off + 0x3D0:off + 0x3E0],
+                        raw[off + HASH_BLOCK_SIZE:off + CLUSTER_SIZE])
+                for off in xrange(0, len(raw), CLUSTER_SIZE)]
+
+    def _hash_block(self, raw, off):
+        """
+        Returns the decrypted hash block of the raw cluster at off in raw.
+        """
+        hashes = raw[off:off + HASH_BLOCK_SIZE]
+        if self.encrypted:
+            hashes = self.cipher.cbc_decrypt(self.decryption_key, '\0' * 16,
+                                             hashes)
+        return hashes
+
+    def _read_raw_clusters(self, first, count):
+        """
+        Reads consecutive raw clusters from the disc with a single request.
+        """
+        raw = self.read_raw(self.data_start + first * CLUSTER_SIZE,
+                            count * CLUSTER_SIZE)
+        if len(raw) != count * CLUSTER_SIZE:
+            raise IOError("cluster %d is past the end of the disc image"
+                          % (first + len(raw) / CLUSTER_SIZE))
+        return raw
+
+    def _check_hashes(self, idx, hashes, data):
+        """
+        Checks the decrypted data of a cluster against its decrypted hash
+        block and against the H3 table. Returns the first hash level which
+        does not match, or None. Clusters passing the checks are marked as
+        verified.
+        """
+
+        sha1 = hashlib.sha1
+        for i in xrange(CLUSTER_DATA_SIZE / DATA_BLOCK_SIZE):
+            block = buffer(data, i * DATA_BLOCK_SIZE, DATA_BLOCK_SIZE)
+            if sha1(block).digest() != hashes[i * 20:i * 20 + 20]:
+                return 'H0'
+
+        h0 = hashes[H0_OFFSET:H0_OFFSET + H0_SIZE]
+        h1 = hashes[H1_OFFSET:H1_OFFSET + H1_SIZE]
+        h2 = hashes[H2_OFFSET:H2_OFFSET + H2_SIZE]
+        h1_pos = idx % 8 * 20
+        h2_pos = idx % CLUSTERS_PER_GROUP / 8 * 20
+        h3_pos = idx / CLUSTERS_PER_GROUP * 20
+        if sha1(h0).digest() != h1[h1_pos:h1_pos + 20]:
+            return 'H1'
+        if sha1(h1).digest() != h2[h2_pos:h2_pos + 20]:
+            return 'H2'
+        if sha1(h2).digest() != self.h3_table()[h3_pos:h3_pos + 20]:
+            return 'H3'
+
+        self._verified[idx >> 3] |= 1 << (idx & 7)
+        return None
+
+    def h3_table(self):
+        """
+        Returns the H3 table of the partition, holding the SHA-1 of the H2
+        table of each hash group.
+        """
+        if self._h3_table is None:
+            self._h3_table = self.read_raw(self.h3_offset, H3_TABLE_SIZE)
+        return self._h3_table
+
+    def _cluster_slices(self, offset, size):
+        """
+        Iterates on (cluster data, start offset, end offset) tuples covering
+        size bytes of decrypted data starting at offset. Clusters are loaded
+        at most one hash group at a time.
+        """
+        idx = offset / CLUSTER_DATA_SIZE
+        start_off = offset % CLUSTER_DATA_SIZE
+        last = (offset + size - 1) / CLUSTER_DATA_SIZE
+        while idx <= last:
+            count = min(last + 1 - idx,
+                        CLUSTERS_PER_GROUP - idx % CLUSTERS_PER_GROUP)
+            for cluster_data in self.read_clusters(idx, count):
+                end_off = min(CLUSTER_DATA_SIZE, start_off + size)
+                yield cluster_data, start_off, end_off
+                size -= end_off - start_off
+                start_off = 0
+            idx += count
 
     def _read_header(self):
         """
@@ -119,6 +467,10 @@ class Partition(object):
         encrypted_title_key = header[TITLE_KEY_OFFSET:TITLE_KEY_OFFSET+0x10]
         title_id = header[TITLE_ID_OFFSET:TITLE_ID_OFFSET+0x8]
 
+        self.h3_offset = header[H3_OFFSET_OFFSET:H3_OFFSET_OFFSET+4]
+        self.h3_offset = struct.unpack(">L", self.h3_offset)[0]
+        self.h3_offset *= 4
+
         self.data_start = header[DATA_START_OFFSET:DATA_START_OFFSET+4]
         self.data_start = struct.unpack(">L", self.data_start)[0]
         self.data_start *= 4
@@ -140,5 +492,4 @@ class Partition(object):
             master_key = MASTER_KEY
 
         iv = title_id + 8 * "\x00"
-        aes = AES.new(master_key, AES.MODE_CBC, iv)
-        return aes.decrypt(key)
+        return self.cipher.cbc_decrypt(master_key, iv, key)
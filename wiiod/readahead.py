@@ -0,0 +1,169 @@
+"""
+wiiod.readahead
+~~~~~~~~~~~~~~~
+
+Sequential readahead: detects files being read front to back and decrypts
+the next clusters on background worker threads before they are requested.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod.partition import CLUSTER_DATA_SIZE
+
+import Queue
+import threading
+
+# Default readahead window (in clusters) and number of worker threads
+DEFAULT_WINDOW = 32
+DEFAULT_WORKERS = 1
+
+# Number of consecutive sequential reads before prefetching starts
+SEQUENTIAL_THRESHOLD = 2
+
+class Readahead(object):
+    """
+    Pool of worker threads loading clusters into partition caches. Worker
+    threads are only started on the first prefetch request, so that the
+    object can be created before forking.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, workers=DEFAULT_WORKERS):
+        """
+        Creates a readahead pool prefetching at most window clusters ahead
+        of each sequential stream, using the given number of threads.
+        """
+        self.window = window
+        self.workers = workers
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def stream(self, part, offset, size):
+        """
+        Returns a new ReadaheadStream for a file of the given partition
+        (wiiod.partition.Partition), starting at offset and of the given size.
+        """
+        return ReadaheadStream(self, part, offset, size)
+
+    def submit(self, stream, generation, first, count):
+        """
+        Queues the loading of count clusters starting at first for a stream.
+        The job is dropped if the stream generation changed in the meantime.
+        """
+        self._start()
+
+        chunk = max(1, -(-count // self.workers))
+        for start in xrange(first, first + count, chunk):
+            size = min(chunk, first + count - start)
+            self._queue.put((stream, generation, start, size))
+
+    def close(self):
+        """
+        Stops the worker threads once the pending jobs are processed.
+        """
+        with self._lock:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _start(self):
+        """
+        Starts the worker threads if needed.
+        """
+        if self._threads:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        """
+        Worker thread main loop.
+        """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            stream, generation, first, count = job
+            if stream.generation != generation:
+                continue
+
+            try:
+                stream.part.load_clusters(first, count)
+            except Exception:
+                # Prefetching is best effort: the error will be raised again
+                # if the data is actually read.
+                pass
+
+class ReadaheadStream(object):
+    """
+    Access pattern tracker for a file being read.
+    """
+
+    def __init__(self, readahead, part, offset, size):
+        self.readahead = readahead
+        self.part = part
+        self.offset = offset
+        self.size = size
+
+        # Incremented to cancel the pending jobs when the access turns random
+        self.generation = 0
+
+        self._next_pos = None
+        self._sequential = 0
+        self._ahead_until = 0
+
+    def access(self, pos, size):
+        """
+        Records a read of size bytes at pos (relative to the file start) and
+        schedules the prefetching of the following clusters if the file is
+        read sequentially.
+        """
+        if pos != self._next_pos:
+            if self._sequential:
+                self.generation += 1
+            self._sequential = 0
+            self._ahead_until = 0
+        else:
+            self._sequential += 1
+        self._next_pos = pos + size
+
+        if self._sequential < SEQUENTIAL_THRESHOLD:
+            return
+
+        first = (self.offset + pos + size) / CLUSTER_DATA_SIZE
+        first = max(first, self._ahead_until)
+        file_end = self.offset + self.size
+        last = min((self.offset + pos + size) / CLUSTER_DATA_SIZE +
+                   self.readahead.window,
+                   (file_end + CLUSTER_DATA_SIZE - 1) / CLUSTER_DATA_SIZE)
+        if first < last:
+            self.readahead.submit(self, self.generation, first, last - first)
+            self._ahead_until = last
+
+    def cancel(self):
+        """
+        Drops the pending prefetching jobs of this stream.
+        """
+        self.generation += 1
+        self._sequential = 0
+        self._ahead_until = 0
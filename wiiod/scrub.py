@@ -0,0 +1,264 @@
+"""
+wiiod.scrub
+~~~~~~~~~~~
+
+Used clusters map of the disc partitions, built from their filesystem and
+their system areas (disc header, apploader, DOL, FST), and writer of
+scrubbed images: the data not referenced by any partition is replaced by
+zeros (or by holes in sparse files), so that the image compresses well.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import cache, disc, partition, wiiodfs
+from wiiod.partition import CLUSTER_SIZE, CLUSTER_DATA_SIZE
+
+import argparse
+import struct
+import sys
+import time
+
+# Locations of the system areas in the partition data
+DOL_OFFSET_POS = 0x420
+APPLOADER_OFFSET = 0x2440
+APPLOADER_HEADER = struct.Struct('>16x4xLL4x')
+
+# DOL header: 18 section offsets at 0x00, 18 load addresses at 0x48 (skipped)
+# and 18 section sizes at 0x90, then the bss and the entry point
+DOL_HEADER = struct.Struct('>18L72x18L')
+DOL_HEADER_SIZE = 0x100
+
+# Disc area before the first partition: header, partition and region tables
+DISC_HEADER_AREA = 0x50000
+
+# Size of the chunks used to copy and zero the image
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class ClusterMap(object):
+    """
+    Bitmap of the clusters of a partition holding the system areas or file
+    data.
+    """
+
+    def __init__(self, part, bitmap):
+        """
+        Creates a map of the clusters of a wiiod.partition.Partition from a
+        bitmap (bytearray, one bit per cluster).
+        """
+        self.part = part
+        self.bitmap = bitmap
+        self.clusters = part.data_size / CLUSTER_SIZE
+
+    @classmethod
+    def for_filesystem(cls, fs_obj):
+        """
+        Builds the map of the partition of a wiiod.wiiodfs.Filesystem.
+        """
+        part = fs_obj.part
+        cluster_map = cls(part, bytearray((part.data_size / CLUSTER_SIZE + 7)
+                                          / 8))
+        mark = cluster_map.mark
+
+        # Disc header, bi2.bin and apploader
+        apploader = part.read(APPLOADER_OFFSET, APPLOADER_HEADER.size)
+        size, trailer_size = APPLOADER_HEADER.unpack(apploader)
+        mark(0, APPLOADER_OFFSET + APPLOADER_HEADER.size + size + trailer_size)
+
+        # DOL executable: the header and its text and data sections
+        dol_offset = struct.unpack('>L', part.read(DOL_OFFSET_POS, 4))[0] * 4
+        dol_header = DOL_HEADER.unpack(part.read(dol_offset, DOL_HEADER.size))
+        mark(dol_offset, max([DOL_HEADER_SIZE] +
+                             [off + size for off, size in
+                              zip(dol_header[:18], dol_header[18:]) if size]))
+
+        mark(fs_obj.fst_offset, fs_obj.fst_size)
+        for ino in xrange(fs_obj.inode_count):
+            if not fs_obj.inode_isdir(ino):
+                mark(fs_obj.inode_offset(ino), fs_obj.inode_size(ino))
+        return cluster_map
+
+    @classmethod
+    def for_partition(cls, part):
+        """
+        Builds the map of a wiiod.partition.Partition.
+        """
+        return cls.for_filesystem(wiiodfs.Filesystem(part))
+
+    def __contains__(self, idx):
+        return (0 <= idx < self.clusters and
+                bool(self.bitmap[idx >> 3] & (1 << (idx & 7))))
+
+    def mark(self, offset, size):
+        """
+        Marks the clusters holding size bytes of decrypted data at offset as
+        used.
+        """
+        if size <= 0:
+            return
+        bitmap = self.bitmap
+        last = min((offset + size - 1) / CLUSTER_DATA_SIZE, self.clusters - 1)
+        for idx in xrange(offset / CLUSTER_DATA_SIZE, last + 1):
+            bitmap[idx >> 3] |= 1 << (idx & 7)
+
+    def used_count(self):
+        """
+        Returns the number of used clusters.
+        """
+        return sum(1 for idx in xrange(self.clusters) if idx in self)
+
+    def runs(self):
+        """
+        Iterates on the (first cluster, number of clusters) runs of used
+        clusters.
+        """
+        first = None
+        for idx in xrange(self.clusters):
+            if idx in self:
+                if first is None:
+                    first = idx
+            elif first is not None:
+                yield first, idx - first
+                first = None
+        if first is not None:
+            yield first, self.clusters - first
+
+    def disc_ranges(self):
+        """
+        Iterates on the (disc offset, size) ranges of the raw clusters in
+        use.
+        """
+        start = self.part.disc_infos.offset + self.part.data_start
+        for first, count in self.runs():
+            yield start + first * CLUSTER_SIZE, count * CLUSTER_SIZE
+
+def used_ranges(disc_obj, maps=None):
+    """
+    Iterates on the sorted (offset, size) ranges of a wiiod.disc.Disc which
+    are in use: the disc header area, the partition headers and the used
+    clusters of the partitions. maps is a list of the ClusterMap of all the
+    partitions, built if not given.
+    """
+    if maps is None:
+        maps = [ClusterMap.for_partition(partition.Partition(
+                    disc_obj, infos, cache.LRUCache(0)))
+                for infos in disc_obj.partitions]
+
+    ranges = [(0, DISC_HEADER_AREA)]
+    for cluster_map in maps:
+        part = cluster_map.part
+        ranges.append((part.disc_infos.offset, part.data_start))
+        ranges.extend(cluster_map.disc_ranges())
+    ranges.sort()
+
+    # Merge the adjacent and overlapping ranges
+    offset, size = ranges[0]
+    for next_offset, next_size in ranges[1:]:
+        if next_offset <= offset + size:
+            size = max(size, next_offset + next_size - offset)
+        else:
+            yield offset, size
+            offset, size = next_offset, next_size
+    yield offset, size
+
+def write_scrubbed(image_path, target, sparse=False, trim=False,
+                   backend='auto', progress=None):
+    """
+    Writes a copy of the disc image where the unused data is replaced by
+    zeros, or left as holes if sparse is set. With trim, the copy stops
+    after the last used data; otherwise it has the size of the disc (up to
+    the end of the last partition for container images). progress is
+    called with the number of bytes processed so far. Returns the number of
+    bytes copied and the size of the copy.
+    """
+    disc_obj = disc.open_disc(image_path, backend, 'sequential')
+    try:
+        parts = [partition.Partition(disc_obj, infos, cache.LRUCache(0))
+                 for infos in disc_obj.partitions]
+        ranges = list(used_ranges(disc_obj, [ClusterMap.for_partition(part)
+                                             for part in parts]))
+
+        if trim:
+            end = ranges[-1][0] + ranges[-1][1]
+        elif isinstance(disc_obj, disc.BlockMapDisc):
+            end = max([part.disc_infos.offset + part.data_start +
+                       part.data_size for part in parts] + [DISC_HEADER_AREA])
+        else:
+            end = disc_obj.stat().st_size
+
+        copied = 0
+        with open(target, 'wb') as out:
+            pos = 0
+            for offset, size in ranges + [(end, 0)]:
+                offset = min(offset, end)
+                if not sparse:
+                    while pos < offset:
+                        length = min(COPY_CHUNK_SIZE, offset - pos)
+                        out.write('\0' * length)
+                        pos += length
+                out.seek(offset)
+
+                pos = offset
+                range_end = min(offset + size, end)
+                while pos < range_end:
+                    data = disc_obj.read(pos, min(COPY_CHUNK_SIZE,
+                                                  range_end - pos))
+                    if not data:
+                        break
+                    out.write(data)
+                    pos += len(data)
+                    copied += len(data)
+                    if progress is not None:
+                        progress(pos)
+                pos = range_end
+            out.truncate(end)
+    finally:
+        disc_obj.close()
+    return copied, end
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Writes a scrubbed copy of a Wii optical disc image.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('target', help='path of the scrubbed image')
+    parser.add_argument('-s', '--sparse', action='store_true',
+                        help='leave holes instead of writing zeros')
+    parser.add_argument('-t', '--trim', action='store_true',
+                        help='stop the image after the last used data')
+    parser.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not display the progress')
+    args = parser.parse_args()
+
+    start = time.time()
+    def progress(total):
+        elapsed = time.time() - start
+        sys.stderr.write('\r%8.1f MB  %8.2f MB/s' % (
+            total / 1048576.0, total / 1048576.0 / max(elapsed, 1e-6)))
+
+    try:
+        copied, size = write_scrubbed(args.image, args.target, args.sparse,
+                                      args.trim, args.backend,
+                                      None if args.quiet else progress)
+    except EnvironmentError as e:
+        print '%s: cannot scrub disc image: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    if not args.quiet:
+        sys.stderr.write('\n')
+
+    print 'Kept %.1f MB of %.1f MB (%.1f%%) in %.2f s' % (
+        copied / 1048576.0, size / 1048576.0,
+        100.0 * copied / max(size, 1), time.time() - start)
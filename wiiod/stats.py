@@ -0,0 +1,288 @@
+"""
+wiiod.stats
+~~~~~~~~~~~
+
+Runtime statistics: number of calls, errors, bytes and latency histogram of
+the main operations (disc reads, AES decryption, cluster reads, filesystem
+operations), collected by decorating the functions with timed. Other
+objects keeping their own statistics (like the clusters caches) can be
+registered as sources. Everything is returned by snapshot, or as JSON by
+report, which is the content of the /.wiiodfs/stats file of mounted discs.
+
+Collection can be disabled at any time with set_enabled: timed functions
+then only check a flag before calling the original function.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import bisect
+import collections
+import functools
+import json
+import threading
+import time
+
+# Latency histograms have power of two buckets, in microseconds: bucket n
+# counts the operations which took less than 2^n us, the last bucket counts
+# all the slower ones
+BUCKETS = 24
+
+# Number of queued samples which triggers their aggregation
+FLUSH_SAMPLES = 4096
+
+# Percentiles reported for each operation
+PERCENTILES = (50, 90, 99)
+
+# Virtual directory and file exposing the statistics in mounted discs
+STATS_DIR = '/.wiiodfs'
+STATS_PATH = STATS_DIR + '/stats'
+
+# The reports are padded with spaces to a multiple of this size, with one
+# more block of margin: their size can then be given before they are built
+REPORT_BLOCK_SIZE = 4096
+
+# Whether timed functions record their calls
+enabled = True
+
+class Histogram(object):
+    """
+    Calls, errors, bytes processed and latency distribution of an
+    operation. The duration and the size of each call are first appended
+    to arrays, which is thread-safe without any lock, and only aggregated by
+    batches (see flush).
+    """
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.sizes = array.array('L')
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Sets all the counters back to zero.
+        """
+        with self._lock:
+            del self.times[:]
+            del self.sizes[:]
+            self.count = 0
+            self.errors = 0
+            self.bytes = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.buckets = [0] * BUCKETS
+
+    def record(self, elapsed, nbytes=0):
+        """
+        Records a call which took elapsed seconds and processed nbytes
+        bytes.
+        """
+        self.times.append(elapsed)
+        self.sizes.append(nbytes)
+        if len(self.times) >= FLUSH_SAMPLES:
+            self.flush()
+
+    def record_error(self):
+        """
+        Records a call which raised an exception.
+        """
+        with self._lock:
+            self.errors += 1
+
+    def flush(self):
+        """
+        Aggregates the queued samples into the counters. Samples appended
+        meanwhile by other threads are kept for the next flush.
+        """
+        with self._lock:
+            count = len(self.times)
+            times = sorted(self.times[:count])
+            del self.times[:count]
+            count_sizes = len(self.sizes)
+            self.bytes += sum(self.sizes[:count_sizes])
+            del self.sizes[:count_sizes]
+            if not count:
+                return
+
+            self.count += count
+            self.total_time += sum(times)
+            self.max_time = max(self.max_time, times[-1])
+
+            # Samples are sorted: each bucket is a slice of the list
+            below = 0
+            for bucket in xrange(BUCKETS - 1):
+                limit = bisect.bisect_left(times, (1 << bucket) / 1000000.0,
+                                           below)
+                self.buckets[bucket] += limit - below
+                below = limit
+            self.buckets[-1] += count - below
+
+    def percentile(self, pct):
+        """
+        Returns an upper bound of the given latency percentile, in
+        microseconds (0 if nothing was recorded). Only the aggregated
+        samples are taken into account.
+        """
+        rank = self.count * pct / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1 << bucket, self.max_time * 1000000)
+        return 0
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the counters, with times in microseconds.
+        """
+        self.flush()
+        with self._lock:
+            result = {
+                'count': self.count,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'total_us': int(self.total_time * 1000000),
+                'mean_us': (self.total_time * 1000000 / self.count
+                            if self.count else 0),
+                'max_us': self.max_time * 1000000,
+                'buckets': list(self.buckets),
+            }
+            for pct in PERCENTILES:
+                result['p%d_us' % pct] = self.percentile(pct)
+        return result
+
+# Histograms of the timed operations and other statistics sources, by name
+_histograms = collections.OrderedDict()
+_sources = collections.OrderedDict()
+_registry_lock = threading.Lock()
+
+# Time of the last reset
+_since = time.time()
+
+def histogram(name):
+    """
+    Returns the histogram of an operation, creating it if needed.
+    """
+    with _registry_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        return _histograms[name]
+
+def timed(name, size=None):
+    """
+    Decorator recording the calls of a function in the histogram of the
+    given operation. size is called with the result of the function to get
+    the number of bytes processed.
+    """
+    hist = histogram(name)
+    times = hist.times
+    sizes = hist.sizes
+    clock = time.time
+
+    # The samples are queued inline: a method call per sample would cost
+    # more than everything else
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = clock()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                hist.record_error()
+                raise
+            times.append(clock() - start)
+            if size is not None:
+                sizes.append(size(result))
+            if len(times) >= FLUSH_SAMPLES:
+                hist.flush()
+            return result
+        return wrapper
+    return decorator
+
+def register(name, source):
+    """
+    Adds a statistics source: source is called without arguments and
+    returns a dictionary which is included in the snapshots under name.
+    """
+    with _registry_lock:
+        _sources[name] = source
+
+def unregister(name):
+    """
+    Removes a statistics source.
+    """
+    with _registry_lock:
+        _sources.pop(name, None)
+
+def set_enabled(flag):
+    """
+    Enables or disables the collection of the timed operations.
+    """
+    global enabled
+    enabled = bool(flag)
+
+def reset():
+    """
+    Sets the counters of all the operations back to zero. Sources keep
+    their own counters.
+    """
+    global _since
+    with _registry_lock:
+        histograms = _histograms.values()
+    for hist in histograms:
+        hist.reset()
+    _since = time.time()
+
+def snapshot():
+    """
+    Returns a dictionary of all the statistics: counters of the operations
+    which were called at least once and the dictionaries of the sources.
+    """
+    with _registry_lock:
+        histograms = _histograms.items()
+        sources = _sources.items()
+
+    result = {
+        'enabled': enabled,
+        'since': _since,
+        'elapsed': time.time() - _since,
+        'operations': dict((name, hist.snapshot())
+                           for name, hist in histograms
+                           if hist.times or hist.count or hist.errors),
+    }
+    for name, source in sources:
+        result[name] = source()
+    return result
+
+def report():
+    """
+    Returns the snapshot as JSON, padded with spaces (see report_size).
+    """
+    text = json.dumps(snapshot(), indent=2, sort_keys=True) + '\n'
+    return text.ljust(report_size(len(text)))
+
+def report_size(length=None):
+    """
+    Returns the size of a report of the given length, or of the current
+    report. Reports built a little later are not larger than this size
+    unless they grow by more than REPORT_BLOCK_SIZE.
+    """
+    if length is None:
+        length = len(json.dumps(snapshot(), indent=2, sort_keys=True)) + 1
+    blocks = (length + REPORT_BLOCK_SIZE - 1) / REPORT_BLOCK_SIZE + 1
+    return blocks * REPORT_BLOCK_SIZE
@@ -0,0 +1,406 @@
+"""
+wiiod.synth
+~~~~~~~~~~~
+
+Builds synthetic Wii disc images: a disc header, a volume group table with a
+single game partition, a partition header with an encrypted title key and an
+H3 table, and the partition data (boot header, apploader, DOL, FST and files)
+stored in hashed and encrypted clusters. The images are read by wiiod.disc,
+wiiod.partition and wiiod.wiiodfs like real ones, so they can be used to
+test and benchmark wiiod without any game image.
+
+The content of the files is derived from their position in the partition
+data (see pattern), so that any read can be checked without keeping a copy
+of the data.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import crypto, disc, partition, scrub, wiiodfs
+from wiiod.partition import (CLUSTER_DATA_SIZE, CLUSTERS_PER_GROUP,
+                             DATA_BLOCK_SIZE, H1_OFFSET, H2_OFFSET,
+                             HASH_BLOCK_SIZE)
+
+import argparse
+import array
+import collections
+import hashlib
+import math
+import random
+import struct
+import sys
+import time
+
+# Layout of the disc: the partition comes right after the partition table
+PARTITION_TABLE_OFFSET = disc.VGTABLE_OFFSET + 0x20
+PARTITION_OFFSET = 0x50000
+
+# Layout of the partition: header, H3 table, then the clusters
+H3_OFFSET = 0x8000
+DATA_START = 0x20000
+
+# Layout of the partition data: boot header and bi2.bin, apploader, DOL, FST,
+# then the files. The FST starts after an unused cluster, so that the images
+# have a hole in the middle of their system area, like real ones.
+BOOT_HEADER_SIZE = 0x440
+APPLOADER_OFFSET = scrub.APPLOADER_OFFSET
+APPLOADER_HEADER = struct.Struct('>16sLLL4x')
+APPLOADER_SIZE = 0x1000
+APPLOADER_TRAILER_SIZE = 0x200
+APPLOADER_ENTRY = 0x81200000
+DOL_OFFSET = 0x4000
+FST_OFFSET = 0x10000
+FILE_ALIGNMENT = 0x20
+
+# DOL executable: section offsets, load addresses and sizes, then the bss
+# and the entry point. The sections are (offset, load address, size), text
+# sections first.
+DOL_HEADER = struct.Struct('>18L18L18LLLL28x')
+DOL_TEXT_SECTIONS = [(0x100, 0x80004000, 0x1800)]
+DOL_DATA_SECTIONS = [(0x1900, 0x80005800, 0x600), (0x1f00, 0x80005e00, 0x120)]
+DOL_BSS = (0x80006000, 0x2000)
+
+# Default identifiers of the generated game
+DEFAULT_GAME_ID = 'RSYN01'
+DEFAULT_TITLE = 'wiiod synthetic disc'
+
+# A file of a synthetic image: path, offset in the partition data and size
+SynthFile = collections.namedtuple('SynthFile', 'path offset size')
+
+def pattern(offset, size):
+    """
+    Returns the content of a synthetic image at the given offset of the
+    partition data: every 32-bit big endian word holds its own offset
+    divided by 4.
+    """
+    first = offset / 4
+    words = array.array('I', xrange(first, (offset + size + 3) / 4))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    start = offset - first * 4
+    return words.tostring()[start:start + size]
+
+def random_tree(files=200, depth=3, min_size=0, max_size=1024 * 1024,
+                fanout=4, seed=0):
+    """
+    Returns a sorted list of (path, size) for the given number of files.
+    Each file is stored at a random depth (up to depth) below directories
+    chosen among fanout names per level. Sizes are picked on a logarithmic
+    scale between min_size and max_size, so that there are many small files
+    and a few large ones, as on real discs.
+    """
+    rand = random.Random(seed)
+    log_min = math.log(min_size + 1)
+    log_max = math.log(max_size + 1)
+
+    tree = []
+    for i in xrange(files):
+        dirs = ['dir%d' % rand.randrange(fanout)
+                for _ in xrange(rand.randint(0, depth))]
+        path = '/' + '/'.join(dirs + ['file%05d.bin' % i])
+        size = int(math.exp(rand.uniform(log_min, log_max))) - 1
+        tree.append((path, min(max(size, min_size), max_size)))
+    tree.sort()
+    return tree
+
+def _layout(tree):
+    """
+    Builds the FST of a list of (path, size) and places the files after it.
+    Returns the FST and the list of SynthFile, in FST order.
+    """
+    root = {}
+    for path, size in tree:
+        components = path.strip('/').split('/')
+        node = root
+        for name in components[:-1]:
+            node = node.setdefault(name, {})
+        node[components[-1]] = size
+
+    # Descriptors: [is_dir, name offset, data offset or parent, size or next]
+    descriptors = [[1, 0, 0, None]]
+    names = []
+    names_size = [0]
+    entries = []
+
+    def add_name(name):
+        offset = names_size[0]
+        names.append(name + '\0')
+        names_size[0] += len(name) + 1
+        return offset
+
+    def walk(node, parent, path):
+        for name in sorted(node):
+            idx = len(descriptors)
+            child = node[name]
+            if isinstance(child, dict):
+                descriptors.append([1, add_name(name), parent, None])
+                walk(child, idx, path + name + '/')
+                descriptors[idx][3] = len(descriptors)
+            else:
+                descriptors.append([0, add_name(name), None, child])
+                entries.append((idx, path + name, child))
+    walk(root, 0, '/')
+    descriptors[0][3] = len(descriptors)
+
+    fst_size = len(descriptors) * wiiodfs.DESCRIPTOR.size + names_size[0]
+    offset = FST_OFFSET + fst_size
+    files = []
+    for idx, path, size in entries:
+        offset = (offset + FILE_ALIGNMENT - 1) & ~(FILE_ALIGNMENT - 1)
+        descriptors[idx][2] = offset / 4
+        files.append(SynthFile(path, offset, size))
+        offset += size
+
+    fst = ''.join(wiiodfs.DESCRIPTOR.pack((is_dir << 24) | name_off, data,
+                                          size)
+                  for is_dir, name_off, data, size in descriptors)
+    fst += ''.join(names)
+
+    # FST sizes are stored in 32-bit words
+    return fst + '\0' * (-len(fst) % 4), files
+
+def _boot_data(game_id, title, fst):
+    """
+    Returns the start of the partition data, up to the end of the FST: the
+    boot header, the apploader and the DOL. The apploader code, the
+    apploader trailer and the DOL sections hold the pattern of their
+    offsets, like the files.
+    """
+    boot = bytearray(FST_OFFSET)
+    boot[0:6] = game_id
+    struct.pack_into('>L', boot, 0x18, disc.WII_MAGIC_NUMBER)
+    boot[0x20:0x20 + len(title)] = title
+    struct.pack_into('>L', boot, scrub.DOL_OFFSET_POS, DOL_OFFSET / 4)
+    struct.pack_into('>LLL', boot, wiiodfs.FST_OFFSET_POS, FST_OFFSET / 4,
+                     len(fst) / 4, len(fst) / 4)
+
+    APPLOADER_HEADER.pack_into(boot, APPLOADER_OFFSET, '2026/10/16',
+                               APPLOADER_ENTRY, APPLOADER_SIZE,
+                               APPLOADER_TRAILER_SIZE)
+    start = APPLOADER_OFFSET + APPLOADER_HEADER.size
+    size = APPLOADER_SIZE + APPLOADER_TRAILER_SIZE
+    boot[start:start + size] = pattern(start, size)
+
+    sections = DOL_TEXT_SECTIONS + [(0, 0, 0)] * (7 - len(DOL_TEXT_SECTIONS))
+    sections += DOL_DATA_SECTIONS + [(0, 0, 0)] * (11 -
+                                                   len(DOL_DATA_SECTIONS))
+    offsets, addresses, sizes = zip(*sections)
+    DOL_HEADER.pack_into(boot, DOL_OFFSET, *(offsets + addresses + sizes +
+                                             DOL_BSS +
+                                             (DOL_TEXT_SECTIONS[0][1],)))
+    for offset, _, size in DOL_TEXT_SECTIONS + DOL_DATA_SECTIONS:
+        start = DOL_OFFSET + offset
+        boot[start:start + size] = pattern(start, size)
+    return str(boot) + fst
+
+def dol_size():
+    """
+    Returns the size of the DOL of the synthetic images: its header and
+    sections.
+    """
+    return max([DOL_HEADER.size] +
+               [offset + size for offset, _, size in
+                DOL_TEXT_SECTIONS + DOL_DATA_SECTIONS])
+
+def _hash_group(data, cipher, key):
+    """
+    Returns the clusters of a hash group (CLUSTERS_PER_GROUP * 0x7C00 bytes
+    of partition data) with their hash blocks, and the H2 table of the
+    group. Clusters are encrypted with the key unless key is None.
+    """
+    sha1 = hashlib.sha1
+    blocks_per_cluster = CLUSTER_DATA_SIZE / DATA_BLOCK_SIZE
+
+    data = str(data)
+    datas = [data[i * CLUSTER_DATA_SIZE:(i + 1) * CLUSTER_DATA_SIZE]
+             for i in xrange(CLUSTERS_PER_GROUP)]
+    h0s = [''.join(sha1(buffer(cluster, i * DATA_BLOCK_SIZE,
+                               DATA_BLOCK_SIZE)).digest()
+                   for i in xrange(blocks_per_cluster))
+           for cluster in datas]
+    h1s = [''.join(sha1(h0).digest() for h0 in h0s[i:i + 8])
+           for i in xrange(0, CLUSTERS_PER_GROUP, 8)]
+    h2 = ''.join(sha1(h1).digest() for h1 in h1s)
+
+    clusters = []
+    for i, cluster in enumerate(datas):
+        hashes = (h0s[i].ljust(H1_OFFSET, '\0') +
+                  h1s[i / 8].ljust(H2_OFFSET - H1_OFFSET, '\0') +
+                  h2.ljust(HASH_BLOCK_SIZE - H2_OFFSET, '\0'))
+        if key is None:
+            clusters.append(hashes)
+            clusters.append(cluster)
+        else:
+            hashes = cipher.cbc_encrypt(key, '\0' * 16, hashes)
+            clusters.append(hashes)
+            clusters.append(cipher.cbc_encrypt(key, hashes[0x3D0:0x3E0],
+                                               cluster))
+    return clusters, h2
+
+def build_image(path, tree, encrypted=True, game_id=DEFAULT_GAME_ID,
+                title=DEFAULT_TITLE, seed=0, backend=None, progress=None):
+    """
+    Writes a synthetic disc image holding the files of tree (a list of
+    (path, size), see random_tree) to path. The clusters are encrypted with
+    a title key derived from the seed, or stored in clear with the
+    encryption disabled in the disc header (as written by wiiod.export).
+    Clusters are encrypted with the given wiiod.crypto backend, or with the
+    default one. progress is called with the number of bytes of partition
+    data written so far after each hash group. Returns the list of
+    SynthFile of the image.
+    """
+    cipher = crypto.get_backend(backend)
+    title = title[:63]
+    fst, files = _layout(tree)
+
+    title_key = hashlib.sha1('wiiod title key %d' % seed).digest()[:16]
+    title_id = '\x00\x01\x00\x00' + game_id[:4]
+    if game_id[3] == 'K':
+        master_key = partition.MASTER_KEY_KOREAN
+    else:
+        master_key = partition.MASTER_KEY
+    encrypted_key = cipher.cbc_encrypt(master_key, title_id + '\0' * 8,
+                                       title_key)
+
+    # Partition data not made of file contents: boot header, apploader, DOL
+    # and FST
+    head = _boot_data(game_id, title, fst)
+
+    end = files[-1].offset + files[-1].size if files else len(head)
+    group_size = CLUSTERS_PER_GROUP * CLUSTER_DATA_SIZE
+    groups = max(1, (end + group_size - 1) / group_size)
+    data_size = groups * CLUSTERS_PER_GROUP * partition.CLUSTER_SIZE
+
+    header = bytearray(disc.VGTABLE_OFFSET)
+    header[0:6] = game_id
+    struct.pack_into('>L', header, 0x18, disc.WII_MAGIC_NUMBER)
+    header[0x20:0x20 + len(title)] = title
+    header[disc.DISABLE_ENCRYPTION_OFFSET] = 0 if encrypted else 1
+
+    tables = bytearray(PARTITION_OFFSET - disc.VGTABLE_OFFSET)
+    struct.pack_into('>LL', tables, 0, 1, PARTITION_TABLE_OFFSET / 4)
+    struct.pack_into('>LL', tables,
+                     PARTITION_TABLE_OFFSET - disc.VGTABLE_OFFSET,
+                     PARTITION_OFFSET / 4, 0)
+
+    part_header = bytearray(DATA_START)
+    struct.pack_into('>L', part_header, 0, 0x10001)
+    part_header[partition.TITLE_KEY_OFFSET:
+                partition.TITLE_KEY_OFFSET + 16] = encrypted_key
+    part_header[partition.TITLE_ID_OFFSET:
+                partition.TITLE_ID_OFFSET + 8] = title_id
+    struct.pack_into('>LLL', part_header, partition.H3_OFFSET_OFFSET,
+                     H3_OFFSET / 4, DATA_START / 4, data_size / 4)
+
+    key = title_key if encrypted else None
+    h3 = []
+    with open(path, 'wb') as out:
+        out.write(header)
+        out.write(tables)
+        out.seek(PARTITION_OFFSET + DATA_START)
+
+        # Files are sorted by offset: each group only looks at the files
+        # starting before its end
+        next_file = 0
+        pending = []
+        for group in xrange(groups):
+            start = group * group_size
+            data = bytearray(group_size)
+            if start < len(head):
+                chunk = head[start:start + group_size]
+                data[:len(chunk)] = chunk
+
+            while (next_file < len(files) and
+                   files[next_file].offset < start + group_size):
+                pending.append(files[next_file])
+                next_file += 1
+            for entry in pending:
+                first = max(entry.offset, start)
+                last = min(entry.offset + entry.size, start + group_size)
+                if first < last:
+                    data[first - start:last - start] = pattern(first,
+                                                               last - first)
+            pending = [entry for entry in pending
+                       if entry.offset + entry.size > start + group_size]
+
+            clusters, h2 = _hash_group(data, cipher, key)
+            h3.append(hashlib.sha1(h2).digest())
+            out.write(''.join(clusters))
+            if progress is not None:
+                progress(start + group_size)
+
+        part_header[H3_OFFSET:H3_OFFSET + 20 * len(h3)] = ''.join(h3)
+        out.seek(PARTITION_OFFSET)
+        out.write(part_header)
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Builds a synthetic Wii optical disc image.')
+    parser.add_argument('target', help='path of the disc image')
+    parser.add_argument('-n', '--files', type=int, default=200,
+                        help='number of files (default: %(default)s)')
+    parser.add_argument('-d', '--depth', type=int, default=3,
+                        help='maximum directory depth (default: %(default)s)')
+    parser.add_argument('-f', '--fanout', type=int, default=4,
+                        help='directories per level (default: %(default)s)')
+    parser.add_argument('--min-size', type=int, default=0, metavar='BYTES',
+                        help='minimum file size (default: %(default)s)')
+    parser.add_argument('--max-size', type=int, default=1024 * 1024,
+                        metavar='BYTES',
+                        help='maximum file size (default: %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-D', '--decrypted', action='store_true',
+                        help='store the clusters in clear, with the '
+                             'encryption disabled in the disc header')
+    parser.add_argument('-g', '--game-id', default=DEFAULT_GAME_ID,
+                        help='6 characters game identifier '
+                             '(default: %(default)s)')
+    parser.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to encrypt the '
+                             'clusters (default: fastest available)')
+    args = parser.parse_args()
+
+    if len(args.game_id) != 6:
+        parser.error('the game identifier must be 6 characters long')
+
+    tree = random_tree(args.files, args.depth, args.min_size, args.max_size,
+                       args.fanout, args.seed)
+
+    start = time.time()
+    def progress(total):
+        elapsed = time.time() - start
+        sys.stderr.write('\r%8.1f MB  %8.2f MB/s' % (
+            total / 1048576.0, total / 1048576.0 / max(elapsed, 1e-6)))
+
+    try:
+        files = build_image(args.target, tree, not args.decrypted,
+                            args.game_id, seed=args.seed,
+                            backend=args.aes_backend, progress=progress)
+    except ImportError as e:
+        print '%s: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    except EnvironmentError as e:
+        print '%s: cannot write disc image: %s' % (sys.argv[0], e)
+        sys.exit(1)
+    sys.stderr.write('\n')
+
+    print 'Wrote %d files (%.1f MB) in %.2f s' % (
+        len(files), sum(f.size for f in files) / 1048576.0,
+        time.time() - start)
+
+if __name__ == '__main__':
+    main()
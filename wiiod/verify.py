@@ -0,0 +1,267 @@
+"""
+wiiod.verify
+~~~~~~~~~~~~
+
+Checks all the clusters of the partitions of a disc against their hash
+trees, using a pool of worker processes, and reports the corrupted clusters
+of each partition with the files they belong to. Zeroed clusters which are
+not used by the filesystem of their partition were scrubbed on purpose (see
+wiiod.scrub and wiiod.export) and are not reported as corrupted.
+
+This file is part of wiiodfs.
+
+wiiodfs is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+wiiodfs is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from wiiod import cache, crypto, disc, discfs, partition, scrub, wiiodfs
+from wiiod.partition import (CLUSTER_SIZE, CLUSTER_DATA_SIZE,
+                             CLUSTERS_PER_GROUP)
+
+import argparse
+import bisect
+import multiprocessing
+import sys
+import time
+
+# Disc image and partitions (by offset) opened by each worker process
+_worker_disc = None
+_worker_parts = {}
+
+def _init_worker(image_path, backend, aes_backend):
+    """
+    Opens the disc image in a worker process. Its partitions are opened
+    when their first job is run.
+    """
+    global _worker_disc
+    crypto.set_default_backend(aes_backend)
+    _worker_disc = disc.open_disc(image_path, backend, 'sequential')
+
+def _worker_partition(part_offset):
+    """
+    Returns the partition of the worker disc image starting at part_offset.
+    """
+    part = _worker_parts.get(part_offset)
+    if part is None:
+        infos = [p for p in _worker_disc.partitions
+                   if p.offset == part_offset][0]
+        part = partition.Partition(_worker_disc, infos, cache.LRUCache(0))
+        _worker_parts[part_offset] = part
+    return part
+
+def _run_job(args):
+    """
+    Checks the clusters of a job. Returns the partition offset, the number
+    of clusters checked and the list of (cluster index, hash level, zeroed)
+    tuples of the clusters which do not match their hashes, zeroed being
+    True for the clusters only made of zeros.
+    """
+    part_offset, first, count = args
+    part = _worker_partition(part_offset)
+    errors = []
+    for idx, level in part.check_clusters(first, count):
+        raw = part.read_raw(part.data_start + idx * CLUSTER_SIZE,
+                            CLUSTER_SIZE)
+        errors.append((idx, level, raw.count('\0') == len(raw)))
+    return part_offset, count, errors
+
+def owners(fs_obj, clusters):
+    """
+    Returns a dictionary mapping each of the given cluster indexes to the
+    sorted list of the paths of the files (of the wiiod.wiiodfs.Filesystem)
+    stored in it. The filesystem table itself is reported as '<fst>'.
+    """
+    clusters = sorted(clusters)
+    result = dict((idx, []) for idx in clusters)
+
+    def add(path, offset, size):
+        first = offset / CLUSTER_DATA_SIZE
+        last = (offset + size - 1) / CLUSTER_DATA_SIZE
+        pos = bisect.bisect_left(clusters, first)
+        while pos < len(clusters) and clusters[pos] <= last:
+            result[clusters[pos]].append(path)
+            pos += 1
+
+    add('<fst>', fs_obj.fst_offset, fs_obj.fst_size)
+    for ino in xrange(fs_obj.inode_count):
+        size = fs_obj.inode_size(ino)
+        if not fs_obj.inode_isdir(ino) and size:
+            add(fs_obj.inode_path(ino), fs_obj.inode_offset(ino), size)
+
+    for paths in result.itervalues():
+        paths.sort()
+    return result
+
+def verify(image_path, parts, processes=None, backend='auto',
+           progress=None, aes_backend=None):
+    """
+    Checks all the clusters of the partitions described by parts (a list of
+    wiiod.disc.PartitionInfos) against their hash trees, using the given
+    number of worker processes (by default, one per CPU), one hash group at
+    a time. progress is called with the number of clusters checked so far
+    after each group. Returns the number of clusters checked and a
+    dictionary mapping the offset of each partition to the sorted list of
+    (cluster index, hash level, zeroed) tuples of its clusters which do not
+    match their hashes (see _run_job).
+    """
+    disc_obj = disc.open_disc(image_path, backend)
+    jobs = []
+    try:
+        for infos in parts:
+            part = partition.Partition(disc_obj, infos)
+            clusters = part.data_size / CLUSTER_SIZE
+            jobs.extend((infos.offset, first,
+                         min(CLUSTERS_PER_GROUP, clusters - first))
+                        for first in xrange(0, clusters, CLUSTERS_PER_GROUP))
+    finally:
+        disc_obj.close()
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (image_path, backend, aes_backend))
+    try:
+        checked = 0
+        errors = dict((infos.offset, []) for infos in parts)
+        for part_offset, count, job_errors in pool.imap_unordered(_run_job,
+                                                                  jobs):
+            checked += count
+            errors[part_offset].extend(job_errors)
+            if progress is not None:
+                progress(checked)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for part_errors in errors.itervalues():
+        part_errors.sort()
+    return checked, errors
+
+def classify(disc_obj, part_infos, errors):
+    """
+    Splits the (cluster index, hash level, zeroed) tuples of the clusters of
+    the partition described by part_infos which do not match their hashes into the
+    corrupted clusters and the scrubbed ones: zeroed clusters which are not
+    used by the filesystem. Returns the list of the (cluster index, hash
+    level) tuples of the corrupted clusters, the list of the indexes of the
+    scrubbed clusters and the owners (see owners) of the corrupted
+    clusters, or None if the filesystem itself is corrupted.
+    """
+    # The filesystem table is read in verify mode: a corrupted table cannot
+    # be used to find the files, and then no cluster is known to be unused
+    part = partition.Partition(disc_obj, part_infos, verify=True)
+    try:
+        fs_obj = wiiodfs.Filesystem(part)
+        used = scrub.ClusterMap.for_filesystem(fs_obj)
+    except partition.IntegrityError:
+        fs_obj = used = None
+
+    corrupted = []
+    scrubbed = []
+    for idx, level, zeroed in errors:
+        if zeroed and used is not None and idx not in used:
+            scrubbed.append(idx)
+        else:
+            corrupted.append((idx, level))
+
+    files = None
+    if fs_obj is not None:
+        files = owners(fs_obj, [idx for idx, _ in corrupted])
+    return corrupted, scrubbed, files
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks a Wii optical disc image against its hashes.')
+    parser.add_argument('image', help='path to the disc image')
+    parser.add_argument('part_index', nargs='?', type=int,
+                        help='only check this game partition (default: '
+                             'check all the partitions)')
+    parser.add_argument('-j', '--processes', type=int, metavar='N',
+                        help='number of worker processes (default: number '
+                             'of CPUs)')
+    parser.add_argument('-b', '--backend', default='auto',
+                        choices=disc.BACKENDS,
+                        help='disc image access method (default: %(default)s)')
+    parser.add_argument('-a', '--aes-backend', choices=crypto.BACKENDS.keys(),
+                        help='AES implementation used to decrypt the '
+                             'clusters (default: fastest available)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not display the progress')
+    args = parser.parse_args()
+
+    try:
+        crypto.set_default_backend(args.aes_backend)
+    except ImportError:
+        print '%s: AES backend not available: %s' % (sys.argv[0],
+                                                     args.aes_backend)
+        sys.exit(1)
+
+    try:
+        disc_obj = disc.open_disc(args.image, args.backend)
+    except (EnvironmentError, ValueError):
+        print '%s: cannot open disc image: %s' % (sys.argv[0], args.image)
+        sys.exit(1)
+    parts = list(disc_obj.partitions)
+
+    if args.part_index is not None:
+        all_game_parts = [part for part in parts if part.type == 0]
+        if args.part_index >= len(all_game_parts) or args.part_index < 0:
+            print 'Invalid partition index (out of bounds)'
+            sys.exit(1)
+        parts = [all_game_parts[args.part_index]]
+
+    start = time.time()
+    def progress(checked):
+        elapsed = time.time() - start
+        size = checked * CLUSTER_SIZE / 1048576.0
+        sys.stderr.write('\r%8d clusters  %8.2f MB/s' % (
+            checked, size / max(elapsed, 1e-6)))
+
+    checked, errors = verify(args.image, parts, args.processes,
+                             args.backend, None if args.quiet else progress,
+                             args.aes_backend)
+    elapsed = time.time() - start
+    if not args.quiet:
+        sys.stderr.write('\n')
+
+    size = checked * CLUSTER_SIZE / 1048576.0
+    print 'Checked %d clusters of %d partitions (%.1f MB) in %.2f s: ' \
+          '%.2f MB/s' % (checked, len(parts), size, elapsed,
+                         size / max(elapsed, 1e-6))
+
+    failed = False
+    for infos in parts:
+        name = discfs.partition_name(infos)
+        part_errors = errors[infos.offset]
+        if not part_errors:
+            print '%s: no corrupted cluster found.' % name
+            continue
+
+        corrupted, scrubbed, files = classify(disc_obj, infos, part_errors)
+        if scrubbed:
+            print '%s: %d scrubbed clusters skipped.' % (name, len(scrubbed))
+        if not corrupted:
+            continue
+
+        failed = True
+        print '%s: %d corrupted clusters:' % (name, len(corrupted))
+        for idx, level in corrupted:
+            if files is None:
+                where = 'unknown (corrupted filesystem table)'
+            else:
+                where = ', '.join(files[idx]) or 'unused'
+            print '  cluster %d (%s): %s' % (idx, level, where)
+    disc_obj.close()
+
+    if failed:
+        sys.exit(2)
@@ -19,11 +19,42 @@ You should have received a copy of the GNU General Public License along with
 wiiodfs.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from wiiod import stats
+from wiiod.partition import CLUSTER_DATA_SIZE, CLUSTERS_PER_GROUP
+
+import array
+import ctypes
+import mmap
+import os
+import os.path
 import struct
+import sys
+import zlib
 
 # Magic fixed locations
 FST_OFFSET_POS = 0x424
 
+# Inode number of the root directory
+ROOT_INODE = 0
+
+# FST offset and size (both shifted by 2) and FST descriptor structures
+FST_INFOS = struct.Struct('>LL')
+DESCRIPTOR = struct.Struct('>LLL')
+
+# Default size of the chunks of streamed files: one hash group of data
+DEFAULT_CHUNK_SIZE = CLUSTERS_PER_GROUP * CLUSTER_DATA_SIZE
+
+# Empty slot of the path hash table
+EMPTY_SLOT = 0xFFFFFFFF
+
+# Sidecar index header: magic (including the byte order of the arrays),
+# disc ID, number and version, image size, image mtime (ns), partition
+# offset, FST offset, FST size, filenames table offset (offsets and sizes in
+# the partition are 34 bits long), number of inodes, path hash table size
+# and filenames table size
+INDEX_MAGIC = 'WIODIX2' + sys.byteorder[0]
+INDEX_HEADER = struct.Struct('<8s8sQQQQQQLLL')
+
 class _File(object):
     """
     Object providing a file-like interface to the data.
@@ -35,8 +66,14 @@ class _File(object):
         self.size = size
         self.pos = 0
 
+        if part.readahead is not None:
+            self._stream = part.readahead.stream(part, offset, size)
+        else:
+            self._stream = None
+
     def close(self):
-        pass
+        if self._stream is not None:
+            self._stream.cancel()
 
     def tell(self):
         return self.pos
@@ -56,6 +93,7 @@ class _File(object):
 
         self.pos = start_pos + offset
 
+    @stats.timed('file.read', len)
     def read(self, size=-1):
         if self.pos >= self.size:
             return ''
@@ -64,45 +102,173 @@ class _File(object):
             size = self.size
 
         actual_size = min(size, self.size - self.pos)
+        if self._stream is not None:
+            self._stream.access(self.pos, actual_size)
         data = self.part.read(self.offset + self.pos, actual_size)
         self.pos += actual_size
         return data
 
+    def readinto(self, buf):
+        if self.pos >= self.size:
+            return 0
+
+        view = memoryview(buf)
+        actual_size = min(len(view), self.size - self.pos)
+        if self._stream is not None:
+            self._stream.access(self.pos, actual_size)
+        self.part.readinto(self.offset + self.pos, view[:actual_size])
+        self.pos += actual_size
+        return actual_size
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterates on the data from the current position to the end of the
+        file, in chunks of at most chunk_size bytes (rounded down to a
+        multiple of the cluster data size). Chunks end on cluster boundaries,
+        so that each cluster is decrypted only once.
+        """
+        chunk_size = max(CLUSTER_DATA_SIZE,
+                         chunk_size - chunk_size % CLUSTER_DATA_SIZE)
+        while self.pos < self.size:
+            # Align the end of the chunk on a cluster boundary
+            start = self.offset + self.pos
+            end = (start + chunk_size) / CLUSTER_DATA_SIZE * CLUSTER_DATA_SIZE
+            data = self.read(min(end, self.offset + self.size) - start)
+            yield data
+
+    def copy_to(self, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes the data from the current position to the end of the file to
+        a file object, one chunk at a time. Returns the number of bytes
+        written.
+        """
+        written = 0
+        for data in self.iter_chunks(chunk_size):
+            fileobj.write(data)
+            written += len(data)
+        return written
+
     def flush(self):
         pass
 
 class Filesystem(object):
-    def __init__(self, part):
+    """
+    Filesystem of a partition, stored as a compact inode table. Inode numbers
+    are the FST descriptor indexes: they are stable for a given disc and the
+    root directory is always ROOT_INODE.
+    """
+
+    def __init__(self, part, index_dir=None):
         """
         Creates a filesystem object representing the filesystem present on the
-        given partition object (of type wiiod.partition.Partition).
+        given partition object (of type wiiod.partition.Partition). If
+        index_dir is provided, the inode table is mapped from a sidecar index
+        file in this directory when it is up to date, and saved there
+        otherwise. The index is only a speed-up: the filesystem is still
+        usable if it cannot be written.
         """
         self.part = part
 
-        self._build_tree()
+        if index_dir is None:
+            self._build_tree()
+            return
+
+        index_path = os.path.join(index_dir, part.unique_name() + '.fst')
+        if not self._load_index(index_path):
+            self._build_tree()
+            try:
+                if not os.path.isdir(index_dir):
+                    os.makedirs(index_dir)
+                self.save_index(index_path)
+            except EnvironmentError:
+                pass
+
+    def lookup(self, path):
+        """
+        Resolves a path to its inode number. Raises IOError if the path does
+        not exist.
+        """
+        key = path.strip('/')
+        if '//' in key:
+            key = '/'.join(comp for comp in key.split('/') if comp)
+        if not key:
+            return ROOT_INODE
+
+        comps = key.split('/')
+        table = self._path_table
+        mask = len(table) - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            ino = table[slot]
+            if ino == EMPTY_SLOT:
+                raise IOError("file not found")
+            if self._path_matches(ino, comps):
+                return ino
+            slot = (slot + 1) & mask
+
+    def _path_matches(self, ino, comps):
+        """
+        Checks if the path of an inode is made of the given components.
+        """
+        for comp in reversed(comps):
+            if ino == ROOT_INODE or self.inode_name(ino) != comp:
+                return False
+            ino = self._parents[ino]
+        return ino == ROOT_INODE
 
     def open(self, path):
         """
         Opens the provided path and returns a file-like object.
         """
-        if not self.isfile(path):
+        return self.open_inode(self.lookup(path))
+
+    def iter_chunks(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterates on the data of a file in chunks of at most chunk_size bytes,
+        see _File.iter_chunks.
+        """
+        fp = self.open(path)
+        try:
+            for data in fp.iter_chunks(chunk_size):
+                yield data
+        finally:
+            fp.close()
+
+    def copy_to(self, path, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes the data of a file to a file object without holding more than
+        one chunk in memory. Returns the number of bytes written.
+        """
+        fp = self.open(path)
+        try:
+            return fp.copy_to(fileobj, chunk_size)
+        finally:
+            fp.close()
+
+    def open_inode(self, ino):
+        """
+        Opens the file with the provided inode number and returns a file-like
+        object.
+        """
+        if self._types[ino]:
             raise IOError("is a directory")
-        return _File(self.part, *self._find_descr_for_path(path))
+        return _File(self.part, self._offsets[ino] * 4, self._sizes[ino])
 
     def listdir(self, path):
         """
         Lists the provided path and return a list of the direct child names.
         """
-        if not self.isdir(path):
+        ino = self.lookup(path)
+        if not self._types[ino]:
             raise IOError("not a directory")
-        return self._find_descr_for_path(path).keys()
+        return [self.inode_name(child) for child in self.inode_children(ino)]
 
     def isfile(self, path):
         """
         Checks if the provided path is a file.
         """
         try:
-            return isinstance(self._find_descr_for_path(path), tuple)
+            return not self._types[self.lookup(path)]
         except IOError:
             return False
 
@@ -111,7 +277,7 @@ class Filesystem(object):
         Checks if the provided path is a directory.
         """
         try:
-            return isinstance(self._find_descr_for_path(path), dict)
+            return bool(self._types[self.lookup(path)])
         except IOError:
             return False
 
@@ -120,7 +286,7 @@ class Filesystem(object):
         Checks if a path exists on the filesystem.
         """
         try:
-            self._find_descr_for_path(path)
+            self.lookup(path)
             return True
         except IOError:
             return False
@@ -129,68 +295,271 @@ class Filesystem(object):
         """
         Returns the size of a file.
         """
-        if not self.isfile(path):
+        ino = self.lookup(path)
+        if self._types[ino]:
             raise IOError("not a file")
-        return self._find_descr_for_path(path)[1]
+        return self._sizes[ino]
 
-    def _find_descr_for_path(self, path):
+    @property
+    def disc(self):
         """
-        Returns the descriptor for a specified path.
+        The wiiod.disc.Disc of the partition.
         """
-        root = self.tree
-        for comp in path.split('/'):
-            if comp == '':
-                continue
-            if comp not in root:
-                raise IOError("file not found")
-            root = root[comp]
-        return root
+        return self.part.disc
 
-    def _build_tree(self):
+    def stat(self):
         """
-        Reads the FileSystem Table (FST) to build the tree structure of the
-        filesystem.
+        Returns the os.stat_result of the disc image.
         """
-        # Offset to the FST
-        fst_offset_string = self.part.read(FST_OFFSET_POS, 4)
-        self.fst_offset = struct.unpack('>L', fst_offset_string)[0] * 4
+        return self.part.disc.stat()
 
-        # Offset to the filenames table
-        descr_count_string = self.part.read(self.fst_offset, 12)
-        self.str_offset = self.fst_offset
-        self.str_offset += struct.unpack('>8xL', descr_count_string)[0] * 12
+    @property
+    def inode_count(self):
+        """
+        Number of inodes in the filesystem, root directory included.
+        """
+        return len(self._types)
 
-        _, _, self.tree = self._parse_descriptor(0)
+    def inode_isdir(self, ino):
+        """
+        Checks if the inode is a directory.
+        """
+        return bool(self._types[ino])
 
-    def _parse_descriptor(self, idx):
+    def inode_size(self, ino):
         """
-        Parses the descriptor whose index matches the parameter. Returns the
-        number of descriptors parsed (if the descriptor represents a directory,
-        all the childs will be parsed), the file name and its data (or childs
-        in case of a directory).
+        Returns the size of a file inode (0 for directories).
         """
-        descr_string = self.part.read(self.fst_offset + 12 * idx, 12)
-        (name_off, data_off, size) = struct.unpack('>LLL', descr_string)
+        return 0 if self._types[ino] else self._sizes[ino]
 
-        data_off *= 4
+    def inode_offset(self, ino):
+        """
+        Returns the data offset of a file inode in the partition.
+        """
+        return self._offsets[ino] * 4
 
-        is_dir = bool(name_off & 0xFF000000)
-        name = self._read_filename(name_off & ~0xFF000000) if idx else ''
+    def inode_read(self, ino, offset, size):
+        """
+        Reads at most size bytes of a file inode at offset, without any file
+        object.
+        """
+        size = min(size, self._sizes[ino] - offset)
+        if size <= 0:
+            return ''
+        return self.part.read(self._offsets[ino] * 4 + offset, size)
 
-        if is_dir:
-            children = {}
-            idx += 1
-            while idx < size:
-                idx, child_name, child_data = self._parse_descriptor(idx)
-                children[child_name] = child_data
-            return idx, name, children
-        else:
-            return idx + 1, name, (data_off, size)
+    def inode_readahead(self, ino):
+        """
+        Returns a new wiiod.readahead.ReadaheadStream for a file inode, or
+        None if the partition does not prefetch data.
+        """
+        if self.part.readahead is None:
+            return None
+        return self.part.readahead.stream(self.part, self._offsets[ino] * 4,
+                                          self._sizes[ino])
+
+    def inode_parent(self, ino):
+        """
+        Returns the inode number of the parent directory.
+        """
+        return self._parents[ino]
+
+    def inode_name(self, ino):
+        """
+        Returns the name of an inode ('' for the root directory).
+        """
+        if ino == ROOT_INODE:
+            return ''
+        name_off = self._names_start + self._name_offsets[ino]
+        return self._names[name_off:self._names.find('\0', name_off)]
+
+    def inode_path(self, ino):
+        """
+        Returns the absolute path of an inode.
+        """
+        comps = []
+        while ino != ROOT_INODE:
+            comps.append(self.inode_name(ino))
+            ino = self._parents[ino]
+        return '/' + '/'.join(reversed(comps))
 
-    def _read_filename(self, offset):
+    def inode_children(self, ino):
+        """
+        Iterates on the inode numbers of the direct children of a directory.
+        Children of a directory are stored in the [ino + 1, end) range, with
+        each subdirectory followed by its own descendants.
+        """
+        end = self._sizes[ino]
+        child = ino + 1
+        while child < end:
+            yield child
+            child = self._sizes[child] if self._types[child] else child + 1
+
+    def save_index(self, path):
+        """
+        Saves the inode table to a sidecar index file, which can be mapped
+        in memory on later mounts instead of parsing the FST again. The file
+        is synced to disk and renamed, so that it is replaced atomically
+        even after a crash. Raises EnvironmentError if it cannot be written.
+        """
+        disc_key, image_size, image_mtime, part_offset = self._index_key()
+        count = len(self._types)
+        names = self._names[self._names_start:
+                            self._names_start + self._names_size]
+        header = INDEX_HEADER.pack(INDEX_MAGIC, disc_key, image_size,
+                                   image_mtime, part_offset, self.fst_offset,
+                                   self.fst_size, self.str_offset, count,
+                                   len(self._path_table), len(names))
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(header)
+                fp.write(buffer(self._types))
+                fp.write('\0' * (-count % 4))
+                for arr in (self._offsets, self._sizes, self._parents,
+                            self._name_offsets, self._path_table):
+                    fp.write(buffer(arr))
+                fp.write(names)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, path)
+        except EnvironmentError:
+            # Do not leave a partial index behind (a full disk, ...)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _index_key(self):
+        """
+        Returns the (disc key, image size, image mtime, partition offset)
+        tuple identifying the sidecar index of this filesystem.
+        """
+        meta = self.part.disc.metadata
+        disc_key = '%s%s%s%s%c%c' % (meta.disc_id, meta.game_code,
+                                     meta.region_code, meta.maker_code,
+                                     meta.disc_number, meta.disc_version)
+        st = self.part.disc.stat()
+        return (disc_key, st.st_size, int(st.st_mtime * 1000000000),
+                self.part.disc_infos.offset)
+
+    def _load_index(self, path):
+        """
+        Maps a sidecar index file in memory and serves the inode table from
+        the mapping: nothing is parsed or copied, the pages are only read
+        when the inodes are accessed. Returns False if the index is missing,
+        invalid or out of date.
+        """
+        # ctypes arrays need a writable buffer: the private mapping is never
+        # written, so it shares the page cache like a read-only one
+        try:
+            with open(path, 'rb') as fp:
+                index = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (EnvironmentError, ValueError):
+            return False
+
+        if len(index) < INDEX_HEADER.size:
+            index.close()
+            return False
+        header = INDEX_HEADER.unpack_from(index)
+        if header[0] != INDEX_MAGIC or header[1:5] != self._index_key():
+            index.close()
+            return False
+
+        (fst_offset, fst_size, str_offset, count, table_size,
+         names_size) = header[5:]
+        pos = INDEX_HEADER.size + count + (-count % 4)
+        end = pos + 16 * count + 4 * table_size + names_size
+        if len(index) != end:
+            index.close()
+            return False
+
+        # The arrays keep a reference to the mapping, which stays open as
+        # long as they are used
+        self.fst_offset, self.fst_size = fst_offset, fst_size
+        self.str_offset = str_offset
+        self._types = (ctypes.c_ubyte * count).from_buffer(index,
+                                                           INDEX_HEADER.size)
+        arrays = []
+        for size in (count, count, count, count, table_size):
+            arrays.append((ctypes.c_uint32 * size).from_buffer(index, pos))
+            pos += size * 4
+        (self._offsets, self._sizes, self._parents, self._name_offsets,
+         self._path_table) = arrays
+        self._names = index
+        self._names_start = pos
+        self._names_size = names_size
+        return True
+
+    def _build_tree(self):
         """
-        Reads a filename from the filenames table given its offset.
+        Reads the FileSystem Table (FST) to build the inode table of the
+        filesystem. The descriptors and the filenames table are each fetched
+        with a single read and decoded in one non-recursive pass.
         """
-        real_offset = self.str_offset + offset
-        string = self.part.read(real_offset, 256)
-        return string[:string.index('\0')]
+        # Offset and size of the FST (descriptors + filenames table)
+        fst_infos = self.part.read(FST_OFFSET_POS, 8)
+        self.fst_offset, self.fst_size = FST_INFOS.unpack(fst_infos)
+        self.fst_offset *= 4
+        self.fst_size *= 4
+
+        # The root descriptor size field is the total number of descriptors
+        root_string = self.part.read(self.fst_offset, DESCRIPTOR.size)
+        descr_count = DESCRIPTOR.unpack(root_string)[2]
+
+        self.str_offset = self.fst_offset + descr_count * DESCRIPTOR.size
+        descrs = self.part.read(self.fst_offset, descr_count * DESCRIPTOR.size)
+        self._names = self.part.read(self.str_offset,
+                                     self.fst_size - len(descrs))
+        self._names_start = 0
+        self._names_size = len(self._names)
+
+        # Parallel arrays indexed by inode number. For directories, the size
+        # is the end of the children range and the offset is unused.
+        self._types = bytearray(descr_count)
+        self._offsets = array.array('I', [0]) * descr_count
+        self._sizes = array.array('I', [0]) * descr_count
+        self._parents = array.array('I', [0]) * descr_count
+        self._name_offsets = array.array('I', [0]) * descr_count
+
+        # Open addressing hash table of the inodes, indexed by the CRC32 of
+        # their full path (without the leading /)
+        table_size = 8
+        while table_size < 2 * descr_count:
+            table_size *= 2
+        self._path_table = array.array('I', [EMPTY_SLOT]) * table_size
+        table = self._path_table
+        mask = table_size - 1
+
+        self._types[ROOT_INODE] = 1
+        self._sizes[ROOT_INODE] = descr_count
+
+        # Stack of (end index, inode, path prefix) for the enclosing dirs
+        stack = [(descr_count, ROOT_INODE, '')]
+        names = self._names
+        unpack_from = DESCRIPTOR.unpack_from
+        descr_size = DESCRIPTOR.size
+        crc32 = zlib.crc32
+        for idx in xrange(1, descr_count):
+            while idx >= stack[-1][0]:
+                stack.pop()
+
+            name_off, data_off, size = unpack_from(descrs, idx * descr_size)
+            is_dir = name_off & 0xFF000000
+            name_off &= 0x00FFFFFF
+            path = stack[-1][2] + names[name_off:names.index('\0', name_off)]
+
+            self._parents[idx] = stack[-1][1]
+            self._name_offsets[idx] = name_off
+            self._sizes[idx] = size
+
+            slot = crc32(path) & mask
+            while table[slot] != EMPTY_SLOT:
+                slot = (slot + 1) & mask
+            table[slot] = idx
+
+            if is_dir:
+                self._types[idx] = 1
+                stack.append((size, idx, path + '/'))
+            else:
+                self._offsets[idx] = data_off